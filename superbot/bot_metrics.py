@@ -0,0 +1,87 @@
+"""
+Метрики бота: время хэндлеров и запросы к Bot API
+=================================================
+
+HandlerMetricsMiddleware — inner middleware диспетчера (действует и на
+роутеры из handlers/): время каждого хэндлера с меткой
+"модуль.функция", без учёта очереди чата и throttling.
+
+TelegramRequestMetrics — middleware сессии бота: время каждого вызова
+Bot API и статус ответа (429 — flood control).
+
+Сами метрики объявлены в metrics.py.
+"""
+
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+    TelegramUnauthorizedError,
+)
+
+from metrics import BOT_HANDLER_LATENCY, observe_outbound
+
+# Исключение aiogram -> статус ответа Bot API для метрики
+TELEGRAM_ERROR_STATUS = (
+    (TelegramRetryAfter, "429"),
+    (TelegramBadRequest, "400"),
+    (TelegramUnauthorizedError, "401"),
+    (TelegramForbiddenError, "403"),
+    (TelegramNotFound, "404"),
+    (TelegramConflictError, "409"),
+    (TelegramServerError, "5xx"),
+    (TelegramNetworkError, "error"),
+)
+
+
+def telegram_error_status(error: Exception) -> str:
+    for error_type, status in TELEGRAM_ERROR_STATUS:
+        if isinstance(error, error_type):
+            return status
+    return "error"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время выполнения хэндлера по его имени"""
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        module = getattr(callback, "__module__", None)
+        # main.py запускается как скрипт — его хэндлеры из модуля __main__
+        if module == "__main__":
+            module = "main"
+        name = f"{module}.{getattr(callback, '__name__', type(callback).__name__)}"
+        started = time.monotonic()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            BOT_HANDLER_LATENCY.labels(name, status).observe(time.monotonic() - started)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Время и результат каждого запроса бота к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.monotonic()
+        try:
+            response = await make_request(bot, method)
+        except Exception as e:
+            observe_outbound("telegram", method.__api_method__, telegram_error_status(e), time.monotonic() - started)
+            raise
+        observe_outbound("telegram", method.__api_method__, "200", time.monotonic() - started)
+        return response
+
+
+handler_metrics_middleware = HandlerMetricsMiddleware()
@@ -0,0 +1,238 @@
+"""
+Webhook-режим бота (BOT_MODE=webhook)
+=====================================
+
+В polling-режиме бот — один процесс с одним циклом getUpdates. Webhook-режим
+принимает обновления через ASGI-эндпоинт за nginx и обрабатывает их в
+нескольких worker'ах:
+
+    Telegram → nginx → POST BOT_WEBHOOK_PATH (любой worker)
+        1. проверка X-Telegram-Bot-Api-Secret-Token
+        2. INSERT OR IGNORE в bot_updates (PRIMARY KEY update_id) — повторная
+           доставка того же обновления отбрасывается
+        3. сразу 200 OK
+    worker-владелец чата (abs(chat_id) % BOT_WEBHOOK_WORKERS == shard)
+        4. забирает свои обновления из bot_updates по порядку update_id
+           (at-most-once: прерванное падением обновление не повторяется)
+        5. передаёт их в ScheduledDispatcher: обновления одного чата — строго
+           по очереди, разных чатов — параллельно (update_scheduler.py)
+
+Каждый чат обрабатывает один worker, поэтому сохраняется порядок сообщений
+и согласованность кэшей в памяти (FSM, throttling). Номер shard'а worker
+получает через flock; если worker'ов больше, чем shard'ов, лишние только
+принимают обновления.
+
+Запуск: BOT_MODE=webhook python main.py (uvicorn с BOT_WEBHOOK_WORKERS worker'ами).
+Polling остаётся режимом по умолчанию.
+"""
+
+import asyncio
+import fcntl
+import hmac
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import Response
+
+from config import (
+    BOT_WEBHOOK_PATH, BOT_WEBHOOK_SECRET, BOT_WEBHOOK_WORKERS, WEBHOOK_BASE_URL
+)
+from metrics import is_local_client, render_metrics
+from database import (
+    init_db, enqueue_bot_update, claim_bot_updates, delete_old_bot_updates
+)
+from main import bot, dp, setup_dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Как часто worker проверяет очередь, если обновление пришло в другой worker
+BOT_UPDATE_POLL_INTERVAL = float(os.getenv("BOT_UPDATE_POLL_INTERVAL", 0.1))
+# Сколько хранить обработанные update_id (Telegram повторяет доставку в пределах часа)
+BOT_UPDATE_DEDUPE_TTL = 3600
+BOT_UPDATE_CLAIM_BATCH = 100
+
+SHARD_LOCK_TEMPLATE = os.path.join(tempfile.gettempdir(), "supercell-bot-shard-{}.lock")
+
+shard = None
+_shard_lock_fd = None
+_wakeup = asyncio.Event()
+
+
+# ============================================
+# РАЗБОР ОБНОВЛЕНИЯ
+# ============================================
+
+def extract_chat_id(update: dict) -> int:
+    """Чат обновления (для callback'ов без сообщения и т.п. — пользователь, иначе 0)"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        user = value.get("from") or value.get("user")
+        if user and "id" in user:
+            return int(user["id"])
+    return 0
+
+
+def owner_shard(chat_id: int) -> int:
+    return abs(chat_id) % BOT_WEBHOOK_WORKERS
+
+
+# ============================================
+# SHARD'Ы WORKER'ОВ
+# ============================================
+
+def acquire_shard():
+    """Занять свободный shard (flock). None — все shard'ы заняты."""
+    global shard, _shard_lock_fd
+    for index in range(BOT_WEBHOOK_WORKERS):
+        fd = os.open(SHARD_LOCK_TEMPLATE.format(index), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        shard, _shard_lock_fd = index, fd
+        return index
+    return None
+
+
+def release_shard():
+    global shard, _shard_lock_fd
+    if _shard_lock_fd is not None:
+        fcntl.flock(_shard_lock_fd, fcntl.LOCK_UN)
+        os.close(_shard_lock_fd)
+    shard, _shard_lock_fd = None, None
+
+
+# ============================================
+# ОБРАБОТКА
+# ============================================
+
+async def process_update(update_id: int, payload: str):
+    """Передать обновление диспетчеру (он ставит его в очередь чата и сразу возвращает)"""
+    try:
+        await dp.feed_raw_update(bot, json.loads(payload), dispatcher=dp)
+    except Exception as e:
+        logger.error(f"Update {update_id} failed: {e}", exc_info=True)
+
+
+async def consume_updates_task():
+    """Забирает обновления своих чатов из bot_updates"""
+    logger.info(f"Bot update consumer started (shard {shard}/{BOT_WEBHOOK_WORKERS})")
+    while True:
+        try:
+            rows = await claim_bot_updates(shard, BOT_WEBHOOK_WORKERS, BOT_UPDATE_CLAIM_BATCH)
+        except Exception as e:
+            logger.error(f"Bot update claim error: {e}")
+            rows = []
+
+        for update_id, chat_id, payload in rows:
+            await process_update(update_id, payload)
+
+        if len(rows) < BOT_UPDATE_CLAIM_BATCH:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=BOT_UPDATE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def cleanup_updates_task():
+    """Удаляет обработанные update_id старше BOT_UPDATE_DEDUPE_TTL"""
+    while True:
+        await asyncio.sleep(600)
+        try:
+            deleted = await delete_old_bot_updates(time.time() - BOT_UPDATE_DEDUPE_TTL)
+            if deleted:
+                logger.debug(f"Removed {deleted} processed bot updates")
+        except Exception as e:
+            logger.error(f"Bot updates cleanup error: {e}")
+
+
+async def _stop_task(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not BOT_WEBHOOK_SECRET:
+        raise RuntimeError("BOT_WEBHOOK_SECRET is required in webhook mode")
+
+    await init_db()
+    setup_dispatcher()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    tasks = []
+    if acquire_shard() is not None:
+        tasks.append(asyncio.create_task(consume_updates_task()))
+        if shard == 0:
+            tasks.append(asyncio.create_task(cleanup_updates_task()))
+            await bot.set_webhook(
+                url=f"{WEBHOOK_BASE_URL.rstrip('/')}{BOT_WEBHOOK_PATH}",
+                secret_token=BOT_WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=False
+            )
+            logger.info(f"Telegram webhook set to {WEBHOOK_BASE_URL}{BOT_WEBHOOK_PATH}")
+    else:
+        logger.warning("No free shard for this worker; accepting updates only")
+
+    yield
+
+    for task in tasks:
+        await _stop_task(task)
+    # emit_shutdown сначала дожидается очередей чатов
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await bot.session.close()
+    release_shard()
+
+
+app = FastAPI(title="SuperCell Shop Bot Webhook", lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+
+@app.post(BOT_WEBHOOK_PATH)
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: str = Header(None)
+):
+    """Приём обновления от Telegram"""
+    if not hmac.compare_digest(x_telegram_bot_api_secret_token or "", BOT_WEBHOOK_SECRET):
+        logger.warning(f"Webhook request with invalid secret from {request.client.host if request.client else '?'}")
+        return Response(status_code=403)
+
+    body = await request.body()
+    try:
+        update = json.loads(body)
+        update_id = int(update["update_id"])
+    except (ValueError, KeyError, TypeError):
+        return Response(status_code=400)
+
+    chat_id = extract_chat_id(update)
+    if not await enqueue_bot_update(update_id, chat_id, body.decode()):
+        logger.debug(f"Duplicate update {update_id} ignored")
+    elif shard is not None and owner_shard(chat_id) == shard:
+        # Своё обновление — будим обработчик без ожидания опроса
+        _wakeup.set()
+
+    return Response(status_code=200)
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Метрики Prometheus всех worker'ов (nginx отдаёт наружу только BOT_WEBHOOK_PATH)"""
+    if not is_local_client(request.client.host if request.client else ""):
+        return Response(status_code=404)
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
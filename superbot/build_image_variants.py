@@ -0,0 +1,42 @@
+"""
+Скрипт для сборки адаптивных картинок Mini App
+Строит WebP/AVIF (и уменьшенные исходные) варианты всех картинок
+miniapp/static/images для каждой ширины из WIDTH_BUCKETS.
+
+/api/img строит недостающие варианты и сам при первом запросе;
+скрипт убирает задержку первого запроса после деплоя.
+
+Запуск: python build_image_variants.py [ширина ...]
+"""
+
+import os
+import sys
+import time
+
+# image_variants импортирует соседние модули miniapp напрямую (как api.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "miniapp"))
+
+from image_variants import IMAGES_DIR, VARIANTS_DIR, WIDTH_BUCKETS, AVIF_ENABLED, WEBP_ENABLED, build_all
+
+
+def main():
+    widths = [int(arg) for arg in sys.argv[1:]] or list(WIDTH_BUCKETS)
+
+    print(f"Исходники: {IMAGES_DIR}")
+    print(f"Варианты:  {VARIANTS_DIR}")
+    print(f"Ширины: {widths}; AVIF: {'да' if AVIF_ENABLED else 'нет'}, WebP: {'да' if WEBP_ENABLED else 'нет'}")
+    print()
+
+    started = time.time()
+    stats = build_all(widths)
+
+    print(f"Картинок: {stats['sources']}")
+    print(f"✅ Построено вариантов: {stats['built']}")
+    print(f"⏭  Уже были: {stats['skipped']}")
+    if stats["failed"]:
+        print(f"⚠️  Ошибок: {stats['failed']}")
+    print(f"Время: {time.time() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
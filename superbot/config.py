@@ -4,12 +4,17 @@ from dotenv import load_dotenv
 # Загрузка переменных окружения
 load_dotenv()
 
+# Логи JSON-строками (log_setup.py); false — текстовый формат
+LOG_JSON = os.getenv("LOG_JSON", "false").lower() == "true"
+
 # Токен бота
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Адрес Bot API (пусто — api.telegram.org; для нагрузочных тестов — loadtest/fake_telegram.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 # Настройки базы данных (используем абсолютный путь)
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_NAME = os.path.join(_BASE_DIR, "shop_bot.db")
+DB_NAME = os.getenv("DB_NAME") or os.path.join(_BASE_DIR, "shop_bot.db")
 
 # ID администраторов (для поддержки)
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(","))) if os.getenv("ADMIN_IDS") else []
@@ -32,3 +37,27 @@ CATEGORY_MEDIA = {
     "clashroyale": os.getenv("CATEGORY_CLASHROYALE_MEDIA", "main.png"),
     "clashofclans": os.getenv("CATEGORY_CLASHOFCLANS_MEDIA", "main.png"),
 }
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+
+# Webhook-режим: Telegram -> nginx -> bot_webhook:app
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (обязателен в webhook-режиме)
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_HOST = os.getenv("BOT_WEBHOOK_HOST", "127.0.0.1")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", 8081))
+BOT_WEBHOOK_WORKERS = int(os.getenv("BOT_WEBHOOK_WORKERS", 2))
+
+# Метрики Prometheus бота: в polling-режиме — отдельный HTTP-сервер на этом порту
+# (0 — выключен), в webhook-режиме — GET /metrics на BOT_WEBHOOK_PORT
+BOT_METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", 9101))
+# Общий каталог метрик webhook-worker'ов (очищается при запуске)
+BOT_METRICS_DIR = os.getenv("BOT_METRICS_DIR", "/dev/shm/supercell-bot-metrics")
+
+# Статистика SQL-запросов (query_stats.py): порог медленного запроса (мс)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+# Каталог, через который процессы (worker'ы API, бот) делятся статистикой; пусто — только свой процесс
+QUERY_STATS_DIR = os.getenv("QUERY_STATS_DIR", "/dev/shm/supercell-query-stats")
@@ -4,19 +4,27 @@ from datetime import datetime
 import random
 import string
 import asyncio
+import json
+import time
+from collections import namedtuple
 from contextlib import asynccontextmanager
+from metrics import CACHE_REQUESTS, DB_CONNECTIONS_IN_USE, DB_POOL_WAIT, DB_RETRIES
+from query_stats import TimedConnection
 
 
 @asynccontextmanager
 async def get_db():
     """Получить подключение к БД с правильными настройками WAL и таймаутом"""
-    db = await aiosqlite.connect(DB_NAME)
+    db = await aiosqlite.connect(DB_NAME, factory=TimedConnection)
+    in_use = DB_CONNECTIONS_IN_USE.labels("direct")
+    in_use.inc()
     try:
         await db.execute("PRAGMA busy_timeout=30000")  # 30 секунд таймаут
         await db.execute("PRAGMA journal_mode=WAL")
         await db.execute("PRAGMA synchronous=NORMAL")
         yield db
     finally:
+        in_use.dec()
         await db.close()
 
 # Глобальный пул соединений
@@ -24,6 +32,21 @@ _db_pool = None
 _pool_size = 20  # Количество соединений в пуле
 _semaphore = None  # Семафор для ограничения одновременных подключений
 
+# Счётчики конкуренции за БД: повторы после блокировок и ожидание соединения из пула
+_db_stats = {
+    "lock_retries": 0,
+    "conflict_retries": 0,
+    "retry_sleep": 0.0,
+    "pool_acquires": 0,
+    "pool_wait": 0.0,
+    "pool_wait_max": 0.0,
+}
+
+
+def get_db_stats() -> dict:
+    """Снимок счётчиков конкуренции за БД (с момента старта процесса)"""
+    return dict(_db_stats)
+
 
 class DBPool:
     """Пул соединений к базе данных"""
@@ -39,24 +62,38 @@ class DBPool:
         if self._initialized:
             return
 
-        for _ in range(self.pool_size):
-            conn = await aiosqlite.connect(self.db_name)
-            # Включаем WAL режим для лучшей параллельной работы
-            await conn.execute("PRAGMA journal_mode=WAL")
-            await conn.execute("PRAGMA synchronous=NORMAL")
-            # Увеличиваем таймаут для высоконагруженных операций (30 секунд)
-            await conn.execute("PRAGMA busy_timeout=30000")
+        # Соединения открываются параллельно (у каждого свой поток aiosqlite):
+        # прогрев worker'а не ждёт pool_size последовательных открытий
+        for conn in await asyncio.gather(*(self._connect() for _ in range(self.pool_size))):
             await self.connections.put(conn)
 
         self._initialized = True
 
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.db_name, factory=TimedConnection)
+        # Включаем WAL режим для лучшей параллельной работы
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        # Увеличиваем таймаут для высоконагруженных операций (30 секунд)
+        await conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
     async def get_connection(self):
         """Получить соединение из пула"""
+        started = time.monotonic()
         await self.semaphore.acquire()
-        return await self.connections.get()
+        conn = await self.connections.get()
+        waited = time.monotonic() - started
+        _db_stats["pool_acquires"] += 1
+        _db_stats["pool_wait"] += waited
+        _db_stats["pool_wait_max"] = max(_db_stats["pool_wait_max"], waited)
+        DB_POOL_WAIT.observe(waited)
+        DB_CONNECTIONS_IN_USE.labels("pool").inc()
+        return conn
 
     async def return_connection(self, conn):
         """Вернуть соединение в пул"""
+        DB_CONNECTIONS_IN_USE.labels("pool").dec()
         await self.connections.put(conn)
         self.semaphore.release()
 
@@ -76,11 +113,56 @@ async def get_db_pool():
     return _db_pool
 
 
+async def close_db_pool():
+    """Закрыть пул при остановке (потоки aiosqlite иначе не дают процессу завершиться)"""
+    global _db_pool
+    if _db_pool is not None:
+        await _db_pool.close_pool()
+        _db_pool = None
+
+
+# ===== ИМЕНОВАННЫЕ СТРОКИ =====
+# Класс строки на каждый набор столбцов запроса
+_row_classes = {}
+
+
+def named_row(cursor, row):
+    """
+    row_factory курсора: namedtuple с именами столбцов запроса.
+    Строка остаётся tuple (row[0], len, распаковка работают как раньше),
+    а API берёт поля по имени: Model(**row._asdict())
+    """
+    fields = tuple(column[0] for column in cursor.description)
+    row_class = _row_classes.get(fields)
+    if row_class is None:
+        row_class = _row_classes[fields] = namedtuple("Row", fields, rename=True)
+    return row_class._make(row)
+
+
 # Кэш для часто запрашиваемых данных
 _user_cache = {}
 _product_cache = {}
 _cache_ttl = 300  # Время жизни кэша в секундах (5 минут для production)
 
+# Версия каталога: увеличивается при каждом изменении товаров в этом процессе.
+# По ней бот понимает, что закэшированные клавиатуры каталога устарели.
+_catalog_version = 0
+
+
+def get_catalog_version() -> int:
+    """Текущая версия каталога"""
+    return _catalog_version
+
+
+def _invalidate_catalog(product_id: int = None):
+    """Сбросить кэш товаров после изменения каталога"""
+    global _catalog_version
+    _catalog_version += 1
+    if product_id is None:
+        _product_cache.clear()
+    else:
+        _product_cache.pop(product_id, None)
+
 
 async def init_db():
     """Инициализация базы данных"""
@@ -209,6 +291,98 @@ async def init_db():
             )
         """)
 
+        # Позиции заказа (для корзины: один заказ — несколько товаров)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL,
+                product_id INTEGER,
+                product_name TEXT,
+                price REAL,
+                quantity INTEGER DEFAULT 1,
+                game TEXT,
+                FOREIGN KEY (order_id) REFERENCES orders (id),
+                FOREIGN KEY (product_id) REFERENCES products (id)
+            )
+        """)
+
+        # Журнал изменений статусов заказов (changefeed).
+        # Пишется в той же транзакции, что и сам статус; потребители
+        # (бот, worker'ы API) читают его по возрастанию id.
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS order_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL,
+                user_id INTEGER,
+                old_status TEXT,
+                new_status TEXT NOT NULL,
+                source TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (order_id) REFERENCES orders (id)
+            )
+        """)
+
+        # Позиции потребителей журнала order_events (последний обработанный id)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS order_event_cursors (
+                consumer TEXT PRIMARY KEY,
+                last_event_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # file_id загруженных в Telegram локальных картинок бота (меню, категории).
+        # Ключ — путь и хэш содержимого: изменили файл — загрузится заново.
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS media_files (
+                path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (path, content_hash)
+            )
+        """)
+
+        # Состояния FSM бота (мастер добавления товара, email для СБП и т.п.).
+        # Переживают перезапуск; updated_at — unix time для TTL
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                storage_key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)")
+
+        # Входящие обновления Telegram в webhook-режиме бота.
+        # PRIMARY KEY по update_id — защита от повторной доставки,
+        # обработанные строки хранятся ещё час и удаляются
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_updates (
+                update_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL DEFAULT 0,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                received_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_updates_status ON bot_updates(status, update_id)")
+
+        # Ключи идемпотентности для POST-запросов Mini App (повторы из WebView)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                user_id INTEGER NOT NULL,
+                endpoint TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL,
+                request_hash TEXT,
+                order_id INTEGER,
+                response TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, endpoint, idempotency_key)
+            )
+        """)
+
         await db.commit()
 
         # ============================================
@@ -217,8 +391,11 @@ async def init_db():
         indexes = [
             # Индекс для быстрого поиска заказов по статусу
             "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
-            # Индекс для быстрого поиска заказов пользователя
-            "CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)",
+            # Заказы пользователя, новые первыми (get_user_orders: поиск и
+            # ORDER BY created_at DESC по одному индексу, без сортировки)
+            "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)",
+            # Старый индекс заменён idx_orders_user_created (его префикс — тот же user_id)
+            "DROP INDEX IF EXISTS idx_orders_user_id",
             # Композитный индекс для фильтрации товаров
             "CREATE INDEX IF NOT EXISTS idx_products_game_subcategory ON products(game, subcategory)",
             # Индекс для поиска товаров в наличии
@@ -229,6 +406,16 @@ async def init_db():
             "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)",
             # Индекс для transaction_id (платежи)
             "CREATE INDEX IF NOT EXISTS idx_orders_transaction_id ON orders(transaction_id)",
+            # Индексы для позиций заказа (выборка по заказу и аналитика по товару)
+            "CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id)",
+            "CREATE INDEX IF NOT EXISTS idx_order_items_product_id ON order_items(product_id)",
+            # Индекс для очистки устаревших ключей идемпотентности
+            "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)",
+            # Индексы журнала заказов (догрузка событий покупателя, история заказа)
+            "CREATE INDEX IF NOT EXISTS idx_order_events_user_id ON order_events(user_id, id)",
+            "CREATE INDEX IF NOT EXISTS idx_order_events_order_id ON order_events(order_id)",
+            # Пользователи, пришедшие по реферальной ссылке (get_referral_stats)
+            "CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)",
         ]
 
         for index_sql in indexes:
@@ -287,7 +474,12 @@ async def get_or_create_user(user_id: int, username: str = None, first_name: str
             if "database is locked" in error_msg or "unique constraint" in error_msg:
                 if attempt < max_retries - 1:
                     # Небольшая случайная задержка перед retry
-                    await asyncio.sleep(0.1 * (attempt + 1) + random.random() * 0.1)
+                    delay = 0.1 * (attempt + 1) + random.random() * 0.1
+                    reason = "lock" if "locked" in error_msg else "conflict"
+                    _db_stats[f"{reason}_retries"] += 1
+                    DB_RETRIES.labels(reason).inc()
+                    _db_stats["retry_sleep"] += delay
+                    await asyncio.sleep(delay)
                     continue
             raise
 
@@ -328,8 +520,10 @@ async def get_user_balance(user_id: int) -> float:
         cache_entry = _user_cache[user_id]
         cache_age = (datetime.now() - cache_entry['time']).total_seconds()
         if cache_age < _cache_ttl:
+            CACHE_REQUESTS.labels("db_user", "hit").inc()
             # Баланс находится по индексу 4 в кортеже пользователя
             return cache_entry['data'][4] if cache_entry['data'] else 0.0
+    CACHE_REQUESTS.labels("db_user", "miss").inc()
 
     pool = await get_db_pool()
     db = await pool.get_connection()
@@ -440,13 +634,16 @@ async def get_product_by_id(product_id: int):
         cache_entry = _product_cache[product_id]
         cache_age = (datetime.now() - cache_entry['time']).total_seconds()
         if cache_age < _cache_ttl:
+            CACHE_REQUESTS.labels("db_product", "hit").inc()
             return cache_entry['data']
+    CACHE_REQUESTS.labels("db_product", "miss").inc()
 
     pool = await get_db_pool()
     db = await pool.get_connection()
 
     try:
         async with db.execute("SELECT * FROM products WHERE id = ?", (product_id,)) as cursor:
+            cursor.row_factory = named_row
             result = await cursor.fetchone()
             # Кэшируем товар
             _product_cache[product_id] = {'data': result, 'time': datetime.now()}
@@ -455,6 +652,45 @@ async def get_product_by_id(product_id: int):
         await pool.return_connection(db)
 
 
+async def get_products_by_ids(product_ids):
+    """Получить несколько товаров одним запросом (IN).
+    Возвращает dict {product_id: row}; отсутствующие ID в словарь не попадают.
+    """
+    result = {}
+    missing = []
+    now = datetime.now()
+
+    for product_id in dict.fromkeys(product_ids):
+        cache_entry = _product_cache.get(product_id)
+        if cache_entry and cache_entry['data'] and (now - cache_entry['time']).total_seconds() < _cache_ttl:
+            result[product_id] = cache_entry['data']
+        else:
+            missing.append(product_id)
+    CACHE_REQUESTS.labels("db_product", "hit").inc(len(result))
+    CACHE_REQUESTS.labels("db_product", "miss").inc(len(missing))
+
+    if not missing:
+        return result
+
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+
+    try:
+        placeholders = ", ".join("?" for _ in missing)
+        async with db.execute(
+            f"SELECT * FROM products WHERE id IN ({placeholders})", missing
+        ) as cursor:
+            cursor.row_factory = named_row
+            rows = await cursor.fetchall()
+
+        for row in rows:
+            result[row[0]] = row
+            _product_cache[row[0]] = {'data': row, 'time': now}
+        return result
+    finally:
+        await pool.return_connection(db)
+
+
 def generate_pickup_code() -> str:
     """Генерировать код получения формата XXX-XXX-XXX"""
     def random_segment():
@@ -463,25 +699,58 @@ def generate_pickup_code() -> str:
     return f"{random_segment()}-{random_segment()}-{random_segment()}"
 
 
-async def create_order(user_id: int, product_id: int, amount: float, product_name: str = None, game: str = None, pickup_code: str = None, supercell_id: str = None):
-    """Создать заказ"""
+async def create_order(user_id: int, product_id: int, amount: float, product_name: str = None, game: str = None, pickup_code: str = None, supercell_id: str = None, items: list = None):
+    """Создать заказ
+
+    items: позиции заказа [(product_id, product_name, price, quantity, game), ...].
+    Записываются в order_items в той же транзакции, что и сам заказ.
+    """
     if pickup_code is None:
         pickup_code = generate_pickup_code()
 
     async with get_db() as db:
-        await db.execute(
+        cursor = await db.execute(
             "INSERT INTO orders (user_id, product_id, product_name, amount, game, pickup_code, status, supercell_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             (user_id, product_id, product_name, amount, game, pickup_code, "pending", supercell_id)
         )
-        await db.commit()
+        # ID созданного заказа
+        order_id = cursor.lastrowid
 
-        # Получаем ID созданного заказа
-        cursor = await db.execute("SELECT last_insert_rowid()")
-        order_id = (await cursor.fetchone())[0]
+        await _append_order_event(db, order_id, user_id, None, "pending", "create")
+
+        if items:
+            await db.executemany(
+                "INSERT INTO order_items (order_id, product_id, product_name, price, quantity, game) VALUES (?, ?, ?, ?, ?, ?)",
+                [(order_id, *item) for item in items]
+            )
+
+        await db.commit()
 
         return order_id, pickup_code
 
 
+async def get_order_items(order_id: int):
+    """Получить позиции заказа"""
+    async with get_db() as db:
+        cursor = await db.execute("""
+            SELECT product_id, product_name, price, quantity, game
+            FROM order_items
+            WHERE order_id = ?
+            ORDER BY id
+        """, (order_id,))
+        rows = await cursor.fetchall()
+        return [
+            {
+                "product_id": row[0],
+                "product_name": row[1],
+                "price": row[2],
+                "quantity": row[3],
+                "game": row[4]
+            }
+            for row in rows
+        ]
+
+
 async def create_order_without_balance(user_id: int, product_id: int, supercell_id: str):
     """Создать заказ без списания баланса. Возвращает (success, message, order_id, pickup_code)"""
     # Получаем товар
@@ -543,19 +812,38 @@ async def purchase_with_balance(user_id: int, product_id: int):
 
 # === Функции для статистики ===
 
+# Границы периодов статистики. Условие — диапазон по самому столбцу, а не
+# DATE(столбец) = ...: функция над столбцом не даёт использовать индекс
+# (idx_orders_created_at), и SQLite читает таблицу целиком.
+# Время хранится текстом 'YYYY-MM-DD HH:MM:SS' (UTC), поэтому сравнение с
+# DATE('now') ('YYYY-MM-DD') — то же, что сравнение дат.
+_PERIOD_BOUNDS = {
+    "today": ("DATE('now')", "DATE('now', '+1 day')"),
+    "yesterday": ("DATE('now', '-1 day')", "DATE('now')"),
+    "7days": ("DATE('now', '-7 days')", None),
+}
+
+
+def _period_filter(column: str, period: str) -> str:
+    """SQL-условие "column попадает в period" (пустая строка для 'all')"""
+    bounds = _PERIOD_BOUNDS.get(period)
+    if bounds is None:
+        return ""
+    start, end = bounds
+    if end is None:
+        return f"{column} >= {start}"
+    return f"{column} >= {start} AND {column} < {end}"
+
+
 async def get_stats_users(period: str = "all") -> dict:
     """Получить статистику по пользователям
     period: 'today', 'yesterday', '7days', 'all'
     """
     async with get_db() as db:
-        if period == "today":
-            query = "SELECT COUNT(*) FROM users WHERE DATE(last_activity) = DATE('now')"
-        elif period == "yesterday":
-            query = "SELECT COUNT(*) FROM users WHERE DATE(last_activity) = DATE('now', '-1 day')"
-        elif period == "7days":
-            query = "SELECT COUNT(*) FROM users WHERE DATE(last_activity) >= DATE('now', '-7 days')"
-        else:  # all
-            query = "SELECT COUNT(*) FROM users"
+        date_filter = _period_filter("last_activity", period)
+        query = "SELECT COUNT(*) FROM users"
+        if date_filter:
+            query += f" WHERE {date_filter}"
 
         async with db.execute(query) as cursor:
             result = await cursor.fetchone()
@@ -569,14 +857,10 @@ async def get_stats_revenue(period: str = "all") -> float:
     """
     async with get_db() as db:
         # Учитываем все заказы кроме отменённых и ожидающих оплаты СБП
-        if period == "today":
-            query = "SELECT SUM(amount) FROM orders WHERE DATE(created_at) = DATE('now') AND (status IS NULL OR status NOT IN ('cancelled', 'pending_payment'))"
-        elif period == "yesterday":
-            query = "SELECT SUM(amount) FROM orders WHERE DATE(created_at) = DATE('now', '-1 day') AND (status IS NULL OR status NOT IN ('cancelled', 'pending_payment'))"
-        elif period == "7days":
-            query = "SELECT SUM(amount) FROM orders WHERE DATE(created_at) >= DATE('now', '-7 days') AND (status IS NULL OR status NOT IN ('cancelled', 'pending_payment'))"
-        else:  # all
-            query = "SELECT SUM(amount) FROM orders WHERE status IS NULL OR status NOT IN ('cancelled', 'pending_payment')"
+        query = "SELECT SUM(amount) FROM orders WHERE (status IS NULL OR status NOT IN ('cancelled', 'pending_payment'))"
+        date_filter = _period_filter("created_at", period)
+        if date_filter:
+            query += f" AND {date_filter}"
 
         async with db.execute(query) as cursor:
             result = await cursor.fetchone()
@@ -590,14 +874,9 @@ async def get_stats_sales_by_game(game: str, period: str = "all") -> dict:
     Возвращает {'count': количество, 'revenue': сумма}
     """
     async with get_db() as db:
-        if period == "today":
-            date_filter = "AND DATE(created_at) = DATE('now')"
-        elif period == "yesterday":
-            date_filter = "AND DATE(created_at) = DATE('now', '-1 day')"
-        elif period == "7days":
-            date_filter = "AND DATE(created_at) >= DATE('now', '-7 days')"
-        else:  # all
-            date_filter = ""
+        date_filter = _period_filter("created_at", period)
+        if date_filter:
+            date_filter = f"AND {date_filter}"
 
         # Считаем все заказы кроме отменённых и ожидающих оплаты
         query_count = f"SELECT COUNT(*) FROM orders WHERE game = ? AND (status IS NULL OR status NOT IN ('cancelled', 'pending_payment')) {date_filter}"
@@ -614,6 +893,51 @@ async def get_stats_sales_by_game(game: str, period: str = "all") -> dict:
         return {'count': count, 'revenue': revenue}
 
 
+async def get_stats_sales_by_product(period: str = "all") -> list:
+    """Получить статистику продаж по товарам (включая позиции корзины)
+    period: 'today', 'yesterday', '7days', 'all'
+    Возвращает [{'product_id', 'product_name', 'count', 'revenue'}, ...] по убыванию выручки
+    """
+    async with get_db() as db:
+        date_filter = _period_filter("o.created_at", period)
+        if date_filter:
+            date_filter = f"AND {date_filter}"
+
+        status_filter = "(o.status IS NULL OR o.status NOT IN ('cancelled', 'pending_payment'))"
+
+        # Одиночные заказы хранят товар в orders.product_id,
+        # заказы по корзине — в order_items (orders.product_id = NULL)
+        query = f"""
+            SELECT product_id, MAX(product_name), SUM(qty), SUM(revenue)
+            FROM (
+                SELECT o.product_id AS product_id, o.product_name AS product_name,
+                       1 AS qty, o.amount AS revenue
+                FROM orders o
+                WHERE o.product_id IS NOT NULL AND {status_filter} {date_filter}
+                UNION ALL
+                SELECT oi.product_id, oi.product_name,
+                       oi.quantity, oi.price * oi.quantity
+                FROM order_items oi
+                JOIN orders o ON o.id = oi.order_id
+                WHERE {status_filter} {date_filter}
+            )
+            GROUP BY product_id
+            ORDER BY SUM(revenue) DESC
+        """
+
+        async with db.execute(query) as cursor:
+            rows = await cursor.fetchall()
+            return [
+                {
+                    'product_id': row[0],
+                    'product_name': row[1],
+                    'count': row[2] or 0,
+                    'revenue': row[3] or 0.0
+                }
+                for row in rows
+            ]
+
+
 async def get_orders_stats_debug() -> dict:
     """Получить отладочную статистику по всем заказам - разбивка по статусам"""
     async with get_db() as db:
@@ -674,6 +998,7 @@ async def add_product(name: str, description: str, price: float, game: str, subc
             (name, description, price, game, subcategory, image_file_id)
         )
         await db.commit()
+        _invalidate_catalog()
 
         # Возвращаем ID созданного товара
         async with db.execute("SELECT last_insert_rowid()") as cursor:
@@ -681,21 +1006,30 @@ async def add_product(name: str, description: str, price: float, game: str, subc
             return result[0] if result else None
 
 
+async def get_product_image_file_ids() -> list:
+    """Все image_file_id каталога (для прогрева хранилища картинок)"""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT DISTINCT image_file_id FROM products WHERE image_file_id IS NOT NULL AND image_file_id != ''"
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+
 async def get_products_by_game_and_subcategory(game: str = None, subcategory: str = None):
-    """Получить товары по игре и подкатегории"""
+    """Получить товары по игре и подкатегории (строки named_row)"""
     async with get_db() as db:
         if game and subcategory:
             query = "SELECT * FROM products WHERE game = ? AND subcategory = ? AND in_stock = 1"
-            async with db.execute(query, (game, subcategory)) as cursor:
-                return await cursor.fetchall()
+            params = (game, subcategory)
         elif game:
             query = "SELECT * FROM products WHERE game = ? AND in_stock = 1"
-            async with db.execute(query, (game,)) as cursor:
-                return await cursor.fetchall()
+            params = (game,)
         else:
             query = "SELECT * FROM products WHERE in_stock = 1"
-            async with db.execute(query) as cursor:
-                return await cursor.fetchall()
+            params = ()
+        async with db.execute(query, params) as cursor:
+            cursor.row_factory = named_row
+            return await cursor.fetchall()
 
 
 async def update_product(product_id: int, name: str = None, description: str = None, price: float = None, image_file_id: str = None):
@@ -722,16 +1056,32 @@ async def update_product(product_id: int, name: str = None, description: str = N
             params.append(product_id)
             await db.execute(query, params)
             await db.commit()
+            _invalidate_catalog(product_id)
             return True
         return False
 
 
 async def delete_product(product_id: int):
     """Удалить товар (мягкое удаление - устанавливаем in_stock = 0)"""
+    return await set_product_in_stock(product_id, False)
+
+
+async def set_product_in_stock(product_id: int, in_stock: bool):
+    """Показать/скрыть товар в каталоге"""
     async with get_db() as db:
-        await db.execute("UPDATE products SET in_stock = 0 WHERE id = ?", (product_id,))
+        await db.execute("UPDATE products SET in_stock = ? WHERE id = ?", (1 if in_stock else 0, product_id))
         await db.commit()
-        return True
+    _invalidate_catalog(product_id)
+    return True
+
+
+async def get_catalog_products():
+    """Все товары в наличии для навигации бота: (id, name, game, subcategory)"""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT id, name, game, subcategory FROM products WHERE in_stock = 1 ORDER BY id"
+        )
+        return await cursor.fetchall()
 
 
 async def get_all_products_admin():
@@ -818,7 +1168,7 @@ async def get_referral_stats(referral_code: str):
 
         # Получаем переходы за сегодня
         async with db.execute(
-            "SELECT COUNT(DISTINCT user_id) FROM referral_visits WHERE referral_code = ? AND DATE(created_at) = DATE('now')",
+            "SELECT COUNT(DISTINCT user_id) FROM referral_visits WHERE referral_code = ? AND " + _period_filter("created_at", "today"),
             (referral_code,)
         ) as cursor:
             result = await cursor.fetchone()
@@ -826,17 +1176,20 @@ async def get_referral_stats(referral_code: str):
 
         # Получаем переходы за 7 дней
         async with db.execute(
-            "SELECT COUNT(DISTINCT user_id) FROM referral_visits WHERE referral_code = ? AND DATE(created_at) >= DATE('now', '-7 days')",
+            "SELECT COUNT(DISTINCT user_id) FROM referral_visits WHERE referral_code = ? AND " + _period_filter("created_at", "7days"),
             (referral_code,)
         ) as cursor:
             result = await cursor.fetchone()
             week_users = result[0] if result else 0
 
-        # Получаем статистику по заказам пользователей, пришедших по этой ссылке
+        # Получаем статистику по заказам пользователей, пришедших по этой ссылке.
+        # CROSS JOIN фиксирует порядок в SQLite: сначала пользователи ссылки
+        # (idx_users_referral_code), затем их заказы (idx_orders_user_created),
+        # а не все завершённые заказы магазина с проверкой каждого покупателя
         async with db.execute("""
             SELECT COUNT(*), COALESCE(SUM(o.amount), 0)
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
+            FROM users u
+            CROSS JOIN orders o ON o.user_id = u.user_id
             WHERE u.referral_code = ? AND o.status = 'completed'
         """, (referral_code,)) as cursor:
             result = await cursor.fetchone()
@@ -844,22 +1197,22 @@ async def get_referral_stats(referral_code: str):
             total_revenue = result[1] if result else 0.0
 
         # Получаем заказы за сегодня
-        async with db.execute("""
+        async with db.execute(f"""
             SELECT COUNT(*), COALESCE(SUM(o.amount), 0)
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-            WHERE u.referral_code = ? AND o.status = 'completed' AND DATE(o.created_at) = DATE('now')
+            FROM users u
+            CROSS JOIN orders o ON o.user_id = u.user_id
+            WHERE u.referral_code = ? AND o.status = 'completed' AND {_period_filter('o.created_at', 'today')}
         """, (referral_code,)) as cursor:
             result = await cursor.fetchone()
             today_orders = result[0] if result else 0
             today_revenue = result[1] if result else 0.0
 
         # Получаем заказы за 7 дней
-        async with db.execute("""
+        async with db.execute(f"""
             SELECT COUNT(*), COALESCE(SUM(o.amount), 0)
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-            WHERE u.referral_code = ? AND o.status = 'completed' AND DATE(o.created_at) >= DATE('now', '-7 days')
+            FROM users u
+            CROSS JOIN orders o ON o.user_id = u.user_id
+            WHERE u.referral_code = ? AND o.status = 'completed' AND {_period_filter('o.created_at', '7days')}
         """, (referral_code,)) as cursor:
             result = await cursor.fetchone()
             week_orders = result[0] if result else 0
@@ -978,7 +1331,8 @@ async def add_to_user_balance(user_id, amount):
 # === Функции для работы с заказами ===
 
 async def get_user_orders(user_id: int, limit: int = 20):
-    """Получить заказы пользователя для истории"""
+    """Получить заказы пользователя для истории (строки named_row:
+    id, product_name, amount, status, pickup_code, supercell_id, created_at, game)"""
     async with get_db() as db:
         cursor = await db.execute("""
             SELECT id, product_name, amount, status, pickup_code, supercell_id, created_at, game
@@ -987,20 +1341,8 @@ async def get_user_orders(user_id: int, limit: int = 20):
             ORDER BY created_at DESC
             LIMIT ?
         """, (user_id, limit))
-        rows = await cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "product_name": row[1],
-                "amount": row[2],
-                "status": row[3],
-                "pickup_code": row[4],
-                "supercell_id": row[5],
-                "created_at": row[6],
-                "game": row[7]
-            }
-            for row in rows
-        ]
+        cursor.row_factory = named_row
+        return await cursor.fetchall()
 
 
 async def get_pending_orders():
@@ -1026,47 +1368,61 @@ async def get_order_by_id(order_id: int):
         return await cursor.fetchone()
 
 
-async def confirm_order(order_id: int):
+async def confirm_order(order_id: int, source: str = "admin_confirm"):
     """Подтвердить заказ"""
     async with get_db() as db:
-        await db.execute("""
+        # Чтение и запись в одной транзакции: параллельный вызов ждёт commit
+        # и уже не видит старый статус — событие пишется один раз
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT user_id, status FROM orders WHERE id = ?", (order_id,))
+        order = await cursor.fetchone()
+
+        cursor = await db.execute("""
             UPDATE orders
             SET status = 'completed'
-            WHERE id = ?
+            WHERE id = ? AND status IS NOT 'completed'
         """, (order_id,))
+
+        if cursor.rowcount == 1:
+            await _append_order_event(db, order_id, order[0], order[1], "completed", source)
+
         await db.commit()
 
 
-async def cancel_order(order_id: int):
+async def cancel_order(order_id: int, source: str = "admin_cancel"):
     """Отменить заказ и вернуть деньги пользователю"""
     async with get_db() as db:
+        await db.execute("BEGIN IMMEDIATE")
         # Получаем информацию о заказе
         cursor = await db.execute("""
-            SELECT user_id, amount
+            SELECT user_id, amount, status
             FROM orders
             WHERE id = ?
         """, (order_id,))
         order = await cursor.fetchone()
 
         if not order:
+            await db.rollback()
             return False
 
-        user_id, amount = order
-
-        # Возвращаем деньги на баланс
-        await db.execute("""
-            UPDATE users
-            SET balance = balance + ?
-            WHERE user_id = ?
-        """, (amount, user_id))
+        user_id, amount, old_status = order
 
-        # Обновляем статус заказа
-        await db.execute("""
+        # Обновляем статус заказа; уже отменённый не трогаем — иначе деньги вернутся дважды
+        cursor = await db.execute("""
             UPDATE orders
             SET status = 'cancelled'
-            WHERE id = ?
+            WHERE id = ? AND status IS NOT 'cancelled'
         """, (order_id,))
 
+        if cursor.rowcount == 1:
+            # Возвращаем деньги на баланс
+            await db.execute("""
+                UPDATE users
+                SET balance = balance + ?
+                WHERE user_id = ?
+            """, (amount, user_id))
+            await _append_order_event(db, order_id, user_id, old_status, "cancelled", source)
+
         await db.commit()
         return True
 
@@ -1075,19 +1431,33 @@ async def cancel_order(order_id: int):
 #ФУНКЦИИ ДЛЯ РАБОТЫ С ПЛАТЕЖАМИ WATA.PRO
 #============================================
 
-async def save_payment_transaction(order_id: int, transaction_id: str):
+async def save_payment_transaction(order_id: int, transaction_id: str, source: str = "payment_link"):
     """Сохраняет transaction_id от wata.pro для заказа"""
     async with get_db() as db:
-        await db.execute("""
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT user_id, status FROM orders WHERE id = ?", (order_id,))
+        order = await cursor.fetchone()
+
+        if not order:
+            await db.rollback()
+            return
+
+        user_id, old_status = order
+        # Оплаченный, выполненный или отменённый заказ статус не меняет
+        if old_status in ("paid", "completed", "cancelled"):
+            new_status = old_status
+        else:
+            new_status = "pending_payment"
+
+        cursor = await db.execute("""
             UPDATE orders
-            SET
-                transaction_id = ?,
-                status = CASE
-                    WHEN status IN ('paid', 'completed', 'cancelled') THEN status
-                    ELSE 'pending_payment'
-                END
-            WHERE id = ?
-        """, (transaction_id, order_id))
+            SET transaction_id = ?, status = ?
+            WHERE id = ? AND status IS ?
+        """, (transaction_id, new_status, order_id, old_status))
+
+        if cursor.rowcount == 1 and new_status != old_status:
+            await _append_order_event(db, order_id, user_id, old_status, new_status, source)
+
         await db.commit()
 
 
@@ -1112,21 +1482,26 @@ async def get_pending_payments():
         ]
 
 
-async def update_order_payment_status(order_id: int, status: str):
+async def update_order_payment_status(order_id: int, status: str, source: str = None):
     """
     Обновляет статус платежа заказа
 
     status: 'paid', 'payment_failed', 'pending_payment'
+    source: кто меняет статус (webhook, checker, mark_paid...) — пишется в order_events
+    Возвращает True, если статус изменён (False — переход запрещён,
+    статус уже такой или заказа нет)
     """
     import logging
     logger = logging.getLogger(__name__)
 
     try:
         async with get_db() as db:
+            # webhook и checker могут прийти одновременно: BEGIN IMMEDIATE
+            # сериализует чтение статуса и запись, второй увидит уже новый статус
+            await db.execute("BEGIN IMMEDIATE")
             # Сначала проверим текущий статус
-            cursor = await db.execute("SELECT status FROM orders WHERE id = ?", (order_id,))
+            cursor = await db.execute("SELECT status, user_id FROM orders WHERE id = ?", (order_id,))
             old_status = await cursor.fetchone()
-            logger.info(f"[UPDATE_STATUS] Order {order_id}: OLD status = {old_status}")
 
             current_status = old_status[0] if old_status else None
 
@@ -1136,7 +1511,8 @@ async def update_order_payment_status(order_id: int, status: str):
                     f"[UPDATE_STATUS] Skip downgrade for order {order_id}: "
                     f"{current_status} -> {status}"
                 )
-                return
+                await db.rollback()
+                return False
 
             # Отмененный заказ оставляем отмененным.
             if current_status == "cancelled" and status != "cancelled":
@@ -1144,25 +1520,30 @@ async def update_order_payment_status(order_id: int, status: str):
                     f"[UPDATE_STATUS] Skip status change for cancelled order {order_id}: "
                     f"{current_status} -> {status}"
                 )
-                return
+                await db.rollback()
+                return False
 
             # Обновляем
-            await db.execute("""
+            cursor = await db.execute("""
                 UPDATE orders
                 SET status = ?
-                WHERE id = ?
-            """, (status, order_id))
-            await db.commit()
+                WHERE id = ? AND status IS NOT ?
+            """, (status, order_id, status))
+            updated = cursor.rowcount
 
-            # Проверим что обновилось
-            cursor = await db.execute("SELECT status FROM orders WHERE id = ?", (order_id,))
-            new_status = await cursor.fetchone()
-            logger.info(f"[UPDATE_STATUS] Order {order_id}: NEW status = {new_status}")
+            if updated == 1:
+                await _append_order_event(db, order_id, old_status[1], current_status, status, source)
 
-            if new_status and new_status[0] == status:
-                logger.info(f"[UPDATE_STATUS] Order {order_id} successfully updated to '{status}'")
+            await db.commit()
+
+            # Одна строка на переход; UPDATE того же соединения не перечитываем
+            if updated == 1:
+                logger.info(f"[UPDATE_STATUS] Order {order_id}: {current_status} -> {status} ({source})")
+            elif old_status:
+                logger.info(f"[UPDATE_STATUS] Order {order_id} already '{status}' ({source})")
             else:
-                logger.error(f"[UPDATE_STATUS] Order {order_id} UPDATE FAILED! Expected '{status}', got {new_status}")
+                logger.error(f"[UPDATE_STATUS] Order {order_id} UPDATE FAILED! Expected '{status}', order not found")
+            return updated == 1
     except Exception as e:
         logger.error(f"[UPDATE_STATUS] Exception updating order {order_id}: {e}", exc_info=True)
         raise
@@ -1189,3 +1570,353 @@ async def get_order_by_transaction_id(transaction_id: str):
                 "supercell_id": row[7]
             }
         return None
+
+
+#============================================
+#КЛЮЧИ ИДЕМПОТЕНТНОСТИ (Idempotency-Key)
+#============================================
+
+# Сколько секунд незавершённая запись считается "в обработке".
+# Если worker упал посреди запроса, по истечении таймаута ключ можно занять снова.
+IDEMPOTENCY_PENDING_TIMEOUT = 60
+
+
+async def get_idempotency_record(user_id: int, endpoint: str, idempotency_key: str, ttl: int):
+    """Получить запись по ключу идемпотентности (один поиск по первичному ключу).
+    Возвращает {'request_hash', 'order_id', 'response'} или None.
+    response = None, пока исходный запрос ещё обрабатывается.
+    """
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+    try:
+        async with db.execute("""
+            SELECT request_hash, order_id, response
+            FROM idempotency_keys
+            WHERE user_id = ? AND endpoint = ? AND idempotency_key = ?
+              AND created_at >= datetime('now', ?)
+        """, (user_id, endpoint, idempotency_key, f"-{int(ttl)} seconds")) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return {
+            "request_hash": row[0],
+            "order_id": row[1],
+            "response": json.loads(row[2]) if row[2] else None
+        }
+    finally:
+        await pool.return_connection(db)
+
+
+async def reserve_idempotency_key(user_id: int, endpoint: str, idempotency_key: str, request_hash: str, ttl: int) -> bool:
+    """Занять ключ идемпотентности перед выполнением запроса.
+    Возвращает True, если ключ занят этим вызовом (можно выполнять запрос).
+    """
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+    try:
+        # Освобождаем ключ, если запись устарела или зависла в обработке
+        await db.execute("""
+            DELETE FROM idempotency_keys
+            WHERE user_id = ? AND endpoint = ? AND idempotency_key = ?
+              AND (created_at < datetime('now', ?)
+                   OR (response IS NULL AND created_at < datetime('now', ?)))
+        """, (user_id, endpoint, idempotency_key, f"-{int(ttl)} seconds", f"-{IDEMPOTENCY_PENDING_TIMEOUT} seconds"))
+        cursor = await db.execute("""
+            INSERT OR IGNORE INTO idempotency_keys (user_id, endpoint, idempotency_key, request_hash)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, endpoint, idempotency_key, request_hash))
+        await db.commit()
+        return cursor.rowcount == 1
+    finally:
+        await pool.return_connection(db)
+
+
+async def complete_idempotency_key(user_id: int, endpoint: str, idempotency_key: str, order_id: int, response: dict):
+    """Сохранить ответ для ключа идемпотентности"""
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+    try:
+        await db.execute("""
+            UPDATE idempotency_keys
+            SET order_id = ?, response = ?
+            WHERE user_id = ? AND endpoint = ? AND idempotency_key = ?
+        """, (order_id, json.dumps(response, ensure_ascii=False), user_id, endpoint, idempotency_key))
+        await db.commit()
+    finally:
+        await pool.return_connection(db)
+
+
+async def release_idempotency_key(user_id: int, endpoint: str, idempotency_key: str):
+    """Освободить незавершённый ключ (запрос упал или вернул ошибку — повтор допустим)"""
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+    try:
+        await db.execute("""
+            DELETE FROM idempotency_keys
+            WHERE user_id = ? AND endpoint = ? AND idempotency_key = ? AND response IS NULL
+        """, (user_id, endpoint, idempotency_key))
+        await db.commit()
+    finally:
+        await pool.return_connection(db)
+
+
+async def delete_expired_idempotency_keys(ttl: int) -> int:
+    """Удалить ключи идемпотентности старше TTL. Возвращает количество удалённых."""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+            (f"-{int(ttl)} seconds",)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+
+#============================================
+#ЖУРНАЛ ИЗМЕНЕНИЙ ЗАКАЗОВ (order_events)
+#============================================
+
+async def _append_order_event(db, order_id: int, user_id: int, old_status: str, new_status: str, source: str = None) -> int:
+    """Записать изменение статуса в order_events.
+    Вызывается внутри транзакции, которая меняет заказ, — commit делает вызывающий.
+    """
+    cursor = await db.execute("""
+        INSERT INTO order_events (order_id, user_id, old_status, new_status, source)
+        VALUES (?, ?, ?, ?, ?)
+    """, (order_id, user_id, old_status, new_status, source))
+    return cursor.lastrowid
+
+
+async def get_order_events_after(last_event_id: int, limit: int = 500, user_id: int = None) -> list:
+    """События журнала с id > last_event_id по возрастанию id.
+    user_id — только события одного покупателя.
+    """
+    query = """
+        SELECT id, order_id, user_id, old_status, new_status, source, created_at
+        FROM order_events
+        WHERE id > ?
+    """
+    params = [last_event_id]
+    if user_id is not None:
+        query += " AND user_id = ?"
+        params.append(user_id)
+    query += " ORDER BY id LIMIT ?"
+    params.append(limit)
+
+    pool = await get_db_pool()
+    db = await pool.get_connection()
+    try:
+        async with db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+    finally:
+        await pool.return_connection(db)
+
+    return [
+        {
+            "id": row[0],
+            "order_id": row[1],
+            "user_id": row[2],
+            "old_status": row[3],
+            "new_status": row[4],
+            "source": row[5],
+            "created_at": row[6]
+        }
+        for row in rows
+    ]
+
+
+async def get_last_order_event_id() -> int:
+    """Последний id в журнале (0, если событий нет)"""
+    async with get_db() as db:
+        cursor = await db.execute("SELECT MAX(id) FROM order_events")
+        row = await cursor.fetchone()
+        return row[0] or 0
+
+
+async def get_order_event_cursor(consumer: str) -> int:
+    """Позиция потребителя в журнале (0 — ещё ничего не читал)"""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT last_event_id FROM order_event_cursors WHERE consumer = ?",
+            (consumer,)
+        )
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+
+async def save_order_event_cursor(consumer: str, last_event_id: int):
+    """Сохранить позицию потребителя (только вперёд)"""
+    async with get_db() as db:
+        await db.execute("""
+            INSERT INTO order_event_cursors (consumer, last_event_id, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(consumer) DO UPDATE SET
+                last_event_id = MAX(last_event_id, excluded.last_event_id),
+                updated_at = CURRENT_TIMESTAMP
+        """, (consumer, last_event_id))
+        await db.commit()
+
+
+async def consume_order_events(consumer: str, handler, limit: int = 500) -> int:
+    """Обработать новые события журнала для потребителя consumer.
+
+    handler(event) — async-функция, вызывается по порядку id.
+    Курсор сдвигается после обработки; если handler упал, курсор остаётся
+    на последнем успешно обработанном событии (доставка at-least-once).
+    Возвращает количество обработанных событий.
+    """
+    last_event_id = await get_order_event_cursor(consumer)
+    events = await get_order_events_after(last_event_id, limit)
+    processed = 0
+
+    try:
+        for event in events:
+            await handler(event)
+            last_event_id = event["id"]
+            processed += 1
+    finally:
+        if processed:
+            await save_order_event_cursor(consumer, last_event_id)
+
+    return processed
+
+
+#============================================
+#РЕЕСТР МЕДИА (file_id локальных картинок)
+#============================================
+
+async def get_media_file_ids() -> dict:
+    """Все сохранённые file_id: {(path, content_hash): file_id}"""
+    async with get_db() as db:
+        cursor = await db.execute("SELECT path, content_hash, file_id FROM media_files")
+        return {(row[0], row[1]): row[2] for row in await cursor.fetchall()}
+
+
+async def save_media_file_id(path: str, content_hash: str, file_id: str):
+    """Сохранить file_id загруженной картинки"""
+    async with get_db() as db:
+        await db.execute("""
+            INSERT OR REPLACE INTO media_files (path, content_hash, file_id)
+            VALUES (?, ?, ?)
+        """, (path, content_hash, file_id))
+        await db.commit()
+
+
+async def delete_media_file_id(path: str, content_hash: str):
+    """Забыть file_id (Telegram его больше не принимает)"""
+    async with get_db() as db:
+        await db.execute(
+            "DELETE FROM media_files WHERE path = ? AND content_hash = ?",
+            (path, content_hash)
+        )
+        await db.commit()
+
+
+#============================================
+#СОСТОЯНИЯ FSM БОТА
+#============================================
+
+async def get_fsm_record(storage_key: str, min_updated_at: float):
+    """(state, data_json, updated_at) или None, если записи нет или она старше min_updated_at"""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE storage_key = ? AND updated_at >= ?",
+            (storage_key, min_updated_at)
+        )
+        return await cursor.fetchone()
+
+
+async def save_fsm_records(records: list):
+    """
+    Записать пачку состояний одной транзакцией.
+    records: [(storage_key, state, data_json, updated_at)]; пустые state и data удаляются.
+    """
+    if not records:
+        return
+    to_delete = [(r[0],) for r in records if r[1] is None and r[2] == "{}"]
+    to_save = [r for r in records if not (r[1] is None and r[2] == "{}")]
+    async with get_db() as db:
+        if to_delete:
+            await db.executemany("DELETE FROM fsm_states WHERE storage_key = ?", to_delete)
+        if to_save:
+            await db.executemany("""
+                INSERT INTO fsm_states (storage_key, state, data, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(storage_key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """, to_save)
+        await db.commit()
+
+
+async def delete_expired_fsm_records(min_updated_at: float) -> int:
+    """Удалить брошенные состояния FSM. Возвращает количество удалённых."""
+    async with get_db() as db:
+        cursor = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (min_updated_at,))
+        await db.commit()
+        return cursor.rowcount
+
+
+#============================================
+#ВХОДЯЩИЕ ОБНОВЛЕНИЯ TELEGRAM (webhook-режим)
+#============================================
+
+async def enqueue_bot_update(update_id: int, chat_id: int, payload: str) -> bool:
+    """Поставить обновление в очередь. False — такой update_id уже был."""
+    pool = await get_db_pool()
+    conn = await pool.get_connection()
+    try:
+        cursor = await conn.execute("""
+            INSERT OR IGNORE INTO bot_updates (update_id, chat_id, payload, received_at)
+            VALUES (?, ?, ?, ?)
+        """, (update_id, chat_id, payload, time.time()))
+        await conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        await pool.return_connection(conn)
+
+
+async def claim_bot_updates(shard: int, shards: int, limit: int = 100) -> list:
+    """
+    Забрать ожидающие обновления своих чатов (abs(chat_id) % shards == shard)
+    в порядке update_id. Возвращает [(update_id, chat_id, payload)].
+
+    Забранные строки сразу отмечаются обработанными (одна запись на пачку):
+    обновление, прерванное падением worker'а, не повторяется — покупка не
+    должна выполниться дважды. Строка остаётся для защиты от повторной доставки.
+    """
+    pool = await get_db_pool()
+    conn = await pool.get_connection()
+    try:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await conn.execute("""
+                SELECT update_id, chat_id, payload FROM bot_updates
+                WHERE status = 'pending' AND abs(chat_id) % ? = ?
+                ORDER BY update_id
+                LIMIT ?
+            """, (shards, shard, limit))
+            rows = await cursor.fetchall()
+            if rows:
+                await conn.executemany(
+                    "UPDATE bot_updates SET status = 'done' WHERE update_id = ?",
+                    [(row[0],) for row in rows]
+                )
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        return rows
+    finally:
+        await pool.return_connection(conn)
+
+
+async def delete_old_bot_updates(min_received_at: float) -> int:
+    """Удалить обработанные обновления старше min_received_at"""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "DELETE FROM bot_updates WHERE status = 'done' AND received_at < ?",
+            (min_received_at,)
+        )
+        await db.commit()
+        return cursor.rowcount
@@ -32,7 +32,7 @@ echo -e "${YELLOW}[1/8] Обновление системы...${NC}"
 apt update && apt upgrade -y
 
 echo -e "${YELLOW}[2/8] Установка зависимостей...${NC}"
-apt install -y python3 python3-pip python3-venv nginx certbot python3-certbot-nginx git
+apt install -y python3 python3-pip python3-venv nginx certbot python3-certbot-nginx git curl
 
 echo -e "${YELLOW}[3/8] Создание директорий...${NC}"
 mkdir -p $APP_DIR
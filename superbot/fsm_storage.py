@@ -0,0 +1,202 @@
+"""
+Хранилище FSM бота в SQLite
+===========================
+
+С MemoryStorage все незавершённые сценарии (мастер добавления товара,
+подтверждение рассылки, ввод email для СБП, создание реферальной ссылки)
+терялись при перезапуске бота.
+
+SQLiteStorage хранит состояния в таблице fsm_states той же базы:
+- чтение — из LRU-кэша в памяти, в БД только при промахе
+- запись — сразу в кэш (write-through), в БД — пачкой раз в
+  FSM_FLUSH_INTERVAL: несколько set_state/set_data одного пользователя
+  подряд превращаются в одну строку одного commit'а
+- брошенные состояния старше FSM_STATE_TTL не читаются и периодически
+  удаляются
+
+Кэш не согласуется между процессами: одновременно обрабатывать один чат
+должен один процесс (polling так и работает, в webhook-режиме чаты
+распределяются по процессам).
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import get_fsm_record, save_fsm_records, delete_expired_fsm_records
+
+logger = logging.getLogger(__name__)
+
+# Время жизни незавершённого сценария (секунды)
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 86400))
+# Как часто записывать изменения в БД (секунды)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))
+# Сколько записей держать в памяти
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+# Как часто удалять брошенные состояния из БД (секунды)
+FSM_PURGE_INTERVAL = 3600
+
+
+def _json_default(value):
+    """Объекты aiogram (клавиатура рассылки, entities) сохраняем как dict —
+    при отправке aiogram принимает их обратно"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"FSM data value of type {type(value).__name__} is not JSON serializable")
+
+
+class _Record:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: Optional[str] = None, data: Dict[str, Any] = None, updated_at: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated_at = updated_at
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage: LRU в памяти + отложенная пакетная запись в SQLite"""
+
+    def __init__(self, ttl: int = FSM_STATE_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()  # storage_key -> _Record
+        self._dirty = set()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._last_purge = 0.0
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0, "rows_written": 0, "expired": 0}
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    # ===== КЭШ =====
+
+    def _is_expired(self, record: _Record, now: float) -> bool:
+        return now - record.updated_at > self.ttl
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        storage_key = self._key(key)
+        now = time.time()
+
+        record = self._cache.get(storage_key)
+        if record is not None:
+            if not self._is_expired(record, now):
+                self.stats["hits"] += 1
+                self._cache.move_to_end(storage_key)
+                return record
+            self.stats["expired"] += 1
+            record = _Record(updated_at=now)
+        else:
+            self.stats["misses"] += 1
+            row = await get_fsm_record(storage_key, now - self.ttl)
+            if row:
+                record = _Record(row[0], json.loads(row[1] or "{}"), row[2])
+            else:
+                record = _Record(updated_at=now)
+
+        self._put(storage_key, record)
+        return record
+
+    def _put(self, storage_key: str, record: _Record):
+        self._cache[storage_key] = record
+        self._cache.move_to_end(storage_key)
+        # Вытесняем только записанные в БД записи
+        while len(self._cache) > self.cache_size:
+            oldest = next(iter(self._cache))
+            if oldest in self._dirty:
+                break
+            del self._cache[oldest]
+
+    def _mark_dirty(self, key: StorageKey, record: _Record):
+        record.updated_at = time.time()
+        self._dirty.add(self._key(key))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    # ===== ЗАПИСЬ В БД =====
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"FSM storage flush failed: {e}")
+            # Повторим при следующем изменении
+            if self._dirty:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def flush(self):
+        """Записать все изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            records = []
+            for storage_key in dirty:
+                record = self._cache.get(storage_key)
+                if record is None:
+                    continue
+                records.append((
+                    storage_key,
+                    record.state,
+                    json.dumps(record.data, ensure_ascii=False, default=_json_default),
+                    record.updated_at
+                ))
+            try:
+                await save_fsm_records(records)
+            except BaseException:
+                # В том числе CancelledError из close(): иначе финальный
+                # flush() не увидит эти ключи и состояния пропадут
+                self._dirty |= dirty
+                raise
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(records)
+
+            now = time.time()
+            if now - self._last_purge > FSM_PURGE_INTERVAL:
+                self._last_purge = now
+                deleted = await delete_expired_fsm_records(now - self.ttl)
+                if deleted:
+                    logger.info(f"FSM storage: removed {deleted} abandoned states")
+
+    # ===== BaseStorage =====
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = copy.deepcopy(data)
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy((await self._get_record(key)).data)
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
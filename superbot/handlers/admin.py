@@ -5,16 +5,15 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from config import ADMIN_IDS
 from database import (
-    get_stats_users, get_stats_revenue, get_stats_sales_by_game,
+    get_stats_users, get_stats_revenue, get_stats_sales_by_game, get_stats_sales_by_product,
     get_all_users_ids, add_product, get_products_by_game_and_subcategory,
-    update_product, delete_product, get_all_products_admin, get_product_by_id,
+    update_product, delete_product, set_product_in_stock, get_all_products_admin, get_product_by_id,
     create_referral_link, get_all_referral_links, get_referral_stats, delete_referral_link,
     get_all_users, search_user_by_id, get_user_full_stats,
     search_user_by_uid, get_user_uid
 )
 import json
 import asyncio
-import aiosqlite
 
 router = Router()
 
@@ -143,6 +142,14 @@ async def show_all_stats(callback: CallbackQuery):
         revenue = stats.get('revenue', 0)
         games_text += f"{game_names[game]}: {count} шт / {revenue:.0f} ₽\n"
 
+    # Топ товаров по выручке (с учётом позиций корзины из order_items)
+    top_products = (await get_stats_sales_by_product("all"))[:5]
+    products_text = ""
+    for i, product in enumerate(top_products, 1):
+        products_text += f"{i}. {product['product_name']}: {product['count']} шт / {product['revenue']:.0f} ₽\n"
+    if not products_text:
+        products_text = "Продаж пока нет\n"
+
     text = (
         f"📊 Статистика\n\n"
         f"👥 Пользователи:\n"
@@ -153,7 +160,8 @@ async def show_all_stats(callback: CallbackQuery):
         f"Всего: {revenue_total:.0f} ₽\n"
         f"Сегодня: {revenue_today:.0f} ₽\n"
         f"За 7 дней: {revenue_week:.0f} ₽\n\n"
-        f"🎮 Продажи по играм:\n{games_text}"
+        f"🎮 Продажи по играм:\n{games_text}\n"
+        f"🏆 Топ товаров:\n{products_text}"
     )
 
     keyboard = [[InlineKeyboardButton(text="« Назад", callback_data="admin_panel")]]
@@ -820,10 +828,7 @@ async def toggle_product_visibility(callback: CallbackQuery, state: FSMContext):
     new_status = 0 if in_stock else 1
 
     # Обновляем статус
-    from config import DB_NAME
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE products SET in_stock = ? WHERE id = ?", (new_status, product_id))
-        await db.commit()
+    await set_product_in_stock(product_id, new_status)
 
     status_text = "скрыт" if new_status == 0 else "показан"
     await callback.answer(f"Товар {status_text}", show_alert=True)
@@ -1,6 +1,9 @@
+import asyncio
+import time
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, FSInputFile
-from database import get_products_by_game_and_subcategory
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from database import get_catalog_products, get_catalog_version
+from message_render import render_screen
 from pathlib import Path
 
 router = Router()
@@ -98,103 +101,155 @@ def build_game_keyboard(game: str, products_all=None) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+def _category_image_path(game: str, subcategory: str):
+    """Картинка категории, иначе общая картинка игры"""
+    category_image_path = CATEGORY_IMAGES_DIR / game / f"{subcategory}.png"
+    if category_image_path.exists():
+        return category_image_path
+
+    image_filename = GAME_IMAGES.get(game)
+    if image_filename and (BASE_DIR / image_filename).exists():
+        return BASE_DIR / image_filename
+    return None
+
+
+def render_category_view(game: str, subcategory: str, products) -> dict:
+    """Caption, клавиатура и картинка экрана категории"""
+    keyboard = []
+
+    for product in products:
+        product_id, name = product[0], product[1]
+        keyboard.append([InlineKeyboardButton(
+            text=name,
+            callback_data=f"buy_product_{product_id}"
+        )])
+
+    keyboard.append([InlineKeyboardButton(text="Назад", callback_data=f"category_{game}")])
+
+    cat_name = get_category_name(game, subcategory)
+    game_name = get_game_name(game)
+
+    caption = f"{game_name} / {cat_name}\n\n"
+    if subcategory == "akcii":
+        caption += "Проверяйте наличие акции в игре перед покупкой!\n\n"
+
+    if products:
+        caption += "Выберите товар:"
+    else:
+        caption += "Товары скоро появятся!"
+
+    return {
+        "caption": caption,
+        "keyboard": InlineKeyboardMarkup(inline_keyboard=keyboard),
+        "image_path": _category_image_path(game, subcategory)
+    }
+
+
+def render_game_view(game: str, products_all) -> dict:
+    """Caption, клавиатура и картинка экрана игры"""
+    image_path = BASE_DIR / GAME_IMAGES[game]
+    return {
+        "caption": f"{get_game_name(game)}\n\nВыберите категорию",
+        "keyboard": build_game_keyboard(game, products_all),
+        "image_path": image_path if image_path.exists() else None
+    }
+
+
+# ===== КЭШ ЭКРАНОВ КАТАЛОГА =====
+# Экраны всех игр и категорий строятся один раз на версию каталога
+# (database.get_catalog_version меняется при правках товаров в админке).
+# TTL — страховка от правок из других процессов (скрипты импорта и т.п.).
+CATALOG_VIEWS_TTL = 300
+
+_catalog_views = {}
+_catalog_views_version = None
+_catalog_views_built_at = 0.0
+_catalog_views_lock = asyncio.Lock()
+
+
+def _is_catalog_views_fresh() -> bool:
+    return (
+        _catalog_views_version == get_catalog_version()
+        and time.monotonic() - _catalog_views_built_at < CATALOG_VIEWS_TTL
+    )
+
+
+async def get_catalog_views() -> dict:
+    """
+    Все экраны каталога: {(game, None): экран игры, (game, subcategory): экран категории}.
+    Перестраиваются одним запросом к БД, только если каталог изменился.
+    """
+    global _catalog_views, _catalog_views_version, _catalog_views_built_at
+
+    if _is_catalog_views_fresh():
+        return _catalog_views
+
+    async with _catalog_views_lock:
+        if _is_catalog_views_fresh():
+            return _catalog_views
+
+        version = get_catalog_version()
+        products = await get_catalog_products()
+
+        by_category = {}
+        for product in products:
+            by_category.setdefault((product[2], product[3]), []).append(product)
+
+        views = {}
+        for game, game_config in CATEGORIES.items():
+            views[(game, None)] = render_game_view(game, by_category.get((game, "all"), []))
+            for cat in game_config["categories"]:
+                views[(game, cat["id"])] = render_category_view(
+                    game, cat["id"], by_category.get((game, cat["id"]), [])
+                )
+        # Подкатегории товаров, которых нет в CATEGORIES (доступны по старым кнопкам)
+        for (game, subcategory), items in by_category.items():
+            if (game, subcategory) not in views:
+                views[(game, subcategory)] = render_category_view(game, subcategory, items)
+
+        _catalog_views = views
+        _catalog_views_version = version
+        _catalog_views_built_at = time.monotonic()
+        return views
+
+
+async def get_catalog_view(game: str, subcategory: str = None) -> dict:
+    """Экран игры (subcategory=None) или категории"""
+    views = await get_catalog_views()
+    view = views.get((game, subcategory))
+    if view is None:
+        # Неизвестная подкатегория — пустой экран, в кэш не кладём
+        view = render_category_view(game, subcategory, [])
+    return view
+
+
 async def show_category_products(callback: CallbackQuery, game: str, subcategory: str):
     """Универсальный показ товаров категории"""
     try:
-        products = await get_products_by_game_and_subcategory(game, subcategory)
-
-        keyboard = []
-
-        if products:
-            for product in products:
-                product_id, name = product[0], product[1]
-                keyboard.append([InlineKeyboardButton(
-                    text=name,
-                    callback_data=f"buy_product_{product_id}"
-                )])
-
-        keyboard.append([InlineKeyboardButton(text="Назад", callback_data=f"category_{game}")])
-
-        cat_name = get_category_name(game, subcategory)
-        game_name = get_game_name(game)
-
-        caption = f"{game_name} / {cat_name}\n\n"
-        if subcategory == "akcii":
-            caption += "Проверяйте наличие акции в игре перед покупкой!\n\n"
-
-        if products:
-            caption += "Выберите товар:"
-        else:
-            caption += "Товары скоро появятся!"
-
-        # Пытаемся найти изображение для категории
-        category_image_path = CATEGORY_IMAGES_DIR / game / f"{subcategory}.png"
-
-        if category_image_path.exists():
-            # Используем изображение категории
-            image_path = category_image_path
-        else:
-            # Используем общее изображение игры
-            image_filename = GAME_IMAGES.get(game)
-            if image_filename:
-                image_path = BASE_DIR / image_filename
-            else:
-                image_path = None
-
-        if image_path and image_path.exists():
-            try:
-                photo = FSInputFile(str(image_path))
-                await callback.message.edit_media(
-                    media=InputMediaPhoto(media=photo, caption=caption),
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-                )
-                await callback.answer()
-                return
-            except Exception as e:
-                print(f"Failed to edit media in show_category_products: {e}")
-
-        # Если не удалось поменять изображение, просто меняем caption/text
-        try:
-            await callback.message.edit_caption(
-                caption=caption,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
-        except Exception:
-            try:
-                await callback.message.edit_text(
-                    text=caption,
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-                )
-            except Exception:
-                pass
+        view = await get_catalog_view(game, subcategory)
+        await render_screen(callback.message, view["caption"], view["keyboard"], photo=view["image_path"])
     except Exception as e:
         print(f"Error in show_category_products: {e}")
     finally:
         await callback.answer()
 
 
+async def show_game_categories(callback: CallbackQuery, game: str):
+    """Показать категории игры"""
+    try:
+        view = await get_catalog_view(game)
+        await render_screen(callback.message, view["caption"], view["keyboard"], photo=view["image_path"])
+    except Exception as e:
+        print(f"Error in show_game_categories: {e}")
+    finally:
+        await callback.answer()
+
+
 # ===== BRAWL STARS =====
 @router.callback_query(F.data == "category_brawlstars")
 async def show_brawlstars(callback: CallbackQuery):
     """Показать категории Brawl Stars"""
-    products_all = await get_products_by_game_and_subcategory("brawlstars", "all")
-    caption = "Brawl Stars\n\nВыберите категорию"
-    keyboard = build_game_keyboard("brawlstars", products_all)
-
-    # Загружаем изображение игры
-    image_path = BASE_DIR / GAME_IMAGES["brawlstars"]
-    if image_path.exists():
-        try:
-            photo = FSInputFile(str(image_path))
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=photo, caption=caption),
-                reply_markup=keyboard
-            )
-        except:
-            await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    else:
-        await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    await callback.answer()
+    await show_game_categories(callback, "brawlstars")
 
 
 @router.callback_query(F.data.startswith("brawlstars_"))
@@ -208,24 +263,7 @@ async def show_brawlstars_category(callback: CallbackQuery):
 @router.callback_query(F.data == "category_clashroyale")
 async def show_clashroyale(callback: CallbackQuery):
     """Показать категории Clash Royale"""
-    products_all = await get_products_by_game_and_subcategory("clashroyale", "all")
-    caption = "Clash Royale\n\nВыберите категорию"
-    keyboard = build_game_keyboard("clashroyale", products_all)
-
-    # Загружаем изображение игры
-    image_path = BASE_DIR / GAME_IMAGES["clashroyale"]
-    if image_path.exists():
-        try:
-            photo = FSInputFile(str(image_path))
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=photo, caption=caption),
-                reply_markup=keyboard
-            )
-        except:
-            await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    else:
-        await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    await callback.answer()
+    await show_game_categories(callback, "clashroyale")
 
 
 @router.callback_query(F.data.startswith("clashroyale_"))
@@ -239,24 +277,7 @@ async def show_clashroyale_category(callback: CallbackQuery):
 @router.callback_query(F.data == "category_clashofclans")
 async def show_clashofclans(callback: CallbackQuery):
     """Показать категории Clash of Clans"""
-    products_all = await get_products_by_game_and_subcategory("clashofclans", "all")
-    caption = "Clash of Clans\n\nВыберите категорию"
-    keyboard = build_game_keyboard("clashofclans", products_all)
-
-    # Загружаем изображение игры
-    image_path = BASE_DIR / GAME_IMAGES["clashofclans"]
-    if image_path.exists():
-        try:
-            photo = FSInputFile(str(image_path))
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=photo, caption=caption),
-                reply_markup=keyboard
-            )
-        except:
-            await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    else:
-        await callback.message.edit_caption(caption=caption, reply_markup=keyboard)
-    await callback.answer()
+    await show_game_categories(callback, "clashofclans")
 
 
 @router.callback_query(F.data.startswith("clashofclans_"))
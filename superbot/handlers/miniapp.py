@@ -1,5 +1,6 @@
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from message_render import render_screen
 
 router = Router()
 
@@ -17,25 +18,15 @@ async def open_miniapp(callback: CallbackQuery):
         [InlineKeyboardButton(text="Назад", callback_data="main_menu")]
     ])
 
-    try:
-        await callback.message.edit_caption(
-            caption="🌟 Bubs Shop Mini App 🌟\n\n"
-                    "Откройте наш удобный магазин прямо в Telegram!\n\n"
-                    "✨ Удобный каталог товаров\n"
-                    "🔍 Быстрый поиск\n"
-                    "💳 Покупка в один клик\n"
-                    "📱 Красивый интерфейс",
-            reply_markup=keyboard
-        )
-    except:
-        await callback.message.edit_text(
-            text="🌟 Bubs Shop Mini App 🌟\n\n"
-                 "Откройте наш удобный магазин прямо в Telegram!\n\n"
-                 "✨ Удобный каталог товаров\n"
-                 "🔍 Быстрый поиск\n"
-                 "💳 Покупка в один клик\n"
-                 "📱 Красивый интерфейс",
-            reply_markup=keyboard
-        )
+    await render_screen(
+        callback.message,
+        "🌟 Bubs Shop Mini App 🌟\n\n"
+        "Откройте наш удобный магазин прямо в Telegram!\n\n"
+        "✨ Удобный каталог товаров\n"
+        "🔍 Быстрый поиск\n"
+        "💳 Покупка в один клик\n"
+        "📱 Красивый интерфейс",
+        keyboard
+    )
 
     await callback.answer()
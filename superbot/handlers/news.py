@@ -2,6 +2,7 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from config import NEWS_CHANNEL
 from keyboards import get_back_to_menu
+from message_render import render_screen
 
 router = Router()
 
@@ -32,14 +33,5 @@ async def show_news(callback: CallbackQuery):
         "Подпишитесь, чтобы не пропустить ничего важного:"
     )
 
-    try:
-        await callback.message.edit_caption(
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-        )
-    except:
-        await callback.message.edit_text(
-            text=caption,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-        )
+    await render_screen(callback.message, caption, InlineKeyboardMarkup(inline_keyboard=keyboard))
     await callback.answer()
@@ -3,7 +3,7 @@ from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardBut
 from aiogram.fsm.context import FSMContext
 from config import ADMIN_IDS
 from database import (
-    get_pending_orders, get_order_by_id, confirm_order, cancel_order,
+    get_pending_orders, get_order_by_id, get_order_items, confirm_order, cancel_order,
     get_user_full_stats, get_user_uid
 )
 
@@ -11,6 +11,8 @@ router = Router()
 
 # Количество заказов на странице
 ORDERS_PER_PAGE = 5
+# Сколько позиций корзины показывать в деталях заказа (лимит длины сообщения)
+ORDER_ITEMS_SHOWN = 15
 TODO_STATUSES = {"paid", "pending"}
 UNPAID_STATUSES = {"pending_payment"}
 
@@ -406,6 +408,18 @@ async def view_order_details(callback: CallbackQuery):
     # Получаем UID пользователя
     user_uid = await get_user_uid(user_id)
 
+    # Заказ по корзине: product_id = NULL, в product_name — обрезанная сводка,
+    # полный состав лежит в order_items
+    product_line = f"🛒 Товар: {product_name}\n"
+    if order[2] is None:
+        items = await get_order_items(order_id)
+        if items:
+            product_line = "🛒 Товары:\n"
+            for item in items[:ORDER_ITEMS_SHOWN]:
+                product_line += f"  • {item['product_name']} × {item['quantity']} — {item['price'] * item['quantity']:.0f} ₽\n"
+            if len(items) > ORDER_ITEMS_SHOWN:
+                product_line += f"  … ещё {len(items) - ORDER_ITEMS_SHOWN} поз.\n"
+
     # Определяем игру
     game_icons = {
         "brawlstars": "⭐ Brawl Stars",
@@ -435,7 +449,7 @@ async def view_order_details(callback: CallbackQuery):
         f"{'='*24}\n\n"
         f"📦 Заказ: #{order_id}\n"
         f"🎮 Игра: {game_text}\n"
-        f"🛒 Товар: {product_name}\n"
+        f"{product_line}"
         f"💰 Сумма: {amount:.0f} ₽\n\n"
         f"👤 Покупатель: UID #{user_uid}\n"
         f"🆔 Telegram: {user_id}\n"
@@ -2,6 +2,7 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from database import get_or_create_user, get_user_orders_stats, get_user_uid
 from keyboards import get_back_to_menu
+from message_render import render_screen
 
 router = Router()
 
@@ -32,15 +33,5 @@ async def show_profile(callback: CallbackQuery):
            f"UID: #{uid}\n\n" \
            f"{orders_text}"
 
-    try:
-        await callback.message.edit_caption(
-            caption=text,
-            reply_markup=get_back_to_menu()
-        )
-    except:
-        # Если нет caption, используем edit_text
-        await callback.message.edit_text(
-            text=text,
-            reply_markup=get_back_to_menu()
-        )
+    await render_screen(callback.message, text, get_back_to_menu())
     await callback.answer()
@@ -1,5 +1,5 @@
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import (
@@ -7,6 +7,7 @@ from database import (
     create_order_without_balance, update_order_payment_status
 )
 from keyboards import get_product_categories
+from message_render import render_screen
 from config import ADMIN_IDS, SUPPORT_URL
 import sys
 import os
@@ -59,22 +60,12 @@ async def buy_product(callback: CallbackQuery):
     caption = f"{description}\n\nЦена: {price:.0f} ₽"
 
     # Если есть изображение товара - показываем его
-    if image_file_id:
-        try:
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=image_file_id, caption=caption),
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
-        except:
-            await callback.message.edit_caption(
-                caption=caption,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
-    else:
-        await callback.message.edit_caption(
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-        )
+    await render_screen(
+        callback.message,
+        caption,
+        InlineKeyboardMarkup(inline_keyboard=keyboard),
+        photo=image_file_id or None
+    )
     await callback.answer()
 
 
@@ -269,7 +260,7 @@ async def process_sbp_email(message: Message, state: FSMContext):
         return
 
     # Устанавливаем статус "ожидает оплаты"
-    await update_order_payment_status(order_id, "pending_payment")
+    await update_order_payment_status(order_id, "pending_payment", "bot_purchase")
 
     # Создаём ссылку на оплату через wata.pro
     try:
@@ -1,6 +1,7 @@
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, FSInputFile, InputMediaPhoto
+from aiogram.types import CallbackQuery
 from keyboards import get_back_to_menu, get_product_categories
+from message_render import render_screen
 from pathlib import Path
 
 router = Router()
@@ -14,28 +15,14 @@ MAIN_IMAGE_PATH = BASE_DIR / "main.png"
 async def show_shop(callback: CallbackQuery):
     """Показать магазин"""
     try:
-        # Пытаемся вернуть главное изображение
-        if MAIN_IMAGE_PATH.exists():
-            photo = FSInputFile(str(MAIN_IMAGE_PATH))
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=photo, caption="Выберите категорию 👇"),
-                reply_markup=get_product_categories()
-            )
-        else:
-            # Если файла нет, просто меняем caption
-            await callback.message.edit_caption(
-                caption="Выберите категорию 👇",
-                reply_markup=get_product_categories()
-            )
+        # Возвращаем главное изображение (если его нет — меняем только текст)
+        await render_screen(
+            callback.message,
+            "Выберите категорию 👇",
+            get_product_categories(),
+            photo=MAIN_IMAGE_PATH if MAIN_IMAGE_PATH.exists() else None
+        )
     except Exception as e:
-        # Если не получилось, пытаемся изменить текст
-        try:
-            await callback.message.edit_text(
-                text="Выберите категорию 👇",
-                reply_markup=get_product_categories()
-            )
-        except Exception:
-            # Если и это не помогло, логируем ошибку
-            print(f"Error in show_shop: {e}")
+        print(f"Error in show_shop: {e}")
 
     await callback.answer()
@@ -1,11 +1,16 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from functools import lru_cache
 import os
 from config import REVIEWS_CHANNEL
 
 # URL Mini App из переменной окружения или ngrok
 MINIAPP_URL = os.getenv("WEBHOOK_BASE_URL", "https://YOUR-DOMAIN.ru")
 
+# Клавиатуры без параметров не меняются — строим один раз на процесс.
+# Возвращается общий объект, изменять его нельзя.
 
+
+@lru_cache(maxsize=None)
 def get_main_menu() -> InlineKeyboardMarkup:
     """Главное меню бота"""
     keyboard = [
@@ -22,6 +27,7 @@ def get_main_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@lru_cache(maxsize=None)
 def get_back_to_menu() -> InlineKeyboardMarkup:
     """Кнопка возврата в главное меню"""
     keyboard = [
@@ -30,6 +36,7 @@ def get_back_to_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@lru_cache(maxsize=None)
 def get_product_categories() -> InlineKeyboardMarkup:
     """Категории товаров"""
     keyboard = [
@@ -45,6 +52,7 @@ def get_product_categories() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@lru_cache(maxsize=None)
 def get_profile_menu() -> InlineKeyboardMarkup:
     """Меню профиля"""
     keyboard = [
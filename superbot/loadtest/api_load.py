@@ -0,0 +1,508 @@
+"""
+Нагрузочный тест API Mini App
+=============================
+
+Смешанная нагрузка на miniapp/api.py с подписанным initData:
+
+    products     GET  /api/products?game=&subcategory=
+    search       GET  /api/search?q=
+    user         GET  /api/user/{id}
+    user_orders  GET  /api/user/{id}/orders
+    avatar       GET  /api/user/{id}/avatar
+    purchase     POST /api/purchase (X-Telegram-Init-Data, Idempotency-Key)
+    webhook      POST /webhook/wata (оплата/отказ по ожидающим заказам)
+
+Пользователи, товары и ожидающие оплаты заказы берутся из базы,
+заполненной loadtest/seed_data.py.
+
+По умолчанию API запускается здесь же, как в production (gunicorn +
+UvicornWorker), на этой базе и с фейковым Telegram (loadtest/fake_telegram.py)
+для аватарок и уведомлений. Лимиты API на IP поднимаются: вся нагрузка
+идёт с одного адреса. С --url тест идёт на уже запущенный API (для
+webhook он должен работать с PRODUCTION=false — подпись wata здесь не
+подделать).
+
+    python loadtest/api_load.py --db /tmp/load.db --duration 60 --concurrency 64 --json after.json
+    python loadtest/api_load.py --db /tmp/load.db --rate 500 --baseline before.json
+
+--rate задаёт постоянную частоту запросов (открытая модель): задержка
+считается от запланированного момента, поэтому очередь перед перегруженным
+API попадает в перцентили. Без --rate каждый из --concurrency клиентов
+шлёт следующий запрос сразу после ответа.
+
+Отчёт (--json) — по маршрутам: запросы, rps, ошибки, коды ответа,
+p50/p95/p99/max в мс. С --baseline отчёт сравнивается с прошлым прогоном;
+код выхода 1 при росте p95 больше --tolerance или росте доли ошибок.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import urlencode
+
+import httpx
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from loadtest.fake_telegram import FakeTelegram  # noqa: E402
+
+BOT_TOKEN = "123456:AAFakeTokenForLoadTestingOnly000000"
+
+DEFAULT_MIX = {
+    "products": 30,
+    "search": 20,
+    "user_orders": 20,
+    "avatar": 15,
+    "user": 5,
+    "purchase": 5,
+    "webhook": 5,
+}
+SEARCH_QUERIES = (
+    "гем", "гемов", "эволюция", "пропуск", "набор", "акция", "brawl", "pass",
+    "royale", "карта", "эмодзи", "рыцар", "мега", "золотой", "xx",
+)
+# Сколько пользователей и заказов брать из базы
+SAMPLE_USERS = 20000
+SAMPLE_HEAVY_USERS = 200
+SAMPLE_PENDING_ORDERS = 50000
+# Доля запросов к пользователям с большой историей заказов
+HEAVY_USER_SHARE = 0.3
+
+# Разница p95 меньше этого порога (мс) — шум, а не регрессия
+REGRESSION_NOISE_MS = 5
+
+
+def sign_init_data(bot_token: str, user_id: int) -> str:
+    """initData, как её подписывает Telegram для Web App"""
+    user = json.dumps(
+        {"id": user_id, "first_name": "Load", "username": f"load{user_id}", "language_code": "ru"},
+        separators=(",", ":"), ensure_ascii=False
+    )
+    fields = {"auth_date": str(int(time.time())), "query_id": f"AAload{user_id}", "user": user}
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def load_dataset(db_path: str) -> dict:
+    """Пользователи, товары и ожидающие оплаты заказы для запросов"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        users = [row[0] for row in conn.execute(
+            "SELECT user_id FROM users ORDER BY RANDOM() LIMIT ?", (SAMPLE_USERS,)
+        )]
+        heavy_users = [row[0] for row in conn.execute(
+            "SELECT user_id FROM orders GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT ?", (SAMPLE_HEAVY_USERS,)
+        )]
+        products = conn.execute("SELECT id, game, subcategory FROM products WHERE in_stock = 1").fetchall()
+        pending_orders = [row[0] for row in conn.execute(
+            "SELECT id FROM orders WHERE status IN ('pending', 'pending_payment') ORDER BY RANDOM() LIMIT ?",
+            (SAMPLE_PENDING_ORDERS,)
+        )]
+    finally:
+        conn.close()
+    if not users or not products:
+        sys.exit(f"{db_path}: нет пользователей или товаров, сначала запустите loadtest/seed_data.py")
+    return {"users": users, "heavy_users": heavy_users or users, "products": products, "pending_orders": pending_orders}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(values[-1] * 1000, 2),
+    }
+
+
+# ============================================
+# ГЕНЕРАТОР НАГРУЗКИ
+# ============================================
+
+class ApiLoad:
+    """Построение запросов и учёт ответов"""
+
+    def __init__(self, client: httpx.AsyncClient, dataset: dict, mix: dict, bot_token: str, seed: int = None):
+        self.client = client
+        self.dataset = dataset
+        self.routes = list(mix)
+        self.weights = list(mix.values())
+        self.bot_token = bot_token
+        self._random = random.Random(seed)
+        self._init_data = {}
+        # Заказы для webhook: созданные в этом прогоне, затем ожидающие из базы
+        self._created_orders = []
+        self._pending_orders = list(dataset["pending_orders"])
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.skipped = defaultdict(int)
+
+    def _user(self) -> int:
+        if self._random.random() < HEAVY_USER_SHARE:
+            return self._random.choice(self.dataset["heavy_users"])
+        return self._random.choice(self.dataset["users"])
+
+    def _auth(self, user_id: int) -> str:
+        init_data = self._init_data.get(user_id)
+        if init_data is None:
+            init_data = self._init_data[user_id] = sign_init_data(self.bot_token, user_id)
+        return init_data
+
+    def build(self, route: str):
+        """(method, url, параметры httpx) для маршрута; None — запрос сделать нельзя"""
+        if route == "products":
+            if self._random.random() < 0.3:
+                return "GET", "/api/products", {}
+            _, game, subcategory = self._random.choice(self.dataset["products"])
+            params = {"game": game}
+            if self._random.random() < 0.5:
+                params["subcategory"] = subcategory
+            return "GET", "/api/products", {"params": params}
+
+        if route == "search":
+            params = {"q": self._random.choice(SEARCH_QUERIES)}
+            if self._random.random() < 0.3:
+                params["game"] = self._random.choice(self.dataset["products"])[1]
+            return "GET", "/api/search", {"params": params}
+
+        if route == "user":
+            return "GET", f"/api/user/{self._user()}", {}
+
+        if route == "user_orders":
+            return "GET", f"/api/user/{self._user()}/orders", {"params": {"limit": 20}}
+
+        if route == "avatar":
+            return "GET", f"/api/user/{self._user()}/avatar", {}
+
+        if route == "purchase":
+            user_id = self._random.choice(self.dataset["users"])
+            product_id = self._random.choice(self.dataset["products"])[0]
+            return "POST", "/api/purchase", {
+                "json": {"user_id": user_id, "product_id": product_id, "supercell_id": f"load{user_id}@example.com"},
+                "headers": {"X-Telegram-Init-Data": self._auth(user_id), "Idempotency-Key": uuid.uuid4().hex},
+            }
+
+        if route == "webhook":
+            orders = self._created_orders or self._pending_orders
+            if not orders:
+                return None
+            order_id = orders.pop()
+            paid = self._random.random() < 0.85
+            return "POST", "/webhook/wata", {"json": {
+                "transactionId": str(uuid.uuid4()),
+                "transactionStatus": "Paid" if paid else "Declined",
+                "orderId": f"order_{order_id}",
+                "amount": 100,
+            }}
+
+        raise ValueError(f"Unknown route {route}")
+
+    async def request(self, route: str, scheduled: float):
+        built = self.build(route)
+        if built is None:
+            self.skipped[route] += 1
+            return
+        method, url, kwargs = built
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+            response = None
+        self.latencies[route].append(time.monotonic() - scheduled)
+        self.statuses[route][status] += 1
+
+        if route == "purchase" and response is not None and status == 200:
+            order_id = response.json().get("order_id")
+            if order_id:
+                self._created_orders.append(order_id)
+
+    async def run(self, duration: float, concurrency: int, rate: float = None) -> float:
+        started = time.monotonic()
+        deadline = started + duration
+        next_slot = 0
+
+        async def worker():
+            nonlocal next_slot
+            while True:
+                if rate:
+                    # Открытая модель: запрос по расписанию, задержка — от него
+                    scheduled = started + next_slot / rate
+                    next_slot += 1
+                    if scheduled >= deadline:
+                        return
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    scheduled = time.monotonic()
+                    if scheduled >= deadline:
+                        return
+                route = self._random.choices(self.routes, self.weights)[0]
+                await self.request(route, scheduled)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.monotonic() - started
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        all_latencies = []
+        total_errors = 0
+        for route in self.routes:
+            latencies = self.latencies.get(route, [])
+            statuses = self.statuses.get(route, {})
+            errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400))
+            total_errors += errors
+            all_latencies.extend(latencies)
+            routes[route] = {
+                "requests": len(latencies),
+                "rps": round(len(latencies) / elapsed, 2),
+                "errors": errors,
+                "error_rate": round(errors / len(latencies), 4) if latencies else 0,
+                "status_codes": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+                "skipped": self.skipped.get(route, 0),
+                "latency_ms": percentiles(latencies),
+            }
+        return {
+            "total": {
+                "requests": len(all_latencies),
+                "rps": round(len(all_latencies) / elapsed, 2),
+                "errors": total_errors,
+                "error_rate": round(total_errors / len(all_latencies), 4) if all_latencies else 0,
+                "latency_ms": percentiles(all_latencies),
+            },
+            "routes": routes,
+        }
+
+
+# ============================================
+# СРАВНЕНИЕ С BASELINE
+# ============================================
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Печатает разницу с прошлым прогоном, возвращает список регрессий"""
+    regressions = []
+    print(f"\n{'маршрут':<13}{'rps':>16}{'p95, мс':>22}{'ошибки':>18}")
+    for route, current in {"total": report["total"], **report["routes"]}.items():
+        previous = baseline["total"] if route == "total" else baseline.get("routes", {}).get(route)
+        if not previous or not current["requests"] or not previous.get("requests"):
+            continue
+        p95, old_p95 = current["latency_ms"]["p95"], previous["latency_ms"]["p95"]
+        change = (p95 - old_p95) / old_p95 if old_p95 else 0
+        print(f"{route:<13}{previous['rps']:>7} → {current['rps']:<7}"
+              f"{old_p95:>9} → {p95:<9}({change:+.0%})"
+              f"{previous['error_rate']:>7.2%} → {current['error_rate']:.2%}")
+        if change > tolerance and p95 - old_p95 > REGRESSION_NOISE_MS:
+            regressions.append(f"{route}: p95 {old_p95} → {p95} мс ({change:+.0%})")
+        if current["error_rate"] > previous["error_rate"] + 0.01:
+            regressions.append(f"{route}: ошибки {previous['error_rate']:.2%} → {current['error_rate']:.2%}")
+    return regressions
+
+
+# ============================================
+# ЗАПУСК
+# ============================================
+
+async def wait_for_api(client: httpx.AsyncClient, process, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode}")
+        try:
+            response = await client.get("/api/products")
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("API did not become ready")
+
+
+def start_api(args, workdir: str) -> subprocess.Popen:
+    """API как в production: gunicorn + UvicornWorker"""
+    env = {
+        **os.environ,
+        "DB_NAME": os.path.abspath(args.db),
+        "BOT_TOKEN": args.bot_token,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "PRODUCTION": "true" if args.production else "false",
+        # Вся нагрузка идёт с одного IP
+        "RATE_LIMIT_PER_MINUTE": str(10 ** 9),
+        "RATE_LIMIT_BURST": str(10 ** 9),
+        "RATE_LIMIT_SHARED_PATH": os.path.join(workdir, "ratelimit"),
+        "MEDIA_CACHE_DIR": os.path.join(workdir, "media"),
+        "API_METRICS_DIR": os.path.join(workdir, "metrics"),
+        "PREFETCH_PRODUCT_IMAGES": "false",
+        "PAYMENT_CHECKER_MODE": "off",
+        "ENABLE_PAYMENT_CHECKER": "false",
+    }
+    log = open(os.path.join(workdir, "api.log"), "wb")
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "api:app", "-w", str(args.workers),
+         "-k", "uvicorn.workers.UvicornWorker", "-b", f"127.0.0.1:{args.port}"],
+        cwd=os.path.join(BOT_DIR, "miniapp"), env=env, stdout=log, stderr=log
+    )
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        route, _, weight = part.partition("=")
+        if route.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r}, expected one of {', '.join(DEFAULT_MIX)}")
+        mix[route.strip()] = float(weight or 1)
+    return mix
+
+
+async def run(args) -> dict:
+    dataset = load_dataset(args.db)
+    mix = args.mix or dict(DEFAULT_MIX)
+    if args.production and not args.url:
+        # Подпись wata.pro не подделать, а в production без неё webhook отклоняется
+        mix.pop("webhook", None)
+
+    workdir = tempfile.mkdtemp(prefix="api-load-")
+    process = None
+    fake_runner = None
+    base_url = args.url
+    if not base_url:
+        fake_telegram = FakeTelegram(latency=args.telegram_latency, seed=args.seed)
+        fake_runner = await fake_telegram.start("127.0.0.1", args.telegram_port)
+        process = start_api(args, workdir)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            await wait_for_api(client, process)
+            load = ApiLoad(client, dataset, mix, args.bot_token, seed=args.seed)
+            if args.warmup:
+                await load.run(args.warmup, args.concurrency, args.rate)
+                load = ApiLoad(client, dataset, mix, args.bot_token, seed=args.seed)
+            elapsed = await load.run(args.duration, args.concurrency, args.rate)
+            if process is not None:
+                # Метрики сервера за прогон (сумма по worker'ам) — рядом с логом API
+                response = await client.get("/metrics")
+                with open(os.path.join(workdir, "metrics.txt"), "wb") as f:
+                    f.write(response.content)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if fake_runner is not None:
+            await fake_runner.cleanup()
+
+    return {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "url": base_url,
+            "db": os.path.abspath(args.db),
+            "duration": args.duration,
+            "elapsed": round(elapsed, 2),
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "workers": None if args.url else args.workers,
+            "mix": mix,
+            "api_log": None if args.url else os.path.join(workdir, "api.log"),
+            "api_metrics": None if args.url else os.path.join(workdir, "metrics.txt"),
+        },
+        **load.report(elapsed),
+    }
+
+
+def print_report(report: dict):
+    meta = report["meta"]
+    print(f"\n{meta['url']}: {meta['elapsed']} с, concurrency={meta['concurrency']}, rate={meta['rate'] or '-'}")
+    print(f"{'маршрут':<13}{'запросов':>10}{'rps':>9}{'ошибок':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (мс)")
+    for route, stats in {"total": report["total"], **report["routes"]}.items():
+        latency = stats["latency_ms"]
+        if not stats["requests"]:
+            continue
+        print(f"{route:<13}{stats['requests']:>10}{stats['rps']:>9}{stats['errors']:>8}"
+              f"{latency['p50']:>9}{latency['p95']:>9}{latency['p99']:>9}{latency['max']:>9}")
+    for route, stats in report["routes"].items():
+        bad = {code: count for code, count in stats["status_codes"].items() if not code.startswith(("2", "3"))}
+        if bad:
+            print(f"  {route}: {bad}")
+    if meta["api_log"]:
+        print(f"Лог API: {meta['api_log']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API Mini App")
+    parser.add_argument("--db", default=None, help="база, заполненная seed_data.py (по умолчанию DB_NAME)")
+    parser.add_argument("--url", help="уже запущенный API (иначе запускается gunicorn на --port)")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=4, help="worker'ов gunicorn")
+    parser.add_argument("--production", action="store_true", help="запустить API с PRODUCTION=true (без webhook)")
+    parser.add_argument("--telegram-port", type=int, default=8091)
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="задержка фейкового Telegram, с")
+    parser.add_argument("--bot-token", default=None, help="токен для подписи initData (по умолчанию фейковый)")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5, help="прогрев перед замером, с")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=None, help="запросов в секунду (открытая модель)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--mix", type=parse_mix, default=None, help="веса маршрутов: products=30,search=20,...")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="записать отчёт в файл")
+    parser.add_argument("--baseline", help="отчёт прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95 (доля)")
+    args = parser.parse_args()
+
+    if args.db is None:
+        from config import DB_NAME
+        args.db = DB_NAME
+    if args.bot_token is None:
+        if args.url:
+            from config import BOT_TOKEN as configured_token
+            args.bot_token = configured_token or BOT_TOKEN
+        else:
+            args.bot_token = BOT_TOKEN
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("\nРегрессии:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nРегрессий нет")
+
+
+if __name__ == "__main__":
+    main()
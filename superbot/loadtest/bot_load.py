@@ -0,0 +1,405 @@
+"""
+Нагрузочный прогон бота против фейкового Bot API
+================================================
+
+Запускает main.py (polling) на временной базе против loadtest/fake_telegram.py
+и проигрывает синтетические сессии пользователей:
+
+- start     — /start, в половине случаев с реферальным кодом
+- browse    — /start и случайные переходы по каталогу, профилю, поддержке
+- purchase  — /start, каталог, товар, покупка с баланса
+- admin     — /admin и переходы по разделам админ-панели (без изменений данных)
+
+Каждый виртуальный пользователь нажимает только кнопки текущего экрана
+(последнего сообщения бота с callback-кнопками) и ждёт ответа перед
+следующим шагом, как живой пользователь. Ответом на шаг считается первый
+вызов Bot API бота в этот чат.
+
+Результат: обработанные обновления в секунду и перцентили времени ответа
+по типам шагов, вызовы Bot API, таймауты, отказы throttling.
+
+Пример:
+    python loadtest/bot_load.py --users 200 --duration 60 --latency 0.05 --json report.json
+
+Время ответа включает задержку фейкового API (--latency): при сравнении
+изменений бота запускайте прогоны с одинаковыми параметрами.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from loadtest.fake_telegram import FakeTelegram  # noqa: E402
+
+# aiogram при импорте ставит политику uvloop (если он установлен); импорт
+# внутри уже запущенного цикла ломает asyncio.create_subprocess_exec
+import aiogram  # noqa: E402,F401
+
+BOT_ID = 123456
+BOT_TOKEN = f"{BOT_ID}:AAFakeTokenForLoadTestingOnly000000"
+# Диапазоны id синтетических пользователей
+USER_ID_BASE = 7_000_000_000
+ADMIN_ID_BASE = 6_000_000_000
+
+REFERRAL_CODES = ("loadtest_a", "loadtest_b", "loadtest_c")
+PRODUCTS_PER_CATEGORY = 3
+USER_BALANCE = 10_000_000
+
+SCENARIO_WEIGHTS = {"start": 1, "browse": 5, "purchase": 2}
+
+# Кнопки, которые нажимают сценарии (по префиксу callback_data)
+BROWSE_BUTTONS = (
+    "shop", "category_", "brawlstars_", "clashroyale_", "clashofclans_",
+    "buy_product_", "profile", "support", "main_menu",
+)
+# Покупка: нажимается самая «дальняя» по воронке кнопка экрана
+PURCHASE_FUNNEL = (
+    ("pay_balance_",),
+    ("confirm_buy_",),
+    ("buy_product_",),
+    ("brawlstars_", "clashroyale_", "clashofclans_"),
+    ("category_",),
+    ("shop",),
+)
+# Только просмотр: кнопки удаления, рассылки и подтверждения заказов не нажимаются
+ADMIN_BUTTONS = (
+    "admin_panel", "admin_products", "admin_orders", "admin_users", "admin_stats",
+    "admin_tracking", "manageprod_", "managesubcat_", "orders_", "vieword_", "editprod_",
+)
+
+STEP_TIMEOUT = 10
+THROTTLE_MARKER = "слишком"
+
+
+# ============================================
+# ПОДГОТОВКА
+# ============================================
+
+async def seed_database(users: list, admins: list):
+    """Товары, реферальные ссылки и пользователи с балансом во временной базе"""
+    # DB_NAME уже указан в окружении — импортируем после этого
+    from database import (
+        init_db, close_db_pool, add_product, create_referral_link, get_or_create_user, set_user_balance
+    )
+    from handlers.categories import CATEGORIES
+
+    await init_db()
+    for game, info in CATEGORIES.items():
+        for category in info["categories"]:
+            for i in range(PRODUCTS_PER_CATEGORY):
+                await add_product(
+                    f"{info['name']} {category['name']} #{i + 1}",
+                    "Товар для нагрузочного теста",
+                    100 + 50 * i, game, category["id"]
+                )
+    for code in REFERRAL_CODES:
+        await create_referral_link(code, f"Load test {code}")
+    for user_id in users + admins:
+        await get_or_create_user(user_id, f"load{user_id}", f"Load {user_id}")
+        await set_user_balance(user_id, USER_BALANCE)
+
+    await close_db_pool()
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1)
+
+    return {
+        "count": len(values),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(values[-1] * 1000, 1),
+    }
+
+
+# ============================================
+# ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ
+# ============================================
+
+class LoadRun:
+    """Сессии пользователей и учёт ответов бота"""
+
+    def __init__(self, server: FakeTelegram, think_time: float, seed: int = None):
+        self.server = server
+        self.think_time = think_time
+        self._random = random.Random(seed)
+        self._pending = {}  # chat_id -> (future, отправлено в)
+        self._message_ids = defaultdict(int)
+        self._callback_ids = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.stats = {"sent": 0, "answered": 0, "timeouts": 0, "throttled": 0, "dead_ends": 0}
+        server.listeners.append(self._on_api_call)
+
+    def _on_api_call(self, method: str, params: dict, result):
+        if method == "answerCallbackQuery":
+            chat_id = int(str(params.get("callback_query_id", "0")).split("-")[0])
+            if THROTTLE_MARKER in str(params.get("text") or "").lower():
+                self.stats["throttled"] += 1
+        elif "chat_id" in params:
+            chat_id = int(params["chat_id"])
+            if THROTTLE_MARKER in str(params.get("text") or "").lower():
+                self.stats["throttled"] += 1
+        else:
+            return
+        pending = self._pending.pop(chat_id, None)
+        if pending is not None and not pending.done():
+            pending.set_result(time.monotonic())
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Load {user_id}", "username": f"load{user_id}"}
+
+    async def _send(self, user_id: int, kind: str, update: dict) -> bool:
+        """Отправить обновление и дождаться ответа бота"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending[user_id] = future
+        sent_at = time.monotonic()
+        self.stats["sent"] += 1
+        await self.server.feed(update)
+        try:
+            answered_at = await asyncio.wait_for(future, STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._pending.pop(user_id, None)
+            self.stats["timeouts"] += 1
+            return False
+        self.stats["answered"] += 1
+        self.latencies[kind].append(answered_at - sent_at)
+        return True
+
+    async def command(self, user_id: int, text: str, kind: str) -> bool:
+        self._message_ids[user_id] += 1
+        command = text.split()[0]
+        return await self._send(user_id, kind, {"message": {
+            "message_id": self._message_ids[user_id],
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Load {user_id}"},
+            "from": self._user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }})
+
+    def _pick_button(self, user_id: int, groups) -> str:
+        """callback_data кнопки текущего экрана из первой непустой группы префиксов"""
+        screen = self.server.screens.get(user_id)
+        if not screen:
+            return None
+        buttons = [
+            button["callback_data"]
+            for row in screen["reply_markup"]["inline_keyboard"] for button in row
+            if "callback_data" in button
+        ]
+        for prefixes in groups:
+            matches = [data for data in buttons if data.startswith(prefixes)]
+            if matches:
+                return self._random.choice(matches)
+        return None
+
+    async def click(self, user_id: int, groups, kind: str) -> bool:
+        data = self._pick_button(user_id, groups)
+        if data is None:
+            self.stats["dead_ends"] += 1
+            return False
+        self._callback_ids[user_id] += 1
+        return await self._send(user_id, kind, {"callback_query": {
+            "id": f"{user_id}-{self._callback_ids[user_id]}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": self.server.screens[user_id],
+            "data": data,
+        }})
+
+    async def think(self):
+        await asyncio.sleep(self._random.expovariate(1 / self.think_time) if self.think_time else 0)
+
+    # ===== СЦЕНАРИИ =====
+
+    async def scenario_start(self, user_id: int):
+        text = "/start"
+        if self._random.random() < 0.5:
+            text += f" {self._random.choice(REFERRAL_CODES)}"
+        await self.command(user_id, text, "start")
+
+    async def scenario_browse(self, user_id: int):
+        if not await self.command(user_id, "/start", "start"):
+            return
+        for _ in range(self._random.randint(3, 8)):
+            await self.think()
+            if not await self.click(user_id, (BROWSE_BUTTONS,), "browse"):
+                return
+
+    async def scenario_purchase(self, user_id: int):
+        if not await self.command(user_id, "/start", "start"):
+            return
+        await self.think()
+        # С главного меню — в каталог
+        if not await self.click(user_id, (("shop",),), "purchase"):
+            return
+        for _ in range(len(PURCHASE_FUNNEL)):
+            await self.think()
+            paying = self._pick_button(user_id, PURCHASE_FUNNEL[:1])
+            if not await self.click(user_id, PURCHASE_FUNNEL, "purchase"):
+                return
+            if paying is not None:
+                # Нажали «оплатить с баланса» — покупка завершена
+                return
+
+    async def scenario_admin(self, user_id: int):
+        if not await self.command(user_id, "/admin", "admin"):
+            return
+        for _ in range(self._random.randint(3, 8)):
+            await self.think()
+            if not await self.click(user_id, (ADMIN_BUTTONS,), "admin"):
+                return
+
+    async def run_user(self, user_id: int, deadline: float, is_admin: bool = False):
+        scenarios = list(SCENARIO_WEIGHTS)
+        weights = list(SCENARIO_WEIGHTS.values())
+        # Пользователи стартуют не одновременно
+        await asyncio.sleep(self._random.uniform(0, self.think_time or 0.1))
+        while time.monotonic() < deadline:
+            if is_admin:
+                await self.scenario_admin(user_id)
+            else:
+                scenario = self._random.choices(scenarios, weights)[0]
+                await getattr(self, f"scenario_{scenario}")(user_id)
+            await self.think()
+
+
+# ============================================
+# ЗАПУСК
+# ============================================
+
+async def wait_process(process, timeout: float) -> int:
+    try:
+        return await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        return await process.wait()
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bot-load-")
+    db_path = os.path.join(workdir, "shop_bot.db")
+    users = [USER_ID_BASE + i for i in range(args.users)]
+    admins = [ADMIN_ID_BASE + i for i in range(args.admins)]
+
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port}",
+        "DB_NAME": db_path,
+        "ADMIN_IDS": ",".join(map(str, admins)),
+        "BOT_MODE": "polling",
+        "LOG_LEVEL": args.bot_log_level,
+        "BOT_LOG_TO_FILE": "false",
+        "ENABLE_PAYMENT_CHECKER": "false",
+        # По умолчанию не занимаем порт метрик работающего рядом бота
+        "BOT_METRICS_PORT": str(args.metrics_port),
+    }
+    os.environ["DB_NAME"] = db_path
+    await seed_database(users, admins)
+
+    server = FakeTelegram(args.latency, args.jitter, args.error_rate, args.retry_after, seed=args.seed)
+    runner = await server.start("127.0.0.1", args.port, BOT_ID)
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "wb") as log_file:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "main.py", cwd=BOT_DIR, env=env, stdout=log_file, stderr=log_file
+        )
+        try:
+            await asyncio.wait_for(server.polling_started.wait(), 60)
+        except asyncio.TimeoutError:
+            process.kill()
+            await runner.cleanup()
+            raise RuntimeError(f"Bot did not start polling, see {log_path}")
+
+        load = LoadRun(server, args.think_time, seed=args.seed)
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(
+            *(load.run_user(user_id, deadline) for user_id in users),
+            *(load.run_user(admin_id, deadline, is_admin=True) for admin_id in admins),
+        )
+        elapsed = time.monotonic() - started
+
+        # SIGINT — штатная остановка aiogram (дожидается очередей чатов)
+        process.send_signal(signal.SIGINT)
+        exit_code = await wait_process(process, 30)
+    await runner.cleanup()
+
+    all_latencies = [value for values in load.latencies.values() for value in values]
+    return {
+        "config": {
+            "users": args.users, "admins": args.admins, "duration": args.duration,
+            "think_time": args.think_time, "latency": args.latency, "jitter": args.jitter,
+            "error_rate": args.error_rate,
+        },
+        "elapsed": round(elapsed, 2),
+        **load.stats,
+        "updates_per_second": round(load.stats["answered"] / elapsed, 1) if elapsed else 0,
+        "latency_ms": {
+            "all": percentiles(all_latencies),
+            **{kind: percentiles(values) for kind, values in sorted(load.latencies.items())},
+        },
+        "telegram_api": server.get_stats(),
+        "bot_exit_code": exit_code,
+        "bot_log": log_path,
+    }
+
+
+def print_report(report: dict):
+    print(f"\nОбновлений: {report['sent']}, с ответом: {report['answered']}, "
+          f"таймаутов: {report['timeouts']}, throttling: {report['throttled']}")
+    print(f"Пропускная способность: {report['updates_per_second']} обновлений/с за {report['elapsed']} с")
+    print(f"\n{'шаг':<10}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  (мс)")
+    for kind, stats in report["latency_ms"].items():
+        if stats["count"]:
+            print(f"{kind:<10}{stats['count']:>8}{stats['p50']:>10}{stats['p90']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    calls = ", ".join(f"{method}={count}" for method, count in sorted(report["telegram_api"]["calls"].items()))
+    print(f"\nBot API: {calls}")
+    print(f"429 injected: {report['telegram_api']['injected_429']}, errors: {report['telegram_api']['errors']}")
+    print(f"Бот завершился с кодом {report['bot_exit_code']}, лог: {report['bot_log']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument("--users", type=int, default=50, help="виртуальных покупателей")
+    parser.add_argument("--admins", type=int, default=1, help="виртуальных администраторов")
+    parser.add_argument("--duration", type=float, default=30, help="длительность, секунды")
+    parser.add_argument("--think-time", type=float, default=1.5, help="средняя пауза между шагами, секунды")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка фейкового Bot API, секунды")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--metrics-port", type=int, default=0, help="порт /metrics бота во время прогона (0 — выключен)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--bot-log-level", default="WARNING")
+    parser.add_argument("--json", help="записать отчёт в файл")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+"""
+Микробенчмарки database.py
+==========================
+
+Замеряет функции database.py на базах разного размера (по умолчанию 1 тыс.,
+100 тыс. и 1 млн заказов, данные — loadtest/seed_data.py) и показывает,
+как время вызова растёт с объёмом данных. Затем на самой большой базе —
+N одновременных вызовов: пропускная способность, задержки, повторы после
+"database is locked" / конфликтов uid и ожидание соединения из пула
+(счётчики get_db_stats()).
+
+    python loadtest/db_bench.py                        # сравнение с db_bench_baseline.json
+    python loadtest/db_bench.py --sizes 1000,100000 --only get_stats_revenue
+    python loadtest/db_bench.py --save-baseline        # обновить baseline после оптимизации
+
+Сгенерированные базы кэшируются в --cache-dir; каждый прогон идёт на
+копии, поэтому пишущие функции не меняют данные следующих прогонов.
+
+Код выхода 1, если медиана какого-либо замера выросла относительно
+baseline больше чем на --tolerance (и больше чем на REGRESSION_NOISE_MS).
+Baseline снят на одной машине: после переезда на другое железо его
+нужно переснять (--save-baseline) до изменений.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_bench_baseline.json")
+DEFAULT_SIZES = (1000, 100_000, 1_000_000)
+DEFAULT_CONCURRENCY = (1, 8, 32)
+DEFAULT_CACHE_DIR = os.path.join("/tmp", "supercell-db-bench")
+
+# Пропорции данных на один заказ (как в seed_data.py по умолчанию)
+USERS_PER_ORDER = 0.25
+VISITS_PER_ORDER = 0.15
+SEED = 42
+
+# Пользователи с балансом для purchase_with_balance
+BUYERS = 2000
+BUYER_BALANCE = 10 ** 9
+
+# Разница медиан меньше этого порога (мс) — шум, а не регрессия
+REGRESSION_NOISE_MS = 2.0
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    return {
+        "runs": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "median_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+# ============================================
+# ПОДГОТОВКА БАЗ
+# ============================================
+
+def prepare_database(size: int, cache_dir: str) -> str:
+    """Сгенерированная база на size заказов (из кэша или через seed_data.py)"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"orders-{size}-seed{SEED}.db")
+    if os.path.exists(path):
+        return path
+    tmp_path = path + ".tmp"
+    for leftover in (tmp_path, tmp_path + "-wal", tmp_path + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    print(f"Генерация базы на {size} заказов...")
+    subprocess.run([
+        sys.executable, os.path.join(BOT_DIR, "loadtest", "seed_data.py"),
+        "--db", tmp_path,
+        "--orders", str(size),
+        "--users", str(max(int(size * USERS_PER_ORDER), 100)),
+        "--visits", str(max(int(size * VISITS_PER_ORDER), 100)),
+        "--seed", str(SEED),
+    ], check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def working_copy(source: str, cache_dir: str) -> str:
+    """Копия базы для одного прогона"""
+    path = os.path.join(cache_dir, "work.db")
+    for leftover in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    shutil.copyfile(source, path)
+    return path
+
+
+def load_inputs(path: str) -> dict:
+    """Аргументы вызовов: существующие пользователи, ожидающие заказы, покупатели"""
+    rng = random.Random(SEED)
+    conn = sqlite3.connect(path)
+    try:
+        users = [row[0] for row in conn.execute("SELECT user_id FROM users")]
+        codes = [row[0] for row in conn.execute("SELECT code FROM referral_links")]
+        pending = [row[0] for row in conn.execute(
+            "SELECT id FROM orders WHERE status IN ('pending', 'pending_payment')"
+        )]
+        product_id = conn.execute(
+            "SELECT id FROM products WHERE in_stock = 1 ORDER BY price LIMIT 1"
+        ).fetchone()[0]
+        buyers = rng.sample(users, min(BUYERS, len(users)))
+        # Баланса хватает на любое число покупок: замеряется успешная покупка
+        conn.executemany("UPDATE users SET balance = ? WHERE user_id = ?", [(BUYER_BALANCE, b) for b in buyers])
+        conn.commit()
+    finally:
+        conn.close()
+    rng.shuffle(pending)
+    return {"users": users, "codes": codes, "pending": pending, "product_id": product_id, "buyers": buyers}
+
+
+# ============================================
+# ЗАМЕРЯЕМЫЕ ВЫЗОВЫ
+# ============================================
+
+def build_cases(database, inputs: dict) -> dict:
+    """
+    Имя замера -> фабрика вызовов. Фабрика возвращает корутину очередного
+    вызова или None, если входные данные кончились (ожидающие заказы).
+    """
+    rng = random.Random(SEED)
+    new_user_ids = iter(range(10 ** 12, 10 ** 13))
+    pending = inputs["pending"]
+
+    def update_payment():
+        if not pending:
+            return None
+        return database.update_order_payment_status(pending.pop(), "paid", source="bench")
+
+    return {
+        "get_or_create_user[existing]": lambda: database.get_or_create_user(
+            rng.choice(inputs["users"]), "bench", "Bench"
+        ),
+        "get_or_create_user[new]": lambda: database.get_or_create_user(next(new_user_ids), "bench", "Bench"),
+        "get_stats_revenue[all]": lambda: database.get_stats_revenue("all"),
+        "get_stats_revenue[7days]": lambda: database.get_stats_revenue("7days"),
+        "get_referral_stats": lambda: database.get_referral_stats(rng.choice(inputs["codes"])),
+        "get_pending_orders": lambda: database.get_pending_orders(),
+        "update_order_payment_status": update_payment,
+        "purchase_with_balance": lambda: database.purchase_with_balance(
+            rng.choice(inputs["buyers"]), inputs["product_id"]
+        ),
+    }
+
+
+async def call_loop(factory, deadline: float, max_runs: int, latencies: list, errors: list):
+    while len(latencies) < max_runs and time.monotonic() < deadline:
+        coro = factory()
+        if coro is None:
+            return
+        started = time.monotonic()
+        try:
+            result = await coro
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            continue
+        latencies.append(time.monotonic() - started)
+        if isinstance(result, tuple) and result and result[0] is False:
+            errors.append(f"failed: {result[1]}")
+
+
+async def bench_single(factory, min_time: float, min_runs: int, max_runs: int, warmup: int) -> dict:
+    """Последовательные вызовы: не меньше min_runs и min_time секунд"""
+    for _ in range(warmup):
+        coro = factory()
+        if coro is None:
+            break
+        await coro
+
+    latencies, errors = [], []
+    started = time.monotonic()
+    await call_loop(factory, started + min_time, max_runs, latencies, errors)
+    while len(latencies) < min_runs:
+        before = len(latencies)
+        await call_loop(factory, math.inf, min_runs, latencies, errors)
+        if len(latencies) == before:
+            break
+    elapsed = time.monotonic() - started
+    if not latencies:
+        return {"runs": 0, "errors": len(errors)}
+    return {**summarize(latencies, elapsed), "errors": len(errors), "error_sample": errors[:3]}
+
+
+async def bench_concurrent(database, factory, callers: int, duration: float) -> dict:
+    """callers одновременных вызывающих в течение duration секунд"""
+    stats_before = database.get_db_stats()
+    latencies, errors = [], []
+    started = time.monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(
+        call_loop(factory, deadline, math.inf, latencies, errors) for _ in range(callers)
+    ))
+    elapsed = time.monotonic() - started
+    stats = database.get_db_stats()
+    pool_acquires = stats["pool_acquires"] - stats_before["pool_acquires"]
+    pool_wait = stats["pool_wait"] - stats_before["pool_wait"]
+    if not latencies:
+        return {"runs": 0, "errors": len(errors)}
+    return {
+        **summarize(latencies, elapsed),
+        "errors": len(errors),
+        "error_sample": errors[:3],
+        "lock_retries": stats["lock_retries"] - stats_before["lock_retries"],
+        "conflict_retries": stats["conflict_retries"] - stats_before["conflict_retries"],
+        "retry_sleep_ms": round((stats["retry_sleep"] - stats_before["retry_sleep"]) * 1000, 1),
+        "pool_wait_avg_ms": round(pool_wait / pool_acquires * 1000, 3) if pool_acquires else 0,
+        "pool_wait_max_ms": round(stats["pool_wait_max"] * 1000, 3),
+    }
+
+
+async def use_database(database, path: str):
+    """Переключить database.py на другую базу (пул и кэши — заново)"""
+    await database.close_db_pool()
+    database.DB_NAME = path
+    database._user_cache.clear()
+    database._invalidate_catalog()
+    database._db_stats["pool_wait_max"] = 0.0
+
+
+# ============================================
+# ЗАПУСК
+# ============================================
+
+async def run(args) -> dict:
+    import database
+
+    report = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPU",
+            "sizes": args.sizes,
+            "concurrency": args.concurrency,
+        },
+        "results": {},
+        "scaling": {},
+        "concurrency": {},
+    }
+    try:
+        for size in args.sizes:
+            source = prepare_database(size, args.cache_dir)
+            path = working_copy(source, args.cache_dir)
+            cases = build_cases(database, load_inputs(path))
+            await use_database(database, path)
+            # Индексы и миграции текущего кода (кэш мог быть создан старой схемой)
+            await database.init_db()
+            print(f"\n== {size} заказов ==")
+            for name, factory in cases.items():
+                if args.only and not any(part in name for part in args.only):
+                    continue
+                result = await bench_single(factory, args.min_time, args.min_runs, args.max_runs, args.warmup)
+                report["results"].setdefault(name, {})[str(size)] = result
+                if result["runs"]:
+                    print(f"  {name:<30} {result['median_ms']:>10.3f} мс  p95 {result['p95_ms']:>10.3f}  "
+                          f"({result['runs']} вызовов, ошибок {result['errors']})")
+                else:
+                    print(f"  {name:<30} нет успешных вызовов ({result['errors']} ошибок)")
+
+            if size == args.sizes[-1] and args.concurrency:
+                print(f"\n== {size} заказов, одновременные вызовы ==")
+                for name, factory in cases.items():
+                    if args.only and not any(part in name for part in args.only):
+                        continue
+                    for callers in args.concurrency:
+                        result = await bench_concurrent(database, factory, callers, args.concurrency_time)
+                        report["concurrency"].setdefault(name, {})[f"{size}x{callers}"] = result
+                        if not result["runs"]:
+                            continue
+                        print(f"  {name:<30} x{callers:<3} {result['ops_per_sec']:>9} оп/с  "
+                              f"p50 {result['median_ms']:>9.3f}  p95 {result['p95_ms']:>9.3f} мс  "
+                              f"retries {result['lock_retries']}+{result['conflict_retries']}  "
+                              f"pool wait {result['pool_wait_avg_ms']} мс  ошибок {result['errors']}")
+            await database.close_db_pool()
+    finally:
+        await database.close_db_pool()
+
+    # Рост времени с объёмом: t ~ n^k между самой маленькой и самой большой базой
+    for name, by_size in report["results"].items():
+        measured = [(int(size), r["median_ms"]) for size, r in by_size.items() if r.get("runs")]
+        if len(measured) >= 2:
+            (n1, t1), (n2, t2) = measured[0], measured[-1]
+            report["scaling"][name] = {
+                "ratio": round(t2 / t1, 2) if t1 else None,
+                "exponent": round(math.log(t2 / t1) / math.log(n2 / n1), 2) if t1 and t2 and n2 != n1 else None,
+            }
+    return report
+
+
+def print_scaling(report: dict):
+    if not report["scaling"]:
+        return
+    sizes = report["meta"]["sizes"]
+    print(f"\nРост с объёмом ({sizes[0]} → {sizes[-1]} заказов; k: время ~ n^k, k≈0 — индекс, k≈1 — полный проход)")
+    for name, scaling in report["scaling"].items():
+        print(f"  {name:<30} ×{scaling['ratio']:<10} k={scaling['exponent']}")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Сравнение медиан с baseline; возвращает список регрессий"""
+    regressions = []
+    print(f"\nСравнение с baseline ({baseline['meta'].get('started_at')}, {baseline['meta'].get('machine')})")
+    # results: по размеру базы, concurrency: "<размер>x<вызывающих>"
+    for section in ("results", "concurrency"):
+        current, previous = report[section], baseline.get(section, {})
+        for name, by_key in current.items():
+            for key, result in by_key.items():
+                old = previous.get(name, {}).get(key)
+                if not old or not old.get("runs") or not result.get("runs"):
+                    continue
+                median, old_median = result["median_ms"], old["median_ms"]
+                change = (median - old_median) / old_median if old_median else 0
+                label = f"{name} @ {key}"
+                marker = ""
+                if change > tolerance and median - old_median > REGRESSION_NOISE_MS:
+                    marker = "  <-- регрессия"
+                    regressions.append(f"{label}: {old_median} → {median} мс ({change:+.0%})")
+                print(f"  {label:<45} {old_median:>10.3f} → {median:<10.3f} ({change:+.0%}){marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки database.py")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        type=lambda value: sorted(int(v) for v in value.split(",")), help="размеры баз, заказов")
+    parser.add_argument("--concurrency", default=",".join(map(str, DEFAULT_CONCURRENCY)),
+                        type=lambda value: [int(v) for v in value.split(",") if v], help="числа одновременных вызовов")
+    parser.add_argument("--only", type=lambda value: value.split(","), default=None,
+                        help="только замеры, содержащие эти подстроки")
+    parser.add_argument("--min-time", type=float, default=1.0, help="секунд на замер")
+    parser.add_argument("--min-runs", type=int, default=5)
+    parser.add_argument("--max-runs", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--concurrency-time", type=float, default=2.0, help="секунд на замер с N вызывающими")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="каталог для сгенерированных баз")
+    parser.add_argument("--json", help="записать отчёт в файл")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--no-compare", action="store_true", help="не сравнивать с baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="записать отчёт как новый baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимый рост медианы (доля)")
+    args = parser.parse_args()
+
+    # update_order_payment_status пишет INFO на каждый вызов
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(run(args))
+    print_scaling(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"\nBaseline записан: {args.baseline}")
+        return
+
+    if not args.no_compare and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("\nРегрессии:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nРегрессий нет")
+
+
+if __name__ == "__main__":
+    main()
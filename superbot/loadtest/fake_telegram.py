@@ -0,0 +1,397 @@
+"""
+Фейковый Telegram Bot API для нагрузочных тестов
+================================================
+
+Бот и Mini App ходят в Telegram на каждый хэндлер, поэтому измерить их
+локально было невозможно. Этот сервер отвечает на методы Bot API, которыми
+пользуются бот и Mini App, и хранит сообщения в памяти:
+
+    getMe, getUpdates, sendMessage, sendPhoto, editMessageText,
+    editMessageCaption, editMessageMedia, answerCallbackQuery, getFile,
+    getUserProfilePhotos, deleteWebhook/setWebhook, /file/bot<token>/...
+
+Остальные методы отвечают True (и считаются в stats["unknown"]).
+
+Как у настоящего Telegram:
+- повторное редактирование без изменений — 400 "message is not modified"
+- неизвестный file_id — 400 "wrong file identifier"
+- с вероятностью error_rate — 429 с parameters.retry_after
+- задержка ответа latency + случайная до jitter секунд
+
+Запуск отдельно:
+    python loadtest/fake_telegram.py --port 8090 --latency 0.05 --error-rate 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8090 BOT_TOKEN=123456:TEST python main.py
+
+Обновления для бота — POST /_fake/updates (JSON-объект или список),
+последний экран чата — GET /_fake/screen/<chat_id>, статистика — GET /_fake/stats.
+Драйвер нагрузки (loadtest/bot_load.py) запускает сервер в своём процессе.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import OrderedDict, defaultdict
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений помнить для редактирования
+MAX_STORED_MESSAGES = 100000
+# Максимальное ожидание в getUpdates (long polling)
+MAX_POLL_TIMEOUT = 30
+# Методы без задержки и без 429 (служебные)
+SERVICE_METHODS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "close", "logOut"}
+
+# Маленький валидный JPEG 1x1 — содержимое всех «скачиваемых» файлов
+FAKE_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c"
+    "140d0c0b0b0c1912130f141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27"
+    "393d38323c2e333432ffc0000b080001000101011100ffc4001f00000105010101010101000000"
+    "00000000000102030405060708090a0bffc400b5100002010303020403050504040000017d0102"
+    "0300041105122131410613516107227114328191a1082342b1c11552d1f02433627282090a1617"
+    "18191a25262728292a3435363738393a434445464748494a535455565758595a63646566676869"
+    "6a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5"
+    "b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6"
+    "f7f8f9faffda0008010100003f00fbd3ffd9"
+)
+
+
+class TelegramError(Exception):
+    """Ответ ok=false"""
+
+    def __init__(self, code: int, description: str, retry_after: int = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class FakeTelegram:
+    """Состояние фейкового Bot API и aiohttp-приложение"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+
+        self._update_ids = itertools.count(1)
+        self._updates = []  # ожидающие getUpdates
+        self._updates_changed = asyncio.Condition()
+        self._message_ids = defaultdict(lambda: itertools.count(1))
+        self._file_ids = itertools.count(1)
+        self.messages = OrderedDict()  # (chat_id, message_id) -> message
+        self.screens = {}  # chat_id -> последнее сообщение с callback-кнопками
+        self.files = {}  # file_id -> размер
+        self.listeners = []  # fn(method, params, result) после каждого вызова
+
+        self.polling_started = asyncio.Event()
+        self.stats = {"calls": defaultdict(int), "errors": defaultdict(int), "injected_429": 0, "unknown": 0}
+        self.bot_user = None
+
+        self.app = web.Application(client_max_size=50 * 1024 * 1024)
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        self.app.router.add_post("/_fake/updates", self.handle_feed)
+        self.app.router.add_get("/_fake/screen/{chat_id}", self.handle_screen)
+        self.app.router.add_get("/_fake/stats", self.handle_stats)
+
+    # ============================================
+    # ОБНОВЛЕНИЯ ДЛЯ БОТА
+    # ============================================
+
+    async def feed(self, update: dict) -> int:
+        """Поставить обновление в очередь getUpdates (update_id назначается здесь)"""
+        update = {**update, "update_id": next(self._update_ids)}
+        async with self._updates_changed:
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+        return update["update_id"]
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(int(params.get("timeout") or 0), MAX_POLL_TIMEOUT)
+        self.polling_started.set()
+
+        async with self._updates_changed:
+            # offset подтверждает всё, что раньше него
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._updates_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    # ============================================
+    # СООБЩЕНИЯ
+    # ============================================
+
+    def _chat(self, chat_id) -> dict:
+        chat_id = int(chat_id)
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+    def _new_message(self, chat_id, **fields) -> dict:
+        chat = self._chat(chat_id)
+        message = {
+            "message_id": next(self._message_ids[chat["id"]]),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": self.bot_user,
+            **{key: value for key, value in fields.items() if value is not None},
+        }
+        self._store(message)
+        return message
+
+    def _store(self, message: dict):
+        key = (message["chat"]["id"], message["message_id"])
+        self.messages[key] = message
+        self.messages.move_to_end(key)
+        while len(self.messages) > MAX_STORED_MESSAGES:
+            self.messages.popitem(last=False)
+        markup = message.get("reply_markup") or {}
+        if any("callback_data" in button for row in markup.get("inline_keyboard", []) for button in row):
+            self.screens[message["chat"]["id"]] = message
+
+    def _find_message(self, params: dict) -> dict:
+        if params.get("inline_message_id"):
+            raise TelegramError(400, "Bad Request: inline messages are not supported by the fake server")
+        message = self.messages.get((int(params.get("chat_id", 0)), int(params.get("message_id", 0))))
+        if message is None:
+            raise TelegramError(400, "Bad Request: message to edit not found")
+        return message
+
+    def _photo(self, value, params: dict) -> list:
+        """PhotoSize[] для загруженного файла или уже известного file_id"""
+        if isinstance(value, str) and value.startswith("attach://"):
+            # aiogram передаёт файл отдельным полем формы
+            value = params.get(value[len("attach://"):])
+        if isinstance(value, web.FileField):
+            file_id = f"fake-photo-{next(self._file_ids)}"
+            self.files[file_id] = len(value.file.read())
+        elif isinstance(value, str) and (value in self.files or value.startswith(("http://", "https://"))):
+            file_id = value
+            self.files.setdefault(file_id, len(FAKE_JPEG))
+        else:
+            raise TelegramError(400, "Bad Request: wrong file identifier/HTTP URL specified")
+        return [{
+            "file_id": file_id,
+            "file_unique_id": f"u{file_id}",
+            "width": 1280,
+            "height": 720,
+            "file_size": self.files[file_id],
+        }]
+
+    @staticmethod
+    def _json(params: dict, key: str):
+        value = params.get(key)
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+    @staticmethod
+    def _same(message: dict, field: str, value, markup) -> bool:
+        return (message.get(field) or "") == (value or "") and message.get("reply_markup") == markup
+
+    # ============================================
+    # МЕТОДЫ BOT API
+    # ============================================
+
+    async def call(self, method: str, params: dict):
+        """Выполнить метод; TelegramError — ответ ok=false"""
+        if method == "getMe":
+            return self.bot_user
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery", "deleteMessage",
+                      "sendChatAction", "setMyCommands"):
+            return True
+
+        if method == "sendMessage":
+            return self._new_message(
+                params["chat_id"], text=params.get("text"), reply_markup=self._json(params, "reply_markup")
+            )
+
+        if method == "sendPhoto":
+            return self._new_message(
+                params["chat_id"], photo=self._photo(params.get("photo"), params),
+                caption=params.get("caption"), reply_markup=self._json(params, "reply_markup")
+            )
+
+        if method == "editMessageText":
+            message = self._find_message(params)
+            if "photo" in message:
+                raise TelegramError(400, "Bad Request: there is no text in the message to edit")
+            markup = self._json(params, "reply_markup")
+            if self._same(message, "text", params.get("text"), markup):
+                raise TelegramError(400, "Bad Request: message is not modified: specified new message content "
+                                         "and reply markup are exactly the same as a current content and reply "
+                                         "markup of the message")
+            message.update(text=params.get("text"), reply_markup=markup, edit_date=int(time.time()))
+            self._store(message)
+            return message
+
+        if method == "editMessageCaption":
+            message = self._find_message(params)
+            if "photo" not in message:
+                raise TelegramError(400, "Bad Request: there is no caption in the message to edit")
+            markup = self._json(params, "reply_markup")
+            if self._same(message, "caption", params.get("caption"), markup):
+                raise TelegramError(400, "Bad Request: message is not modified: specified new message content "
+                                         "and reply markup are exactly the same as a current content and reply "
+                                         "markup of the message")
+            message.update(caption=params.get("caption"), reply_markup=markup, edit_date=int(time.time()))
+            self._store(message)
+            return message
+
+        if method == "editMessageMedia":
+            message = self._find_message(params)
+            media = self._json(params, "media") or {}
+            message.pop("text", None)
+            message.update(
+                photo=self._photo(media.get("media"), params), caption=media.get("caption"),
+                reply_markup=self._json(params, "reply_markup"), edit_date=int(time.time())
+            )
+            self._store(message)
+            return message
+
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            if file_id not in self.files:
+                raise TelegramError(400, "Bad Request: invalid file_id")
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"u{file_id}",
+                "file_size": self.files[file_id],
+                "file_path": f"photos/{file_id}.jpg",
+            }
+
+        if method == "getUserProfilePhotos":
+            # У каждого пользователя одна аватарка
+            file_id = f"fake-avatar-{params.get('user_id')}"
+            self.files.setdefault(file_id, len(FAKE_JPEG))
+            size = {"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 160, "height": 160,
+                    "file_size": len(FAKE_JPEG)}
+            return {"total_count": 1, "photos": [[size]]}
+
+        self.stats["unknown"] += 1
+        return True
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.method == "POST":
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+
+        self.stats["calls"][method] += 1
+        if method not in SERVICE_METHODS:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats["injected_429"] += 1
+                return self._error(TelegramError(
+                    429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after
+                ))
+
+        try:
+            result = await self.call(method, params)
+        except TelegramError as e:
+            self.stats["errors"][method] += 1
+            return self._error(e)
+
+        for listener in self.listeners:
+            listener(method, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(error: TelegramError) -> web.Response:
+        body = {"ok": False, "error_code": error.code, "description": error.description}
+        if error.retry_after is not None:
+            body["parameters"] = {"retry_after": error.retry_after}
+        return web.json_response(body, status=error.code)
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=FAKE_JPEG, content_type="image/jpeg")
+
+    async def handle_feed(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        updates = body if isinstance(body, list) else [body]
+        update_ids = [await self.feed(update) for update in updates]
+        return web.json_response({"ok": True, "result": update_ids})
+
+    async def handle_screen(self, request: web.Request) -> web.Response:
+        screen = self.screens.get(int(request.match_info["chat_id"]))
+        return web.json_response({"ok": screen is not None, "result": screen})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    def get_stats(self) -> dict:
+        return {
+            "calls": dict(self.stats["calls"]),
+            "errors": dict(self.stats["errors"]),
+            "injected_429": self.stats["injected_429"],
+            "unknown": self.stats["unknown"],
+            "stored_messages": len(self.messages),
+        }
+
+    # ============================================
+    # ЗАПУСК
+    # ============================================
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8090, bot_id: int = 123456) -> web.AppRunner:
+        """Запустить сервер в текущем event loop'е"""
+        self.bot_user = {
+            "id": bot_id, "is_bot": True, "first_name": "Fake Shop Bot", "username": "fake_shop_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+        }
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Fake Telegram Bot API on http://{host}:{port}")
+        return runner
+
+
+async def _serve(args):
+    server = FakeTelegram(args.latency, args.jitter, args.error_rate, args.retry_after)
+    runner = await server.start(args.host, args.port, args.bot_id)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--bot-id", type=int, default=123456, help="первая часть BOT_TOKEN")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Проверка планов запросов database.py
+====================================
+
+Создаёт пустую базу через init_db() (та же схема и индексы, что в
+продакшене), вызывает горячие функции database.py и для каждого
+выполненного ими SQL снимает EXPLAIN QUERY PLAN. Проверка не проходит,
+если запрос читает таблицу целиком (SCAN <таблица>) или сортирует
+результат во временном B-дереве там, где должен работать индекс.
+
+    python loadtest/query_plans.py                 # все проверки
+    python loadtest/query_plans.py --only referral --verbose
+
+Полный проход разрешается явно (allow_scan) только там, где он и есть
+смысл запроса: агрегаты за всё время, небольшие справочники (products).
+Новая горячая функция добавляется в build_checks(); новый индекс, который
+перестал использоваться, или обёртка вида DATE(created_at) = ... вокруг
+индексированного столбца дадут код выхода 1.
+
+Данные в базе — по несколько строк на таблицу: план SQLite без ANALYZE
+зависит только от схемы и текста запроса, поэтому проверка быстрая и не
+требует сгенерированных баз db_bench.py.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+USER_ID = 1001
+OTHER_USER_ID = 1002
+NEW_USER_ID = 1003
+REFERRAL_CODE = "plans"
+TRANSACTION_ID = "tx-plans"
+IDEMPOTENCY_TTL = 3600
+
+# Строка плана "SCAN <таблица> ..." (в т.ч. "SCAN orders USING INDEX ...")
+_SCAN_RE = re.compile(r"^SCAN (\w+)")
+_TEMP_SORT = "USE TEMP B-TREE FOR ORDER BY"
+# Запросы без плана выборки
+_SKIP_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "CREATE", "ANALYZE")
+
+
+class Check:
+    """
+    Вызов функции database.py и ожидания к планам его запросов.
+    allow_scan — таблицы (или их псевдонимы в запросе), которые можно читать
+    целиком; expect — подстроки (обычно имена индексов), которые должны
+    встретиться в планах вызова.
+    """
+
+    def __init__(self, name: str, call, allow_scan=(), allow_sort: bool = False, expect=()):
+        self.name = name
+        self.call = call
+        self.allow_scan = set(allow_scan)
+        self.allow_sort = allow_sort
+        self.expect = tuple(expect)
+
+
+# ============================================
+# ПОДГОТОВКА БАЗЫ
+# ============================================
+
+async def use_database(database, path: str):
+    """Переключить database.py на другую базу (пул и кэши — заново)"""
+    await database.close_db_pool()
+    database.DB_NAME = path
+    database._user_cache.clear()
+    database._invalidate_catalog()
+
+
+async def seed(database) -> dict:
+    """Несколько строк в каждой таблице, чтобы функции прошли все ветки"""
+    await database.init_db()
+    product_id = await database.add_product("Plans Pass", "", 100.0, "brawlstars", "pass")
+    await database.add_product("Plans Gems", "", 50.0, "clashroyale", "gems")
+    for user_id in (USER_ID, OTHER_USER_ID):
+        await database.get_or_create_user(user_id, "plans", "Plans")
+    await database.update_user_balance(USER_ID, 10_000)
+    await database.create_referral_link(REFERRAL_CODE, "Проверка планов")
+    await database.register_referral_visit(REFERRAL_CODE, OTHER_USER_ID)
+
+    order_id, _ = await database.create_order(USER_ID, product_id, 100.0, "Plans Pass", "brawlstars")
+    payment_order_id, _ = await database.create_order(OTHER_USER_ID, product_id, 100.0, "Plans Pass", "brawlstars")
+    # Заказ по корзине: позиции в order_items
+    await database.create_order(USER_ID, None, 200.0, items=[(product_id, "Plans Pass", 100.0, 2, "brawlstars")])
+    await database.save_payment_transaction(payment_order_id, TRANSACTION_ID)
+    # Переход в pending_payment должен попасть в журнал (его читают SSE и changefeed)
+    events = await database.get_order_events_after(0, user_id=OTHER_USER_ID)
+    if not any(e["order_id"] == payment_order_id and e["new_status"] == "pending_payment" for e in events):
+        raise RuntimeError(f"save_payment_transaction не записал событие заказа {payment_order_id}")
+    await database.enqueue_bot_update(1, USER_ID, "{}")
+    await database.reserve_idempotency_key(USER_ID, "/api/buy", "plans-key", "hash", IDEMPOTENCY_TTL)
+    uid = await database.get_user_uid(USER_ID)
+    return {"product_id": product_id, "order_id": order_id, "payment_order_id": payment_order_id, "uid": uid}
+
+
+# ============================================
+# ПРОВЕРЯЕМЫЕ ВЫЗОВЫ
+# ============================================
+
+def build_checks(database, data: dict) -> list:
+    product_id = data["product_id"]
+    order_id = data["order_id"]
+
+    async def consume_handler(events):
+        return None
+
+    checks = [
+        # Пользователи
+        Check("get_or_create_user[existing]", lambda: database.get_or_create_user(USER_ID, "plans", "Plans")),
+        Check("get_or_create_user[new]", lambda: database.get_or_create_user(NEW_USER_ID, "plans", "Plans")),
+        Check("get_user_balance", lambda: database.get_user_balance(USER_ID)),
+        Check("search_user_by_uid", lambda: database.search_user_by_uid(data["uid"])),
+        Check("get_user_full_stats", lambda: database.get_user_full_stats(USER_ID)),
+        Check("get_user_orders", lambda: database.get_user_orders(USER_ID), expect={"idx_orders_user_created"}),
+        Check("get_user_orders_stats", lambda: database.get_user_orders_stats(USER_ID)),
+        # Каталог: products — справочник на десятки строк, полный проход дешевле индекса
+        Check("get_product_by_id", lambda: database.get_product_by_id(product_id)),
+        Check("get_products_by_ids", lambda: database.get_products_by_ids([product_id, product_id + 1])),
+        Check("get_products_by_game_and_subcategory", lambda: database.get_products_by_game_and_subcategory(
+            "brawlstars", "pass"
+        )),
+        Check("get_catalog_products", lambda: database.get_catalog_products(),
+              allow_scan={"products"}, allow_sort=True),
+        # Заказы и оплата
+        Check("purchase_with_balance", lambda: database.purchase_with_balance(USER_ID, product_id)),
+        Check("get_order_by_id", lambda: database.get_order_by_id(order_id)),
+        Check("get_order_items", lambda: database.get_order_items(order_id)),
+        Check("get_order_by_transaction_id", lambda: database.get_order_by_transaction_id(TRANSACTION_ID)),
+        Check("update_order_payment_status", lambda: database.update_order_payment_status(
+            data["payment_order_id"], "paid", source="plans"
+        )),
+        # Незакрытых заказов единицы: сортируются уже найденные по idx_orders_status
+        Check("get_pending_orders", lambda: database.get_pending_orders(),
+              allow_sort=True, expect={"idx_orders_status"}),
+        Check("get_pending_payments", lambda: database.get_pending_payments()),
+        Check("confirm_order", lambda: database.confirm_order(order_id)),
+        # Статистика админки: "all" — агрегат по всей таблице по определению.
+        # users.last_activity без индекса: его пришлось бы обновлять при каждом
+        # get_or_create_user ради редкого отчёта
+        *[
+            Check(f"get_stats_users[{period}]", lambda period=period: database.get_stats_users(period),
+                  allow_scan={"users"})
+            for period in ("today", "yesterday", "7days", "all")
+        ],
+        *[
+            Check(f"get_stats_revenue[{period}]", lambda period=period: database.get_stats_revenue(period),
+                  allow_scan={"orders"} if period == "all" else (),
+                  expect={"idx_orders_created_at"} if period != "all" else ())
+            for period in ("today", "yesterday", "7days", "all")
+        ],
+        *[
+            Check(f"get_stats_sales_by_game[{period}]",
+                  lambda period=period: database.get_stats_sales_by_game("brawlstars", period),
+                  allow_scan={"orders"} if period == "all" else (),
+                  expect={"idx_orders_created_at"} if period != "all" else ())
+            for period in ("today", "yesterday", "7days", "all")
+        ],
+        # Группировка по товару — всегда во временном дереве
+        *[
+            Check(f"get_stats_sales_by_product[{period}]",
+                  lambda period=period: database.get_stats_sales_by_product(period),
+                  allow_scan={"o", "oi"} if period == "all" else (), allow_sort=True,
+                  expect={"idx_orders_created_at"} if period != "all" else ())
+            for period in ("today", "yesterday", "7days", "all")
+        ],
+        # Рефералы
+        Check("register_referral_visit", lambda: database.register_referral_visit(REFERRAL_CODE, USER_ID)),
+        Check("get_referral_link_by_code", lambda: database.get_referral_link_by_code(REFERRAL_CODE)),
+        Check("get_referral_stats", lambda: database.get_referral_stats(REFERRAL_CODE),
+              expect={"idx_users_referral_code (referral_code=?)", "idx_referral_visits_code"}),
+        # Журнал заказов, очередь обновлений, FSM, идемпотентность
+        Check("get_order_events_after[user]", lambda: database.get_order_events_after(0, user_id=USER_ID)),
+        Check("get_order_events_after[all]", lambda: database.get_order_events_after(0)),
+        Check("consume_order_events", lambda: database.consume_order_events("plans", consume_handler)),
+        Check("enqueue_bot_update", lambda: database.enqueue_bot_update(2, USER_ID, "{}")),
+        Check("claim_bot_updates", lambda: database.claim_bot_updates(0, 1)),
+        Check("delete_old_bot_updates", lambda: database.delete_old_bot_updates(0)),
+        Check("get_fsm_record", lambda: database.get_fsm_record("plans:1:1", 0)),
+        Check("delete_expired_fsm_records", lambda: database.delete_expired_fsm_records(0)),
+        Check("get_idempotency_record", lambda: database.get_idempotency_record(
+            USER_ID, "/api/buy", "plans-key", IDEMPOTENCY_TTL
+        )),
+        Check("delete_expired_idempotency_keys", lambda: database.delete_expired_idempotency_keys(IDEMPOTENCY_TTL)),
+    ]
+    return checks
+
+
+# ============================================
+# ПРОВЕРКА
+# ============================================
+
+def explain(conn: sqlite3.Connection, sql: str, parameters) -> list:
+    """Строки плана без отступов"""
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, parameters or ()).fetchall()
+    return [row[3] for row in rows]
+
+
+def problems(plan: list, check: Check) -> list:
+    found = []
+    for line in plan:
+        match = _SCAN_RE.match(line)
+        if match and match.group(1) != "CONSTANT" and match.group(1) not in check.allow_scan:
+            found.append(line)
+        elif line.startswith(_TEMP_SORT) and not check.allow_sort:
+            found.append(line)
+    return found
+
+
+async def run_check(query_stats, conn: sqlite3.Connection, check: Check, verbose: bool) -> bool:
+    with query_stats.capture_statements() as statements:
+        await check.call()
+
+    ok = True
+    seen = set()
+    lines = []
+    used = set()
+    for sql, parameters in statements:
+        key = query_stats.fingerprint(sql)
+        # executemany: параметры не сохранены; запросы без плана выборки
+        if key in seen or parameters is None or key.upper().startswith(_SKIP_PREFIXES):
+            continue
+        seen.add(key)
+        plan = explain(conn, sql, parameters)
+        used.update(name for line in plan for name in check.expect if name in line)
+        found = problems(plan, check)
+        if found:
+            ok = False
+        if found or verbose:
+            lines.append(f"    {key}")
+            lines.extend(f"      {'!! ' if line in found else ''}{line}" for line in plan)
+
+    missing = [name for name in check.expect if name not in used]
+    if missing:
+        ok = False
+        lines.insert(0, f"    не использован индекс: {', '.join(missing)}")
+
+    print(f"  {'OK  ' if ok else 'FAIL'} {check.name}")
+    for line in lines:
+        print(line)
+    return ok
+
+
+async def run(args) -> int:
+    import database
+    import query_stats
+
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="supercell-plans-") as tmp:
+        path = os.path.join(tmp, "plans.db")
+        try:
+            await use_database(database, path)
+            data = await seed(database)
+            conn = sqlite3.connect(path)
+            try:
+                for check in build_checks(database, data):
+                    if args.only and not any(part in check.name for part in args.only):
+                        continue
+                    if not await run_check(query_stats, conn, check, args.verbose):
+                        failed.append(check.name)
+            finally:
+                conn.close()
+        finally:
+            await database.close_db_pool()
+
+    if failed:
+        print(f"\nПолный проход, сортировка или поиск без нужного индекса: {', '.join(failed)}")
+        return 1
+    print("\nВсе планы используют индексы")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка EXPLAIN QUERY PLAN горячих запросов database.py")
+    parser.add_argument("--only", type=lambda s: [p for p in s.split(",") if p],
+                        help="только проверки, в имени которых есть одна из подстрок (через запятую)")
+    parser.add_argument("--verbose", action="store_true", help="печатать планы всех запросов, а не только проблемных")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Файлы статистики запросов этого прогона не нужны
+    os.environ.setdefault("QUERY_STATS_DIR", "")
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
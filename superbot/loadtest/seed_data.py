@@ -0,0 +1,302 @@
+"""
+Генератор данных production-масштаба для нагрузочных тестов
+===========================================================
+
+Заполняет базу реалистичными объёмами: сотни тысяч пользователей,
+миллионы заказов во всех статусах, реферальные переходы, корзины.
+На маленькой базе разработчика все запросы быстрые, и регрессии
+(full scan, N+1) не видны — на такой базе видны.
+
+Схема создаётся init_db() (со всеми миграциями), данные вставляются
+напрямую через sqlite3 пачками по BATCH_SIZE строк — async-функции
+database.py на миллионах строк работали бы часами.
+
+    python loadtest/seed_data.py --db /tmp/load.db
+    python loadtest/seed_data.py --db /tmp/load.db --users 50000 --orders 200000 --seed 1
+
+Генерация детерминирована при одинаковом --seed. В базу, где уже есть
+пользователи, данные добавляются только с --append.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+BATCH_SIZE = 50000
+
+# Диапазон id синтетических пользователей (как у настоящих аккаунтов Telegram)
+USER_ID_BASE = 1_000_000_000
+
+# Доли статусов заказов
+ORDER_STATUSES = (
+    ("completed", 0.55),
+    ("paid", 0.10),
+    ("pending_payment", 0.12),
+    ("pending", 0.08),
+    ("cancelled", 0.10),
+    ("declined", 0.05),
+)
+# Доля заказов-корзин (несколько позиций в order_items)
+CART_ORDER_SHARE = 0.10
+# Доля пользователей, пришедших по реферальной ссылке
+REFERRAL_USER_SHARE = 0.15
+
+# Названия товаров по играм: (шаблон, варианты)
+PRODUCT_TEMPLATES = {
+    "brawlstars": [
+        ("{} гемов", (30, 80, 170, 360, 950, 2000)),
+        ("Brawl Pass {}", ("", "Plus", "Premium")),
+        ("Акция: {}", ("Стартовый набор", "Набор бойца", "Мега-ящик", "Легендарный набор")),
+    ],
+    "clashroyale": [
+        ("{} гемов", (80, 500, 1200, 2500, 6500, 14000)),
+        ("Эволюция {}", ("Рыцаря", "Лучниц", "Бомбера", "Мушкетера", "Валькирии", "Дровосека", "Теслы")),
+        ("Эмодзи {}", ("Король", "Принцесса", "Гоблин", "Свинья")),
+        ("Легендарная карта {}", ("Мегарыцарь", "Ледяной маг", "Шахтёр", "Принцесса", "Бандитка")),
+        ("Pass Royale {}", ("", "Diamond")),
+    ],
+    "clashofclans": [
+        ("{} гемов", (80, 500, 1200, 2500, 6500, 14000)),
+        ("Золотой пропуск {}", ("", "сезонный")),
+        ("Акция: {}", ("Набор строителя", "Набор героя", "Зелья")),
+    ],
+}
+FIRST_NAMES = (
+    "Алексей", "Максим", "Даниил", "Артём", "Иван", "Дмитрий", "Кирилл", "Никита",
+    "Анна", "Мария", "Софья", "Алиса", "Ева", "Полина", "Alex", "Max", "Leo", "Mia",
+)
+EMAIL_DOMAINS = ("gmail.com", "mail.ru", "yandex.ru", "icloud.com")
+
+
+def _status_picker(rng: random.Random):
+    statuses = [status for status, _ in ORDER_STATUSES]
+    weights = [weight for _, weight in ORDER_STATUSES]
+    return lambda: rng.choices(statuses, weights)[0]
+
+
+def _timestamp(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _batched(rows, size: int = BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn: sqlite3.Connection, sql: str, rows, label: str, total: int) -> int:
+    """Вставить строки пачками, по транзакции на пачку"""
+    inserted = 0
+    started = time.monotonic()
+    for batch in _batched(rows):
+        conn.executemany(sql, batch)
+        conn.commit()
+        inserted += len(batch)
+        print(f"\r  {label}: {inserted}/{total}", end="", flush=True)
+    print(f"\r  {label}: {inserted} за {time.monotonic() - started:.1f} с")
+    return inserted
+
+
+# ============================================
+# ГЕНЕРАТОРЫ СТРОК
+# ============================================
+
+def generate_products(rng: random.Random, count: int):
+    """Товары по играм и подкатегориям каталога"""
+    from handlers.categories import CATEGORIES
+
+    rows = []
+    for i in range(count):
+        game = list(PRODUCT_TEMPLATES)[i % len(PRODUCT_TEMPLATES)]
+        template, variants = rng.choice(PRODUCT_TEMPLATES[game])
+        name = template.format(rng.choice(variants)).strip()
+        subcategory = rng.choice(CATEGORIES[game]["categories"])["id"]
+        price = rng.choice((99, 149, 299, 499, 799, 1299, 2490, 4990, 9990))
+        rows.append((f"{name} #{i + 1}", f"{name} для аккаунта {CATEGORIES[game]['name']}", price, game, subcategory))
+    return rows
+
+
+def generate_users(rng: random.Random, count: int, first_uid: int, referral_codes: list, now: datetime):
+    for i in range(count):
+        registered = now - timedelta(seconds=rng.randint(0, 730 * 86400))
+        last_activity = registered + timedelta(seconds=rng.randint(0, int((now - registered).total_seconds())))
+        balance = 0.0 if rng.random() < 0.8 else float(rng.randint(1, 5000))
+        yield (
+            USER_ID_BASE + first_uid + i,
+            first_uid + i,
+            f"user{first_uid + i}" if rng.random() < 0.7 else None,
+            rng.choice(FIRST_NAMES),
+            balance,
+            _timestamp(registered),
+            _timestamp(last_activity),
+            rng.choice(referral_codes) if referral_codes and rng.random() < REFERRAL_USER_SHARE else None,
+        )
+
+
+def generate_orders(rng: random.Random, count: int, user_ids: list, products: list, now: datetime):
+    """
+    Заказы в порядке created_at (как id в production). Покупатели
+    неравномерны: у постоянных клиентов — десятки заказов, у большинства — 0-2.
+    Выдаёт (строка orders, позиции корзины для order_items).
+    """
+    pick_status = _status_picker(rng)
+    start = now - timedelta(days=365)
+    step = 365 * 86400 / max(count, 1)
+    scale = max(len(user_ids) / 20, 1)
+
+    for i in range(count):
+        if rng.random() < 0.8:
+            user_id = user_ids[int(rng.expovariate(1 / scale)) % len(user_ids)]
+        else:
+            user_id = rng.choice(user_ids)
+        status = pick_status()
+        created = start + timedelta(seconds=i * step + rng.random() * step)
+
+        if rng.random() < CART_ORDER_SHARE:
+            items = rng.sample(products, rng.randint(2, 3))
+        else:
+            items = [rng.choice(products)]
+        first = items[0]
+        amount = sum(item[2] for item in items)
+        product_name = ", ".join(item[1] for item in items)
+
+        pickup_code = "".join(rng.choices(string.ascii_uppercase + string.digits, k=8))
+        email = f"player{rng.randint(1, 10 ** 7)}@{rng.choice(EMAIL_DOMAINS)}"
+        transaction_id = (
+            f"tx-{rng.getrandbits(64):016x}" if status in ("paid", "completed") and rng.random() < 0.7 else None
+        )
+        order = (
+            user_id, first[0], product_name, amount, first[3], pickup_code,
+            status, _timestamp(created), email, transaction_id,
+        )
+        cart = [(item[0], item[1], item[2], 1, item[3]) for item in items] if len(items) > 1 else []
+        yield order, cart
+
+
+def generate_visits(rng: random.Random, count: int, referral_codes: list, user_ids: list, now: datetime):
+    for _ in range(count):
+        visited = now - timedelta(seconds=rng.randint(0, 365 * 86400))
+        # Часть переходов — без регистрации в боте
+        user_id = rng.choice(user_ids) if rng.random() < 0.8 else None
+        yield (rng.choice(referral_codes), user_id, _timestamp(visited))
+
+
+# ============================================
+# ЗАПОЛНЕНИЕ
+# ============================================
+
+async def create_schema(db_path: str):
+    """Таблицы и индексы — как в production (init_db со всеми миграциями)"""
+    os.environ["DB_NAME"] = db_path
+    from database import init_db, close_db_pool
+    await init_db()
+    await close_db_pool()
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    now = datetime.now().replace(microsecond=0)
+    asyncio.run(create_schema(args.db))
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+
+    existing_users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    if existing_users and not args.append:
+        sys.exit(f"{args.db} уже содержит {existing_users} пользователей; для дозаписи укажите --append")
+
+    started = time.monotonic()
+    print(f"Заполнение {args.db}")
+
+    # Товары: дополняем до --products
+    existing_products = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    if existing_products < args.products:
+        rows = generate_products(rng, args.products - existing_products)
+        _insert(conn, "INSERT INTO products (name, description, price, game, subcategory) VALUES (?, ?, ?, ?, ?)",
+                rows, "products", len(rows))
+    products = conn.execute("SELECT id, name, price, game FROM products WHERE in_stock = 1").fetchall()
+
+    # Реферальные ссылки
+    codes = [f"promo{i:03d}" for i in range(args.referral_links)]
+    conn.executemany("INSERT OR IGNORE INTO referral_links (code, name) VALUES (?, ?)",
+                     [(code, f"Промо {code}") for code in codes])
+    conn.commit()
+
+    first_uid = (conn.execute("SELECT MAX(uid) FROM users").fetchone()[0] or 0) + 1
+    _insert(conn, """
+        INSERT INTO users (user_id, uid, username, first_name, balance, registered_at, last_activity, referral_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, generate_users(rng, args.users, first_uid, codes, now), "users", args.users)
+    user_ids = [USER_ID_BASE + first_uid + i for i in range(args.users)]
+
+    _insert(conn, "INSERT INTO referral_visits (referral_code, user_id, created_at) VALUES (?, ?, ?)",
+            generate_visits(rng, args.visits, codes, user_ids, now), "referral_visits", args.visits)
+
+    # Заказы и позиции корзин: id заказа нужен для order_items, поэтому
+    # пачка заказов вставляется по одному execute в общей транзакции
+    inserted = 0
+    items_inserted = 0
+    orders_started = time.monotonic()
+    for batch in _batched(generate_orders(rng, args.orders, user_ids, products, now)):
+        items = []
+        for order, cart in batch:
+            cursor = conn.execute("""
+                INSERT INTO orders (user_id, product_id, product_name, amount, game, pickup_code,
+                                    status, created_at, supercell_id, transaction_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, order)
+            items.extend((cursor.lastrowid, *item) for item in cart)
+        conn.executemany(
+            "INSERT INTO order_items (order_id, product_id, product_name, price, quantity, game) VALUES (?, ?, ?, ?, ?, ?)",
+            items
+        )
+        conn.commit()
+        inserted += len(batch)
+        items_inserted += len(items)
+        print(f"\r  orders: {inserted}/{args.orders}", end="", flush=True)
+    print(f"\r  orders: {inserted} (позиций корзин: {items_inserted}) за {time.monotonic() - orders_started:.1f} с")
+
+    print("  ANALYZE...")
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    print(f"Готово за {time.monotonic() - started:.1f} с, размер базы {os.path.getsize(args.db) / 2 ** 20:.0f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заполнение базы данными production-масштаба")
+    parser.add_argument("--db", default=None, help="файл базы (по умолчанию DB_NAME из config)")
+    parser.add_argument("--users", type=int, default=500_000)
+    parser.add_argument("--orders", type=int, default=2_000_000)
+    parser.add_argument("--visits", type=int, default=300_000, help="реферальных переходов")
+    parser.add_argument("--products", type=int, default=300)
+    parser.add_argument("--referral-links", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--append", action="store_true", help="дописать в базу с существующими пользователями")
+    args = parser.parse_args()
+
+    if args.db is None:
+        from config import DB_NAME
+        args.db = DB_NAME
+    seed(args)
+
+
+if __name__ == "__main__":
+    main()
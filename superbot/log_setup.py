@@ -0,0 +1,156 @@
+"""
+Логирование без блокировки event loop
+=====================================
+
+setup_logging() вешает на root один QueueHandler: вызов logger.info() из
+хэндлера только кладёт запись в очередь, а форматирование и запись в
+stdout/файл делает QueueListener в отдельном потоке. Логгеры uvicorn
+переводятся туда же (иначе они пишут в stderr синхронно), а его access-лог
+выключается: строку на запрос пишет само приложение, выборочно.
+
+Формат — текст (как раньше) или JSON по строке на запись (LOG_JSON=true):
+поля ts, level, logger, where, msg, exc и всё, что передано через extra=.
+
+Поток не переживает fork (gunicorn с preload_app): в дочернем процессе
+очередь и QueueListener создаются заново на тех же handler'ах.
+
+AccessLogSampler решает, писать ли строку access-лога запроса: ошибки и
+медленные запросы — всегда, остальные — с долей для маршрута.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_JSON
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+
+# Логгеры, которые uvicorn настраивает со своими синхронными handler'ами
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error")
+UVICORN_ACCESS_LOGGER = "uvicorn.access"
+
+# Атрибуты любой LogRecord; остальные пришли через extra= и попадают в JSON
+# (color_message — копия сообщения с ANSI-цветами от uvicorn)
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "color_message"}
+
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "where": f"{record.filename}:{record.lineno}",
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LoopQueueHandler(QueueHandler):
+    """
+    QueueHandler без форматирования в вызывающем потоке: подставляем только
+    аргументы сообщения, traceback форматирует поток QueueListener
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level, log_file: str = None):
+    """Настроить root-логгер процесса (повторный вызов ничего не делает)"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = _LoopQueueHandler(log_queue)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    for name in UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    access_logger = logging.getLogger(UVICORN_ACCESS_LOGGER)
+    access_logger.handlers.clear()
+    access_logger.propagate = False
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    os.register_at_fork(after_in_child=_restart_listener)
+    # Дописать очередь при выходе процесса
+    atexit.register(_stop_listener)
+
+
+def _restart_listener():
+    """После fork: своя очередь и поток записи в дочернем процессе"""
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    _listener.stop()
+
+
+class AccessLogSampler:
+    """
+    Доля записываемых строк access-лога по шаблону маршрута.
+    Ответы >= 400 и запросы дольше slow_seconds пишутся всегда.
+    """
+
+    def __init__(self, default_rate: float = 1.0, route_rates: dict = None, slow_seconds: float = 1.0):
+        self.default_rate = default_rate
+        self.route_rates = route_rates or {}
+        self.slow_seconds = slow_seconds
+
+    @classmethod
+    def from_spec(cls, default_rate: float, spec: str, slow_seconds: float):
+        """spec: "/api/products=0.01,/api/img/{image_path:path}=0" """
+        route_rates = {}
+        for item in spec.split(","):
+            route, sep, rate = item.strip().rpartition("=")
+            if sep and route:
+                route_rates[route.strip()] = float(rate)
+        return cls(default_rate, route_rates, slow_seconds)
+
+    def should_log(self, route: str, status: int, duration: float) -> bool:
+        if status >= 400 or duration >= self.slow_seconds:
+            return True
+        rate = self.route_rates.get(route, self.default_rate)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
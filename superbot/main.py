@@ -2,16 +2,26 @@ import asyncio
 import logging
 import os
 from pathlib import Path
-from collections import defaultdict
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart
-from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, CallbackQuery, ErrorEvent
 from aiogram.exceptions import TelegramRetryAfter
-from config import BOT_TOKEN
-from database import init_db, get_or_create_user, register_referral_visit, get_referral_link_by_code
+from config import (
+    BOT_TOKEN, TELEGRAM_API_URL, BOT_MODE, BOT_WEBHOOK_HOST, BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH, BOT_WEBHOOK_WORKERS,
+    BOT_METRICS_HOST, BOT_METRICS_PORT, BOT_METRICS_DIR
+)
+from database import init_db, close_db_pool, get_or_create_user, register_referral_visit, get_referral_link_by_code
 from keyboards import get_main_menu, get_back_to_menu
+from media_registry import send_cached_photo
+from message_render import render_screen, remember_screen
+from throttling import throttling_middleware
+from fsm_storage import SQLiteStorage
+from update_scheduler import ScheduledDispatcher
+from bot_metrics import TelegramRequestMetrics, handler_metrics_middleware
+from metrics import prepare_multiprocess_dir, start_metrics_server
+from log_setup import setup_logging
 from handlers import profile, support, reviews, products, shop, news, categories, admin, purchase, orders_admin, miniapp
 from miniapp.wata_payment import WataPaymentClient
 
@@ -23,15 +33,8 @@ BASE_DIR = Path(__file__).parent
 # Настройка логирования (production-friendly)
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_TO_FILE = os.getenv("BOT_LOG_TO_FILE", "false").lower() == "true"
-log_handlers = [logging.StreamHandler()]
-if LOG_TO_FILE:
-    log_handlers.append(logging.FileHandler('/tmp/bot_debug.log', encoding='utf-8'))
-
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=log_handlers
-)
+# Запись логов — в фоновом потоке (log_setup.py), не в event loop
+setup_logging(getattr(logging, LOG_LEVEL, logging.INFO), '/tmp/bot_debug.log' if LOG_TO_FILE else None)
 
 # DEBUG для aiogram только в debug-режиме
 if LOG_LEVEL == "DEBUG":
@@ -40,29 +43,6 @@ if LOG_LEVEL == "DEBUG":
 
 logger = logging.getLogger(__name__)
 
-# Rate Limiting - защита от спама
-_rate_limit_storage = defaultdict(list)
-RATE_LIMIT_MESSAGES = 30  # Максимум сообщений
-RATE_LIMIT_PERIOD = 60  # За период в секундах
-
-
-def check_rate_limit(user_id: int) -> bool:
-    """Проверка лимита запросов пользователя"""
-    now = datetime.now()
-    # Очищаем старые запросы
-    _rate_limit_storage[user_id] = [
-        timestamp for timestamp in _rate_limit_storage[user_id]
-        if now - timestamp < timedelta(seconds=RATE_LIMIT_PERIOD)
-    ]
-
-    # Проверяем лимит
-    if len(_rate_limit_storage[user_id]) >= RATE_LIMIT_MESSAGES:
-        return False
-
-    # Добавляем текущий запрос
-    _rate_limit_storage[user_id].append(now)
-    return True
-
 
 async def send_with_retry(coro_func, max_retries: int = 3):
     """
@@ -85,9 +65,27 @@ async def send_with_retry(coro_func, max_retries: int = 3):
                 raise
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+if TELEGRAM_API_URL:
+    # Свой Bot API сервер (нагрузочные тесты с loadtest/fake_telegram.py)
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+# Время и статусы (в т.ч. 429) всех запросов к Bot API
+bot.session.middleware(TelegramRequestMetrics())
+# Состояния FSM в SQLite: сценарии переживают перезапуск бота
+storage = SQLiteStorage()
+# Обновления одного чата — по очереди, разных чатов — параллельно (с общим лимитом)
+dp = ScheduledDispatcher(storage=storage)
+# Пул БД закрывается последним: после сохранения состояний FSM
+dp.shutdown.register(close_db_pool)
+
+# Rate limiting - защита от спама: все сообщения и callback'и до хэндлеров
+dp.message.outer_middleware(throttling_middleware)
+dp.callback_query.outer_middleware(throttling_middleware)
+
+# Время каждого хэндлера (inner middleware действует и на роутеры handlers/)
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
 
 
 @dp.message(CommandStart())
@@ -96,12 +94,6 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     logger.info(f"START command from user {user_id} (@{message.from_user.username})")
 
-    # Проверка rate limit
-    if not check_rate_limit(user_id):
-        logger.warning(f"Rate limit exceeded for user {user_id}")
-        await message.answer("Вы отправляете запросы слишком часто. Пожалуйста, подождите минуту.")
-        return
-
     try:
         # Получаем или создаем пользователя
         username = message.from_user.username or ""
@@ -132,18 +124,19 @@ async def cmd_start(message: Message):
 
     try:
         if photo_path.exists():
-            photo = FSInputFile(str(photo_path))
-            await send_with_retry(lambda: message.answer_photo(
+            sent = await send_with_retry(lambda: send_cached_photo(photo_path, lambda photo: message.answer_photo(
                 photo=photo,
                 caption=caption_text,
                 reply_markup=get_main_menu()
-            ))
+            )))
+            remember_screen(sent, caption_text, get_main_menu(), photo=photo_path)
         else:
             # Если файл не найден, отправляем без фото
-            await send_with_retry(lambda: message.answer(
+            sent = await send_with_retry(lambda: message.answer(
                 text=caption_text,
                 reply_markup=get_main_menu()
             ))
+            remember_screen(sent, caption_text, get_main_menu())
     except TelegramRetryAfter:
         logger.error(f"Failed to send start message to {user_id} after retries")
         # Молча пропускаем — пользователь просто не получит приветствие
@@ -152,11 +145,6 @@ async def cmd_start(message: Message):
 @dp.callback_query(F.data == "main_menu")
 async def back_to_menu(callback: CallbackQuery):
     """Возврат в главное меню"""
-    # Проверка rate limit
-    if not check_rate_limit(callback.from_user.id):
-        await callback.answer("Слишком много запросов. Подождите минуту.", show_alert=True)
-        return
-
     caption_text = ("👋 Приветствуем тебя в Supercell Shop!\n\n"
                     "Самые низкие цены и безопасный донат ждут тебя!\n"
                     "Воспользуйся кнопками ниже 👇")
@@ -164,32 +152,17 @@ async def back_to_menu(callback: CallbackQuery):
     photo_path = BASE_DIR / "main.png"
 
     try:
-        # Пытаемся отредактировать caption (если это уже фото)
-        await send_with_retry(lambda: callback.message.edit_caption(
-            caption=caption_text,
-            reply_markup=get_main_menu()
+        # Один вызов edit_* (или ни одного, если меню уже показано)
+        await send_with_retry(lambda: render_screen(
+            callback.message,
+            caption_text,
+            get_main_menu(),
+            photo=photo_path if photo_path.exists() else None
         ))
     except TelegramRetryAfter:
-        logger.warning(f"Flood control on edit_caption for user {callback.from_user.id}")
+        logger.warning(f"Flood control on main menu render for user {callback.from_user.id}")
     except Exception as e:
-        # Если не получилось (сообщение без фото), используем edit_media
-        try:
-            if photo_path.exists():
-                photo = FSInputFile(str(photo_path))
-                await send_with_retry(lambda: callback.message.edit_media(
-                    media=InputMediaPhoto(media=photo, caption=caption_text),
-                    reply_markup=get_main_menu()
-                ))
-            else:
-                # Если фото не найдено, просто редактируем текст
-                await send_with_retry(lambda: callback.message.edit_text(
-                    text=caption_text,
-                    reply_markup=get_main_menu()
-                ))
-        except TelegramRetryAfter:
-            logger.warning(f"Flood control on edit_media for user {callback.from_user.id}")
-        except Exception as inner_e:
-            logger.error(f"Ошибка при возврате в меню: {inner_e}")
+        logger.error(f"Ошибка при возврате в меню: {e}")
 
     try:
         await callback.answer()
@@ -198,16 +171,34 @@ async def back_to_menu(callback: CallbackQuery):
 
 
 @dp.errors()
-async def errors_handler(event, exception):
+async def errors_handler(event: ErrorEvent):
     """Глобальный обработчик ошибок"""
+    exception = event.exception
     if isinstance(exception, TelegramRetryAfter):
         logger.warning(f"Telegram flood control: retry in {exception.retry_after}s")
         # Ждём и не падаем — просто пропускаем этот запрос
         return True
-    logger.error(f"Unhandled exception: {exception}", exc_info=True)
+    logger.error(f"Unhandled exception: {exception}", exc_info=exception)
     return True
 
 
+def setup_dispatcher():
+    """Регистрация роутеров (один раз на процесс; общее для polling и webhook)"""
+    if dp.sub_routers:
+        return
+    dp.include_router(admin.router)  # Админ-панель первой
+    dp.include_router(orders_admin.router)  # Управление заказами
+    dp.include_router(purchase.router)  # Покупка товаров
+    dp.include_router(miniapp.router)  # Mini App
+    dp.include_router(shop.router)
+    dp.include_router(categories.router)
+    dp.include_router(profile.router)
+    dp.include_router(support.router)
+    dp.include_router(reviews.router)
+    dp.include_router(news.router)
+    dp.include_router(products.router)
+
+
 async def main():
     """Главная функция запуска бота"""
     try:
@@ -217,31 +208,55 @@ async def main():
         logger.info("База данных инициализирована успешно!")
 
         # Регистрация роутеров
-        dp.include_router(admin.router)  # Админ-панель первой
-        dp.include_router(orders_admin.router)  # Управление заказами
-        dp.include_router(purchase.router)  # Покупка товаров
-        dp.include_router(miniapp.router)  # Mini App
-        dp.include_router(shop.router)
-        dp.include_router(categories.router)
-        dp.include_router(profile.router)
-        dp.include_router(support.router)
-        dp.include_router(reviews.router)
-        dp.include_router(news.router)
-        dp.include_router(products.router)
+        setup_dispatcher()
 
         logger.info("Бот запущен! Готов обрабатывать 1000+ запросов в минуту")
         logger.info("Активированы оптимизации:")
         logger.info("  - Пул соединений к БД (20 подключений)")
         logger.info("  - Кэширование данных пользователей и товаров")
-        logger.info("  - Rate limiting (30 запросов/минуту на пользователя)")
+        logger.info("  - Rate limiting (throttling middleware для всех хэндлеров)")
         logger.info("  - WAL режим SQLite для параллельной работы")
+        logger.info(
+            f"  - Очереди обновлений по чатам (до {dp.scheduler.max_in_flight} хэндлеров одновременно)"
+        )
+
+        if BOT_METRICS_PORT:
+            start_metrics_server(BOT_METRICS_PORT, BOT_METRICS_HOST)
+            logger.info(f"  - Метрики Prometheus: http://{BOT_METRICS_HOST}:{BOT_METRICS_PORT}/metrics")
+
+        # Если раньше работал webhook-режим, getUpdates будет конфликтовать с ним
+        await bot.delete_webhook(drop_pending_updates=False)
 
-        # Запуск бота
-        await dp.start_polling(bot)
+        # Запуск бота. Параллельность обеспечивает ScheduledDispatcher:
+        # polling только раскладывает обновления по очередям чатов
+        await dp.start_polling(bot, handle_as_tasks=False)
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
         raise
 
 
+def run_webhook():
+    """Webhook-режим: ASGI-приложение bot_webhook:app в нескольких worker'ах"""
+    import uvicorn
+    # Worker'ы uvicorn — новые процессы: каталог метрик должен быть в окружении до их запуска
+    prepare_multiprocess_dir(BOT_METRICS_DIR)
+    logger.info(
+        f"Webhook mode: {BOT_WEBHOOK_HOST}:{BOT_WEBHOOK_PORT}{BOT_WEBHOOK_PATH}, "
+        f"workers={BOT_WEBHOOK_WORKERS}"
+    )
+    uvicorn.run(
+        "bot_webhook:app",
+        host=BOT_WEBHOOK_HOST,
+        port=BOT_WEBHOOK_PORT,
+        workers=BOT_WEBHOOK_WORKERS,
+        log_level=LOG_LEVEL.lower(),
+        # Строка на каждый webhook Telegram — лишняя запись в горячем пути; ошибки пишет приложение
+        access_log=False
+    )
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
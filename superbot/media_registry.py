@@ -0,0 +1,97 @@
+"""
+Реестр file_id для локальных картинок бота
+==========================================
+
+Меню и категории показывают одни и те же картинки (main.png, royale.png,
+картинки категорий). Через FSInputFile бот заново загружал их в Telegram
+на каждый клик. Теперь картинка загружается один раз, а её file_id
+сохраняется в таблице media_files — дальше отправляется только строка.
+
+Ключ — путь относительно папки бота и sha256 содержимого, поэтому
+заменённая картинка загрузится заново автоматически.
+"""
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from database import get_media_file_ids, save_media_file_id, delete_media_file_id
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).parent
+
+# (path, content_hash) -> file_id; загружается из БД при первом обращении
+_file_ids: dict = {}
+_loaded = False
+# путь -> (mtime, size, content_hash): не хэшируем файл на каждый клик
+_hashes: dict = {}
+
+
+def media_key(path) -> tuple[str, str]:
+    """(путь относительно бота, sha256 содержимого)"""
+    path = Path(path)
+    stat = path.stat()
+    cached = _hashes.get(str(path))
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        content_hash = cached[2]
+    else:
+        content_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+        _hashes[str(path)] = (stat.st_mtime_ns, stat.st_size, content_hash)
+
+    try:
+        rel_path = os.path.relpath(path, BASE_DIR)
+    except ValueError:
+        rel_path = str(path)
+    return rel_path, content_hash
+
+
+async def _load():
+    global _loaded
+    if not _loaded:
+        _file_ids.update(await get_media_file_ids())
+        _loaded = True
+
+
+def _photo_file_id(result) -> str | None:
+    """file_id самого большого размера из отправленного сообщения"""
+    if isinstance(result, Message) and result.photo:
+        return result.photo[-1].file_id
+    return None
+
+
+async def send_cached_photo(path, send):
+    """
+    Отправить локальную картинку, по возможности без повторной загрузки.
+
+    send(photo) — функция, которая отправляет/редактирует сообщение с photo
+    (file_id или FSInputFile) и возвращает результат вызова Bot API.
+    """
+    await _load()
+    key = media_key(path)
+
+    file_id = _file_ids.get(key)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest as e:
+            # file_id больше не принимается (например, сменился бот) — загружаем заново.
+            # Прочие ошибки (message is not modified и т.п.) пробрасываем как есть.
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {key[0]} rejected, re-uploading: {e}")
+            _file_ids.pop(key, None)
+            await delete_media_file_id(*key)
+
+    result = await send(FSInputFile(str(path)))
+
+    file_id = _photo_file_id(result)
+    if file_id:
+        _file_ids[key] = file_id
+        await save_media_file_id(key[0], key[1], file_id)
+        logger.info(f"Uploaded {key[0]} to Telegram, file_id cached")
+    return result
@@ -0,0 +1,154 @@
+"""
+Перерисовка экранов бота одним вызовом Telegram API
+===================================================
+
+Раньше обработчики перебирали edit_caption → edit_media → edit_text и
+глотали ошибки ("message is not modified", "there is no caption in the
+message to edit"), делая 2-3 запроса к Telegram на один клик.
+
+render_screen() знает тип текущего сообщения (фото или текст — из самого
+callback.message) и хэш последнего отрисованного состояния, поэтому:
+- ничего не изменилось        → вызова нет
+- та же картинка, другой текст → edit_caption
+- другая картинка              → edit_media
+- текстовое сообщение          → edit_text
+
+Какая картинка в сообщении, хранится в памяти процесса по
+(chat_id, message_id) вместе с хэшем текста и клавиатуры. Если сообщение
+правили в обход render_screen (или бот перезапускался), картинка считается
+неизвестной и следующий экран с картинкой делает edit_media.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InputMediaPhoto, Message
+
+from media_registry import media_key, send_cached_photo
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений помнить (старые вытесняются первыми)
+MAX_TRACKED_MESSAGES = 10000
+
+# (chat_id, message_id) -> (photo_key, render_hash).
+# photo_key — какая картинка сейчас в сообщении (None — текстовое сообщение,
+# UNKNOWN_PHOTO — фото есть, но какое — неизвестно), render_hash — текст и клавиатура
+_rendered: OrderedDict = OrderedDict()
+
+UNKNOWN_PHOTO = "<unknown>"
+
+# Счётчики для логов/метрик
+render_stats = {"skipped": 0, "edit_caption": 0, "edit_media": 0, "edit_text": 0}
+
+
+def _photo_key(photo):
+    """Ключ картинки: (путь, sha256) для локального файла, иначе сам file_id"""
+    if photo is None:
+        return None
+    if isinstance(photo, Path):
+        return media_key(photo)
+    return str(photo)
+
+
+def _markup_dump(reply_markup) -> str:
+    if reply_markup is None:
+        return ""
+    return reply_markup.model_dump_json(exclude_none=True)
+
+
+def _render_hash(text: str, reply_markup) -> str:
+    # Telegram обрезает пробелы по краям текста — сравниваем без них
+    payload = f"{text.strip()}\x00{_markup_dump(reply_markup)}"
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _message_key(message: Message) -> tuple:
+    return message.chat.id, message.message_id
+
+
+def _remember(message: Message, photo_key, render_hash: str):
+    key = _message_key(message)
+    _rendered[key] = (photo_key, render_hash)
+    _rendered.move_to_end(key)
+    while len(_rendered) > MAX_TRACKED_MESSAGES:
+        _rendered.popitem(last=False)
+
+
+def remember_screen(message: Message, text: str, reply_markup: InlineKeyboardMarkup = None, photo=None):
+    """Запомнить только что отправленное сообщение (answer_photo / answer)"""
+    if not isinstance(message, Message):
+        return
+    photo_key = None
+    if message.photo:
+        photo_key = _photo_key(photo) or UNKNOWN_PHOTO
+    _remember(message, photo_key, _render_hash(text, reply_markup))
+
+
+def forget_screen(message: Message):
+    """Забыть состояние сообщения (после ручного edit_* в обход render_screen)"""
+    _rendered.pop(_message_key(message), None)
+
+
+async def render_screen(message: Message, text: str, reply_markup: InlineKeyboardMarkup = None, photo=None):
+    """
+    Показать экран (text + reply_markup [+ photo]) в существующем сообщении.
+
+    photo — Path к локальной картинке (через реестр file_id) или file_id;
+    None — оставить картинку, которая уже есть.
+    Делает не больше одного вызова edit_* (плюс повторная загрузка картинки,
+    если сохранённый file_id отклонён). Ошибки Telegram, кроме
+    "message is not modified", пробрасываются.
+    """
+    is_photo_message = bool(message.photo)
+    if not is_photo_message:
+        # В текстовое сообщение картинку не вставить — показываем текст
+        photo = None
+
+    photo_key = _photo_key(photo)
+    render_hash = _render_hash(text, reply_markup)
+
+    # Текст и клавиатура видны в самом callback.message; сохранённое состояние
+    # нужно, чтобы знать, какая картинка в сообщении. Если сообщение с тех пор
+    # правили в обход render_screen, хэши не совпадут и картинка считается неизвестной.
+    current_text = message.caption if is_photo_message else message.text
+    current_hash = _render_hash(current_text or "", message.reply_markup)
+    current_photo = UNKNOWN_PHOTO if is_photo_message else None
+    known = _rendered.get(_message_key(message))
+    if known is not None and known[1] == current_hash:
+        current_photo = known[0]
+
+    same_photo = photo is None or current_photo == photo_key
+    if same_photo and current_hash == render_hash:
+        render_stats["skipped"] += 1
+        _remember(message, current_photo, render_hash)
+        return None
+
+    try:
+        if not is_photo_message:
+            render_stats["edit_text"] += 1
+            result = await message.edit_text(text=text, reply_markup=reply_markup)
+        elif same_photo:
+            render_stats["edit_caption"] += 1
+            result = await message.edit_caption(caption=text, reply_markup=reply_markup)
+        else:
+            render_stats["edit_media"] += 1
+            edit = lambda media: message.edit_media(
+                media=InputMediaPhoto(media=media, caption=text),
+                reply_markup=reply_markup
+            )
+            if isinstance(photo, Path):
+                result = await send_cached_photo(photo, edit)
+            else:
+                result = await edit(photo)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            forget_screen(message)
+            raise
+        result = None
+
+    _remember(message, current_photo if same_photo else photo_key, render_hash)
+    return result
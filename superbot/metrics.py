@@ -0,0 +1,208 @@
+"""
+Метрики Prometheus
+==================
+
+Общие для API Mini App и бота: все метрики объявлены здесь, модули только
+увеличивают счётчики. Экспорт:
+
+- API: GET /metrics (miniapp/api.py) — только с localhost или с admin_key
+- бот, polling: отдельный HTTP-сервер на BOT_METRICS_PORT (127.0.0.1)
+- бот, webhook: GET /metrics на BOT_WEBHOOK_PORT (bot_webhook.py)
+
+Несколько worker'ов (gunicorn у API, uvicorn у webhook-бота): каждый пишет
+свои значения в файлы каталога PROMETHEUS_MULTIPROC_DIR, а /metrics любого
+worker'а отдаёт сумму по всем (prometheus_client multiprocess mode).
+Каталог задаёт процесс, запускающий worker'ов, ещё до импорта этого модуля:
+miniapp/gunicorn.conf.py (API_METRICS_DIR) и main.run_webhook (BOT_METRICS_DIR).
+Без PROMETHEUS_MULTIPROC_DIR метрики живут в памяти единственного процесса.
+
+Доли попаданий в кэши, 429 и т.п. считаются уже в Prometheus (см. README).
+"""
+
+import os
+import shutil
+import time
+from urllib.parse import urlsplit
+
+import httpx
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+# Границы гистограмм (секунды)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+OUTBOUND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+# Время хэндлеров и ожидания в очереди чата у бота
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CHECKER_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+# ===== HTTP (API Mini App) =====
+HTTP_REQUESTS = Counter(
+    "supercell_http_requests_total", "HTTP-запросы к API", ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "supercell_http_request_duration_seconds", "Время ответа API по шаблону маршрута",
+    ["method", "route", "status"], buckets=HTTP_BUCKETS
+)
+HTTP_IN_PROGRESS = Gauge(
+    "supercell_http_requests_in_progress", "Запросы, обрабатываемые сейчас", multiprocess_mode="livesum"
+)
+RATE_LIMITED = Counter(
+    "supercell_rate_limited_total", "Запросы, отклонённые лимитером", ["limiter"]
+)
+
+# ===== КЭШИ =====
+CACHE_REQUESTS = Counter(
+    "supercell_cache_requests_total", "Обращения к кэшам", ["cache", "result"]
+)
+
+# ===== БАЗА ДАННЫХ =====
+DB_POOL_WAIT = Histogram(
+    "supercell_db_pool_wait_seconds", "Ожидание соединения из пула", buckets=DB_WAIT_BUCKETS
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    "supercell_db_connections_in_use", "Занятые соединения с БД (pool — из пула, direct — get_db())",
+    ["kind"], multiprocess_mode="livesum"
+)
+DB_RETRIES = Counter(
+    "supercell_db_retries_total", "Повторы запросов после блокировки БД или конфликта", ["reason"]
+)
+DB_SLOW_QUERIES = Counter(
+    "supercell_db_slow_queries_total", "SQL-запросы дольше SLOW_QUERY_MS (см. query_stats.py)"
+)
+
+# ===== ПРОВЕРКА ПЛАТЕЖЕЙ =====
+CHECKER_CYCLE = Histogram(
+    "supercell_payment_checker_cycle_seconds", "Длительность цикла проверки платежей", buckets=CHECKER_BUCKETS
+)
+CHECKER_BACKLOG = Gauge(
+    "supercell_payment_checker_backlog", "Незавершённые платежи в последнем цикле", multiprocess_mode="livemax"
+)
+CHECKER_LAST_CYCLE = Gauge(
+    "supercell_payment_checker_last_cycle_timestamp_seconds", "Время окончания последнего цикла",
+    multiprocess_mode="livemax"
+)
+CHECKER_ORDERS = Counter(
+    "supercell_payment_checker_orders_total", "Результаты проверки заказов", ["result"]
+)
+
+# ===== ИСХОДЯЩИЕ ЗАПРОСЫ (Telegram, wata.pro) =====
+OUTBOUND_LATENCY = Histogram(
+    "supercell_outbound_request_duration_seconds", "Время исходящих запросов",
+    ["service", "method"], buckets=OUTBOUND_BUCKETS
+)
+OUTBOUND_RESPONSES = Counter(
+    "supercell_outbound_responses_total", "Ответы внешних API по статусу (error — сетевая ошибка)",
+    ["service", "method", "status"]
+)
+
+# ===== БОТ =====
+BOT_UPDATES = Counter(
+    "supercell_bot_updates_total", "Обновления бота", ["result"]
+)
+BOT_UPDATE_WAIT = Histogram(
+    "supercell_bot_update_wait_seconds", "Ожидание обновления в очереди чата", buckets=LATENCY_BUCKETS
+)
+BOT_UPDATE_LATENCY = Histogram(
+    "supercell_bot_update_duration_seconds", "Обработка обновления целиком", buckets=LATENCY_BUCKETS
+)
+BOT_HANDLER_LATENCY = Histogram(
+    "supercell_bot_handler_duration_seconds", "Время хэндлера бота", ["handler", "status"], buckets=LATENCY_BUCKETS
+)
+BOT_UPDATES_IN_FLIGHT = Gauge(
+    "supercell_bot_updates_in_flight", "Выполняющиеся хэндлеры", multiprocess_mode="livesum"
+)
+BOT_UPDATES_QUEUED = Gauge(
+    "supercell_bot_updates_queued", "Обновления в очередях чатов", multiprocess_mode="livesum"
+)
+
+
+# ============================================
+# ЭКСПОРТ
+# ============================================
+
+def prepare_multiprocess_dir(path: str):
+    """
+    Очистить каталог метрик worker'ов перед их запуском и передать его
+    worker'ам через окружение (файлы прошлого запуска исказили бы счётчики)
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def _registry():
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Текст для /metrics и его Content-Type"""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """HTTP-сервер /metrics в фоновом потоке (для процесса без своего HTTP)"""
+    start_http_server(port, addr=host, registry=_registry())
+
+
+def is_local_client(host: str) -> bool:
+    return host in ("127.0.0.1", "::1", "localhost")
+
+
+# ============================================
+# ИСХОДЯЩИЕ ЗАПРОСЫ
+# ============================================
+
+def outbound_method(service: str, url: str) -> str:
+    """
+    Имя вызова для метки method: метод Bot API или путь wata без id.
+    Токен бота и идентификаторы в метки не попадают.
+    """
+    parts = [part for part in urlsplit(str(url)).path.split("/") if part]
+    if service == "telegram":
+        if parts and parts[0] == "file":
+            return "file"
+        return parts[-1] if len(parts) >= 2 else "unknown"
+    if "h2h" in parts:
+        parts = parts[parts.index("h2h") + 1:]
+    return "/".join(":id" if any(char.isdigit() for char in part) else part for part in parts) or "/"
+
+
+def observe_outbound(service: str, method: str, status, duration: float):
+    OUTBOUND_LATENCY.labels(service, method).observe(duration)
+    OUTBOUND_RESPONSES.labels(service, method, str(status)).inc()
+
+
+class OutboundTransport(httpx.AsyncHTTPTransport):
+    """Транспорт httpx, который замеряет каждый запрос к внешнему сервису"""
+
+    def __init__(self, service: str, **kwargs):
+        super().__init__(**kwargs)
+        self.service = service
+
+    async def handle_async_request(self, request):
+        method = outbound_method(self.service, request.url)
+        started = time.monotonic()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            observe_outbound(self.service, method, "error", time.monotonic() - started)
+            raise
+        observe_outbound(self.service, method, response.status_code, time.monotonic() - started)
+        return response
@@ -7,22 +7,22 @@ from fastapi import FastAPI, HTTPException, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
 from pydantic import BaseModel, Field, field_validator
 from contextlib import asynccontextmanager
 import re
 import sys
 import os
-import aiohttp
-from io import BytesIO
 import logging
 import time
 import httpx
 import hashlib
 import hmac
 import asyncio
+import json
 from urllib.parse import parse_qsl, unquote
 import fcntl
+import orjson
 
 ENABLE_PAYMENT_CHECKER = os.getenv("ENABLE_PAYMENT_CHECKER", "false").lower() == "true"
 ENABLE_DEBUG_ENDPOINTS = os.getenv("ENABLE_DEBUG_ENDPOINTS", "false").lower() == "true"
@@ -55,21 +55,29 @@ IS_PRODUCTION = os.getenv("PRODUCTION", "false").lower() == "true"
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "").strip()
 API_LOG_TO_FILE = os.getenv("API_LOG_TO_FILE", "false").lower() == "true"
 PAYMENT_CHECKER_LOCK_PATH = os.getenv("PAYMENT_CHECKER_LOCK_PATH", "/tmp/supercell_payment_checker.lock")
+PREFETCH_PRODUCT_IMAGES = os.getenv("PREFETCH_PRODUCT_IMAGES", "true").lower() == "true"
+PREFETCH_LOCK_PATH = os.getenv("PREFETCH_LOCK_PATH", "/tmp/supercell_image_prefetch.lock")
 
-# Настройка логирования для production
-LOG_LEVEL = logging.INFO if IS_PRODUCTION else logging.DEBUG
-LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+# Добавляем родительскую директорию в путь для импорта database
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-log_handlers = [logging.StreamHandler()]
-if API_LOG_TO_FILE:
-    log_handlers.append(logging.FileHandler('/tmp/api_debug.log', encoding='utf-8'))
+from log_setup import AccessLogSampler, setup_logging
 
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format=LOG_FORMAT,
-    handlers=log_handlers
-)
+# Настройка логирования для production (запись — в фоновом потоке, см. log_setup.py)
+LOG_LEVEL = logging.INFO if IS_PRODUCTION else logging.DEBUG
+setup_logging(LOG_LEVEL, '/tmp/api_debug.log' if API_LOG_TO_FILE else None)
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("access")
+
+# Доля записываемых строк access-лога: по умолчанию и по шаблонам маршрутов
+# ("/api/products=0.01,/api/img/{image_path:path}=0"). Ответы >= 400 и
+# запросы дольше ACCESS_LOG_SLOW_MS пишутся всегда
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", 0.05 if IS_PRODUCTION else 1.0))
+ACCESS_LOG_ROUTE_RATES = os.getenv("ACCESS_LOG_ROUTE_RATES", "")
+ACCESS_LOG_SLOW_MS = float(os.getenv("ACCESS_LOG_SLOW_MS", 1000))
+access_log_sampler = AccessLogSampler.from_spec(
+    ACCESS_LOG_SAMPLE_RATE, ACCESS_LOG_ROUTE_RATES, ACCESS_LOG_SLOW_MS / 1000
+)
 
 if INVALID_PAYMENT_CHECKER_MODE:
     logger.warning(
@@ -85,13 +93,11 @@ if ENABLE_PAYMENT_CHECKER and not PAYMENT_CHECKER_MODE_ENV and (
         "Using monitor mode for safety."
     )
 
-# Добавляем родительскую директорию в путь для импорта database
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
 from database import (
     get_user_full_stats,
     get_products_by_game_and_subcategory,
     get_product_by_id,
+    get_products_by_ids,
     create_order_without_balance,
     create_order,
     get_all_products_admin,
@@ -102,9 +108,52 @@ from database import (
     save_payment_transaction,
     get_order_by_transaction_id,
     get_user_orders,
-    get_order_by_id
+    get_order_by_id,
+    get_order_events_after,
+    get_last_order_event_id,
+    get_product_image_file_ids,
+    get_idempotency_record,
+    reserve_idempotency_key,
+    complete_idempotency_key,
+    release_idempotency_key,
+    delete_expired_idempotency_keys,
+    get_db_pool,
+    close_db_pool
 )
-from config import BOT_TOKEN, ADMIN_IDS, SUPPORT_URL
+from config import BOT_TOKEN, ADMIN_IDS, SUPPORT_URL, TELEGRAM_API_URL
+from order_events import broker as order_events, OrderEvent
+from media_cache import (
+    AvatarCache,
+    ProductImageStore,
+    TelegramFileError,
+    accel_redirect_path,
+    close_session as close_media_session
+)
+from image_variants import (
+    PRODUCT_DETAIL_WIDTH,
+    PRODUCT_LIST_WIDTH,
+    get_variant,
+    negotiate_format,
+    pick_width,
+    resolve_source,
+    variant_url
+)
+from rate_limit import GCRALimiter, MemoryStore, SharedMemoryStore, default_shared_path
+from metrics import (
+    CACHE_REQUESTS,
+    CHECKER_BACKLOG,
+    CHECKER_CYCLE,
+    CHECKER_LAST_CYCLE,
+    CHECKER_ORDERS,
+    HTTP_IN_PROGRESS,
+    HTTP_LATENCY,
+    HTTP_REQUESTS,
+    RATE_LIMITED,
+    OutboundTransport,
+    is_local_client,
+    render_metrics
+)
+from query_stats import query_report
 
 
 #============================================
@@ -140,10 +189,10 @@ def ensure_debug_access(admin_key: str | None):
     ensure_admin_access(admin_key)
 
 
-def acquire_payment_checker_lock() -> int | None:
+def acquire_payment_checker_lock(lock_path: str = PAYMENT_CHECKER_LOCK_PATH) -> int | None:
     """Берем межпроцессный lock, чтобы checker запускался в одном worker."""
     try:
-        fd = os.open(PAYMENT_CHECKER_LOCK_PATH, os.O_CREAT | os.O_RDWR, 0o644)
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
         fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
         return fd
     except BlockingIOError:
@@ -182,14 +231,17 @@ async def check_pending_payments_task():
     client = WataPaymentClient()
 
     while payment_checker_running:
+        cycle_started = time.monotonic()
         paid_detected = 0
         declined_detected = 0
         paid_synced = 0
         declined_synced = 0
+        check_errors = 0
 
         try:
             # Получаем список незавершённых платежей из базы
             pending = await get_pending_payments()
+            CHECKER_BACKLOG.set(len(pending))
 
             if pending:
                 logger.info(f"Checking {len(pending)} pending payments...")
@@ -214,7 +266,7 @@ async def check_pending_payments_task():
                                     continue
 
                                 # Обновляем статус заказа
-                                await update_order_payment_status(order_id, "paid")
+                                await apply_order_status(order_id, "paid", "checker")
                                 logger.info(f"Order {order_id} marked as paid via checker")
                                 paid_synced += 1
 
@@ -264,16 +316,25 @@ async def check_pending_payments_task():
                                     declined_detected += 1
                                     continue
 
-                                await update_order_payment_status(order_id, "payment_failed")
+                                await apply_order_status(order_id, "payment_failed", "checker")
                                 logger.info(f"Order {order_id} payment declined via checker")
                                 declined_synced += 1
 
                     except Exception as e:
+                        check_errors += 1
                         logger.error(f"Error checking order {order_id}: {e}")
 
         except Exception as e:
             logger.error(f"Payment checker error: {e}", exc_info=True)
         finally:
+            CHECKER_CYCLE.observe(time.monotonic() - cycle_started)
+            CHECKER_LAST_CYCLE.set(time.time())
+            for result, count in (
+                ("paid_detected", paid_detected), ("declined_detected", declined_detected),
+                ("paid_synced", paid_synced), ("declined_synced", declined_synced), ("error", check_errors)
+            ):
+                if count:
+                    CHECKER_ORDERS.labels(result).inc(count)
             if paid_detected or declined_detected:
                 logger.warning(
                     "Checker monitor mode: detected paid=%s declined=%s, no status changes applied",
@@ -293,50 +354,205 @@ async def check_pending_payments_task():
     logger.info("Payment checker task stopped")
 
 
+#============================================
+#ЧТЕНИЕ ЖУРНАЛА ЗАКАЗОВ (order_events)
+#============================================
+
+# Как часто опрашивать журнал, если этот worker ничего не менял
+ORDER_EVENTS_POLL_INTERVAL = float(os.getenv("ORDER_EVENTS_POLL_INTERVAL", 1.0))
+ORDER_EVENTS_BATCH = 500
+
+
+async def order_events_tail_task():
+    """
+    Читает журнал order_events и публикует события в broker этого worker'а.
+
+    Журнал общий для бота и всех worker'ов, поэтому открытые Mini App
+    получают изменения независимо от того, какой процесс их сделал.
+    Курсор в памяти: после рестарта live-потоку нужны только новые события.
+    """
+    last_id = await get_last_order_event_id()
+    order_events.last_id = last_id
+
+    while True:
+        try:
+            events = await get_order_events_after(last_id, ORDER_EVENTS_BATCH)
+            for event in events:
+                order_events.publish(OrderEvent(**event))
+                last_id = event["id"]
+            if len(events) == ORDER_EVENTS_BATCH:
+                continue  # Догоняем отставание без паузы
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Order events tail error: {e}")
+
+        await order_events.wait_for_changes(ORDER_EVENTS_POLL_INTERVAL)
+
+
+async def prefetch_product_images_task():
+    """
+    Прогрев хранилища картинок товаров после старта.
+    Выполняется в одном worker'е (flock), остальные пропускают.
+    """
+    lock_fd = acquire_payment_checker_lock(PREFETCH_LOCK_PATH)
+    if lock_fd is None:
+        return
+    try:
+        file_ids = await get_product_image_file_ids()
+        stats = await product_images.prefetch(file_ids)
+        logger.info(
+            "Product images prefetch: cached=%s fetched=%s failed=%s",
+            stats["cached"], stats["fetched"], stats["failed"]
+        )
+    except Exception as e:
+        logger.error(f"Product images prefetch error: {e}")
+    finally:
+        release_payment_checker_lock(lock_fd)
+
+
+async def _stop_task(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+# ===== ПРОГРЕВ =====
+# Без прогрева первые запросы после деплоя платят за открытие пула, чтение
+# каталога и загрузку ключа wata. С preload_app (miniapp/gunicorn.conf.py)
+# preload() выполняется один раз в мастере до fork: кэш каталога и ключи
+# достаются worker'ам общими страницами памяти (copy-on-write). Worker в
+# lifespan открывает свой пул и только после этого принимает запросы;
+# /ready отвечает 200 после прогрева.
+
+readiness = {
+    "ready": False,
+    "preloaded": False,
+    "catalog_keys": 0,
+    "wata_key": False,
+    "warmup_seconds": None,
+    "error": None,
+}
+
+
+async def warm_catalog() -> int:
+    """Кэш /api/products для всех игр и подкатегорий и кэш товаров database.py"""
+    products = await get_products_by_game_and_subcategory()
+    keys = {(None, None)}
+    for product in products:
+        keys.add((product.game, None))
+        keys.add((product.game, product.subcategory))
+    for game, subcategory in keys:
+        await get_products(game, subcategory)
+    await get_products_by_ids([product.id for product in products])
+    return len(keys)
+
+
+async def preload():
+    """Общая часть прогрева: каталог и публичный ключ wata"""
+    started = time.monotonic()
+    readiness["catalog_keys"] = await warm_catalog()
+    # Подпись webhook'ов проверяется только в production — там ключ нужен сразу
+    if IS_PRODUCTION:
+        from wata_form import get_wata_public_key
+        readiness["wata_key"] = await get_wata_public_key() is not None
+    readiness["preloaded"] = True
+    logger.info(
+        f"Preload: {readiness['catalog_keys']} catalog keys, wata key={readiness['wata_key']}, "
+        f"{time.monotonic() - started:.2f}s"
+    )
+
+
+def preload_before_fork():
+    """Прогрев в мастере gunicorn (when_ready): свой event loop, соединения закрываются до fork"""
+    async def run():
+        try:
+            await preload()
+        finally:
+            await close_db_pool()
+    asyncio.run(run())
+
+
+async def warm_up_worker():
+    """Пул соединений worker'а и, без preload_app, весь прогрев; затем ready"""
+    started = time.monotonic()
+    try:
+        await get_db_pool()
+        if not readiness["preloaded"]:
+            await preload()
+    except Exception as e:
+        readiness["error"] = str(e)
+        logger.error(f"Warm-up failed: {e}", exc_info=True)
+        return
+    readiness["warmup_seconds"] = round(time.monotonic() - started, 3)
+    readiness["ready"] = True
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global payment_checker_lock_fd
+    global payment_checker_lock_fd, payment_checker_running
+    # Запросы worker начнёт принимать только после прогрева
+    await warm_up_worker()
+    tail_task = asyncio.create_task(order_events_tail_task())
+    sweeper_task = asyncio.create_task(rate_limit_sweeper_task())
+    checker_task = None
+    prefetch_task = asyncio.create_task(prefetch_product_images_task()) if PREFETCH_PRODUCT_IMAGES else None
+
     if PAYMENT_CHECKER_MODE != "off":
         payment_checker_lock_fd = acquire_payment_checker_lock()
         if payment_checker_lock_fd is None:
             logger.warning("Payment checker already running in another worker; skipping in this worker")
-            yield
-            return
-
-        logger.warning("⚠️ Payment checker ENABLED")
-        logger.warning(
-            "⚠️ Checker mode: %s (mutates=%s, notifies=%s)",
-            PAYMENT_CHECKER_MODE,
-            CHECKER_MUTATES_STATUS,
-            CHECKER_SENDS_NOTIFICATIONS
-        )
-        task = asyncio.create_task(check_pending_payments_task())
+        else:
+            logger.warning("⚠️ Payment checker ENABLED")
+            logger.warning(
+                "⚠️ Checker mode: %s (mutates=%s, notifies=%s)",
+                PAYMENT_CHECKER_MODE,
+                CHECKER_MUTATES_STATUS,
+                CHECKER_SENDS_NOTIFICATIONS
+            )
+            checker_task = asyncio.create_task(check_pending_payments_task())
+    else:
+        logger.info("Payment checker disabled (mode=off)")
 
-        yield
+    yield
 
-        global payment_checker_running
+    readiness["ready"] = False
+    if checker_task is not None:
         payment_checker_running = False
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+        await _stop_task(checker_task)
         release_payment_checker_lock(payment_checker_lock_fd)
         payment_checker_lock_fd = None
-    else:
-        logger.info("Payment checker disabled (mode=off)")
-        yield
 
+    await _stop_task(tail_task)
+    await _stop_task(sweeper_task)
+    if prefetch_task is not None:
+        await _stop_task(prefetch_task)
+    await close_media_session()
 
 
-app = FastAPI(title="SuperCell Shop Mini App API", lifespan=lifespan)
+
+class OrjsonResponse(JSONResponse):
+    """
+    Ответ по умолчанию: JSON через orjson (в разы быстрее json.dumps).
+    Маршруты с response_model отдают сюда уже проверенные моделью данные,
+    поэтому медленный jsonable_encoder не вызывается
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(title="SuperCell Shop Mini App API", lifespan=lifespan, default_response_class=OrjsonResponse)
 
 
 # ===== КЕШИРОВАНИЕ =====
 class SimpleCache:
     """Простой in-memory кеш с TTL"""
 
-    def __init__(self):
+    def __init__(self, name: str = "api"):
+        self.name = name
         self._cache = {}
         self._timestamps = {}
 
@@ -344,11 +560,13 @@ class SimpleCache:
         """Получить значение из кеша (TTL в секундах)"""
         if key in self._cache:
             if time.time() - self._timestamps[key] < ttl:
+                CACHE_REQUESTS.labels(self.name, "hit").inc()
                 return self._cache[key]
             else:
                 # Кеш устарел
                 del self._cache[key]
                 del self._timestamps[key]
+        CACHE_REQUESTS.labels(self.name, "miss").inc()
         return None
 
     def set(self, key: str, value):
@@ -369,69 +587,69 @@ class SimpleCache:
 
 
 # Глобальный кеш
-cache = SimpleCache()
+cache = SimpleCache("products")
 CACHE_TTL = int(os.getenv("PRODUCTS_CACHE_TTL", 300))  # 5 минут по умолчанию
 
+# Дисковый кэш аватарок и картинок товаров (общий для всех worker'ов)
+async def _is_registered_user(user_id: int) -> bool:
+    """Аватарки отдаём только пользователям бота — не любому перебираемому id"""
+    return await get_user_uid(user_id) is not None
+
+
+avatar_cache = AvatarCache(BOT_TOKEN, user_exists=_is_registered_user)
+product_images = ProductImageStore(BOT_TOKEN)
+
 
 # ===== ЗАЩИТА ОТ DDOS =====
-class RateLimiter:
-    """Rate limiter для защиты от DDoS"""
-
-    def __init__(self, requests_per_minute: int = 60, burst_limit: int = 10):
-        self._requests = {}  # IP -> список timestamps
-        self._blocked = {}   # IP -> время блокировки
-        self.rpm = requests_per_minute
-        self.burst = burst_limit
-        self.block_duration = 300  # 5 минут блокировки
-
-    def is_allowed(self, ip: str) -> bool:
-        """Проверить, разрешён ли запрос"""
-        now = time.time()
-
-        # Проверяем блокировку
-        if ip in self._blocked:
-            if now < self._blocked[ip]:
-                return False
-            else:
-                del self._blocked[ip]
+# GCRA: O(1) на запрос, одно число на IP для каждого лимита (см. rate_limit.py).
+# Состояние общее для всех worker'ов gunicorn (mmap-таблица в /dev/shm)
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", 120))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 20))
+RATE_LIMIT_BLOCK_DURATION = 300  # 5 минут блокировки
+RATE_LIMIT_SWEEP_INTERVAL = 60   # как часто удалять неактивные IP
+# Файл общей для worker'ов таблицы лимитов (пусто — у каждого worker'а свой лимит)
+RATE_LIMIT_SHARED_PATH = os.getenv("RATE_LIMIT_SHARED_PATH", default_shared_path())
+RATE_LIMIT_SLOTS = int(os.getenv("RATE_LIMIT_SLOTS", 65536))
+
+RATE_LIMITS = [
+    (RATE_LIMIT_PER_MINUTE, 60),  # запросов в минуту на IP
+    (RATE_LIMIT_BURST, 1),        # запросов в секунду (burst)
+]
 
-        # Очищаем старые записи
-        if ip in self._requests:
-            self._requests[ip] = [t for t in self._requests[ip] if now - t < 60]
-        else:
-            self._requests[ip] = []
 
-        # Проверяем лимиты
-        recent = self._requests[ip]
+def create_rate_limit_store():
+    """Общая таблица в /dev/shm, при ошибке — состояние в памяти worker'а"""
+    if RATE_LIMIT_SHARED_PATH:
+        try:
+            return SharedMemoryStore(RATE_LIMIT_SHARED_PATH, GCRALimiter.state_size(RATE_LIMITS), RATE_LIMIT_SLOTS)
+        except OSError as e:
+            logger.error(f"Shared rate limit table unavailable ({RATE_LIMIT_SHARED_PATH}): {e}; using per-worker limits")
+    return MemoryStore(GCRALimiter.state_size(RATE_LIMITS))
 
-        # Burst check (слишком много запросов за секунду)
-        last_second = [t for t in recent if now - t < 1]
-        if len(last_second) >= self.burst:
-            self._blocked[ip] = now + self.block_duration
-            logger.warning(f"IP {ip} blocked for burst ({len(last_second)} req/sec)")
-            return False
 
-        # Rate limit check
-        if len(recent) >= self.rpm:
-            self._blocked[ip] = now + self.block_duration
-            logger.warning(f"IP {ip} blocked for rate limit ({len(recent)} req/min)")
-            return False
+rate_limiter = GCRALimiter(
+    limits=RATE_LIMITS,
+    block_duration=RATE_LIMIT_BLOCK_DURATION,
+    store=create_rate_limit_store()
+)
 
-        # Записываем запрос
-        self._requests[ip].append(now)
-        return True
 
-    def get_blocked_count(self) -> int:
-        """Количество заблокированных IP"""
-        now = time.time()
-        return sum(1 for t in self._blocked.values() if t > now)
+async def rate_limit_sweeper_task():
+    """Периодически удаляет из rate limiter'а IP, которые перестали приходить"""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        try:
+            rate_limiter.sweep()
+            stats = rate_limiter.get_stats()
+            if stats["rejected"] or stats["blocked_keys"]:
+                logger.info(f"Rate limiter: {stats}")
+        except Exception as e:
+            logger.error(f"Rate limiter sweep error: {e}")
 
 
-# Глобальный rate limiter
-rate_limiter = RateLimiter(
-    requests_per_minute=120,  # 120 запросов в минуту на IP
-    burst_limit=20            # Не более 20 запросов в секунду
-)
+# secret_key = HMAC_SHA256("WebAppData", bot_token) — один на процесс, не на запрос.
+# ВАЖНО: порядок аргументов - сначала "WebAppData" как ключ, затем bot_token как сообщение
+WEBAPP_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest() if BOT_TOKEN else None
 
 
 def validate_telegram_init_data(init_data: str):
@@ -458,17 +676,13 @@ def validate_telegram_init_data(init_data: str):
 
         logger.debug(f"Data check string: {data_check_string[:100]}...")
 
-        # Создаём secret_key = HMAC_SHA256("WebAppData", bot_token)
-        # ВАЖНО: порядок аргументов - сначала "WebAppData" как ключ, затем bot_token как сообщение
-        secret_key = hmac.new(
-            b"WebAppData",
-            BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
+        if WEBAPP_SECRET_KEY is None:
+            logger.error("BOT_TOKEN is not set, initData cannot be verified")
+            return None
 
         # Вычисляем hash
         calculated_hash = hmac.new(
-            secret_key,
+            WEBAPP_SECRET_KEY,
             data_check_string.encode(),
             hashlib.sha256
         ).hexdigest()
@@ -482,7 +696,7 @@ def validate_telegram_init_data(init_data: str):
         import json
         if 'user' in parsed_data:
             user_data = json.loads(unquote(parsed_data['user']))
-            logger.info(f"Validated user: {user_data.get('id')}")
+            logger.debug("Validated user: %s", user_data.get('id'))
             return user_data
 
         return parsed_data
@@ -508,7 +722,7 @@ async def get_validated_user(x_telegram_init_data: str = Header(None, alias="X-T
 
 async def send_telegram_message(chat_id: int, text: str, reply_markup: dict = None):
     """Отправить сообщение через Telegram Bot API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = f"{(TELEGRAM_API_URL or 'https://api.telegram.org').rstrip('/')}/bot{BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -521,7 +735,7 @@ async def send_telegram_message(chat_id: int, text: str, reply_markup: dict = No
 
     logger.info(f"Sending Telegram message to {chat_id}, text length: {len(text)}")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    async with httpx.AsyncClient(timeout=30.0, transport=OutboundTransport("telegram")) as client:
         try:
             response = await client.post(url, json=payload)
             response_text = response.text[:500] if response.text else ""
@@ -582,6 +796,14 @@ async def notify_user_about_purchase(user_id: int, product_name: str, pickup_cod
 
     await send_telegram_message(user_id, purchase_message, reply_markup)
 
+async def apply_order_status(order_id: int, status: str, source: str = None) -> bool:
+    """Обновить статус заказа (событие попадает в журнал order_events)"""
+    applied = await update_order_payment_status(order_id, status, source)
+    if applied:
+        # Событие этого worker'а отправляем в Mini App сразу, без ожидания опроса
+        order_events.notify()
+    return applied
+
 # Middleware для логирования и защиты от DDoS
 
 
@@ -592,6 +814,7 @@ async def security_middleware(request: Request, call_next):
 
     # Rate limiting check
     if not rate_limiter.is_allowed(client_ip):
+        RATE_LIMITED.labels("api").inc()
         logger.warning(f"⛔ BLOCKED {request.method} {request.url.path} from {client_ip}")
         from fastapi.responses import JSONResponse
         return JSONResponse(
@@ -599,16 +822,33 @@ async def security_middleware(request: Request, call_next):
             content={"detail": "Too many requests. Please try again later."}
         )
 
-    logger.info(f"→ {request.method} {request.url.path} from {client_ip}")
-
+    status_code = 500
+    HTTP_IN_PROGRESS.inc()
     try:
         response = await call_next(request)
-        process_time = time.time() - start_time
-        logger.info(f"← {request.method} {request.url.path} - Status: {response.status_code} - Time: {process_time:.3f}s")
+        status_code = response.status_code
         return response
     except Exception as e:
         logger.error(f"✗ {request.method} {request.url.path} - Error: {e}", exc_info=True)
         raise
+    finally:
+        HTTP_IN_PROGRESS.dec()
+        process_time = time.time() - start_time
+        # Шаблон маршрута (/api/user/{user_id}), а не путь: иначе метка на каждого пользователя
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", None) or "unmatched"
+        HTTP_REQUESTS.labels(request.method, route_path, status_code).inc()
+        HTTP_LATENCY.labels(request.method, route_path, status_code).observe(process_time)
+        # Одна строка на запрос; успешные — выборочно по маршруту
+        if access_log_sampler.should_log(route_path, status_code, process_time):
+            access_logger.log(
+                logging.WARNING if status_code >= 500 else logging.INFO,
+                "%s %s %s %.3fs", request.method, request.url.path, status_code, process_time,
+                extra={
+                    "method": request.method, "path": request.url.path, "route": route_path,
+                    "status": status_code, "duration_ms": round(process_time * 1000, 1), "client": client_ip,
+                }
+            )
 
 # CORS middleware - PRODUCTION: ограничиваем origins
 # Разрешаем только Telegram Web App и наш домен
@@ -627,7 +867,7 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "X-Telegram-Init-Data", "Authorization"],
+    allow_headers=["Content-Type", "X-Telegram-Init-Data", "Authorization", "Idempotency-Key"],
     max_age=86400,  # Кэш preflight запросов на 24 часа
 )
 
@@ -708,6 +948,137 @@ class PurchaseCartRequest(BaseModel):
         return v.lower()
 
 
+# Модели ответов. Строки database.py (named_row) превращаются в них по
+# именам столбцов: Model.model_validate(row._asdict()); лишние поля строки
+# (created_at товара и т.п.) модель отбрасывает
+class UserStatsResponse(BaseModel):
+    uid: int | None = None
+    orders_count: int
+    total_spent: float
+
+
+class ProductSummary(BaseModel):
+    id: int
+    name: str
+    description: str | None = None
+    price: float
+    game: str | None = None
+    subcategory: str | None = None
+    image_file_id: str | None = None
+    image_path: str | None = None
+
+
+class ProductResponse(ProductSummary):
+    in_stock: int
+
+
+class OrderResponse(BaseModel):
+    id: int
+    product_name: str | None = None
+    amount: float | None = None
+    status: str | None = None
+    pickup_code: str | None = None
+    supercell_id: str | None = None
+    created_at: str | None = None
+    game: str | None = None
+
+
+class DebugOrder(BaseModel):
+    id: int
+    user_id: int | None = None
+    product: str | None = None
+    amount: float | None = None
+    status: str
+    transaction_id: str | None = None
+    created_at: str | None = None
+
+
+class OrdersDebugResponse(BaseModel):
+    total_shown: int
+    status_breakdown: dict[str, int]
+    orders: list[DebugOrder]
+
+
+def product_response(model, row, width: int):
+    """Строка товара -> модель ответа с URL варианта картинки нужной ширины"""
+    fields = row._asdict()
+    fields["image_path"] = variant_url(row.image_path, width)
+    return model.model_validate(fields)
+
+
+# ===== ИДЕМПОТЕНТНОСТЬ =====
+# WebView в мобильных клиентах повторяют POST-запросы. Клиент передаёт
+# заголовок Idempotency-Key, и повтор получает исходный ответ, а не новый заказ.
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 86400))  # 24 часа по умолчанию
+IDEMPOTENCY_CLEANUP_INTERVAL = 3600
+_idempotency_last_cleanup = 0.0
+
+
+async def _cleanup_idempotency_keys():
+    """Периодически удаляем устаревшие ключи (не чаще раза в час на worker)"""
+    global _idempotency_last_cleanup
+    now = time.time()
+    if now - _idempotency_last_cleanup < IDEMPOTENCY_CLEANUP_INTERVAL:
+        return
+    _idempotency_last_cleanup = now
+    try:
+        deleted = await delete_expired_idempotency_keys(IDEMPOTENCY_TTL)
+        if deleted:
+            logger.info(f"Removed {deleted} expired idempotency keys")
+    except Exception as e:
+        logger.error(f"Failed to cleanup idempotency keys: {e}")
+
+
+async def run_idempotent(endpoint: str, user_id: int, idempotency_key: str | None, payload: dict, handler):
+    """
+    Выполнить handler() не более одного раза для (user_id, endpoint, Idempotency-Key).
+
+    Успешный ответ сохраняется в БД вместе с order_id, повтор с тем же ключом
+    возвращает его без создания нового заказа/платёжной ссылки.
+    Неуспешные ответы не сохраняются — повтор выполнит запрос заново.
+    """
+    if not idempotency_key:
+        return await handler()
+
+    key = idempotency_key.strip()
+    if not key or len(key) > 128:
+        raise HTTPException(status_code=400, detail="Некорректный Idempotency-Key")
+
+    request_hash = hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+    record = await get_idempotency_record(user_id, endpoint, key, IDEMPOTENCY_TTL)
+    if record is None:
+        if await reserve_idempotency_key(user_id, endpoint, key, request_hash, IDEMPOTENCY_TTL):
+            try:
+                response = await handler()
+            except Exception:
+                await release_idempotency_key(user_id, endpoint, key)
+                raise
+
+            if isinstance(response, dict) and response.get("success"):
+                await complete_idempotency_key(user_id, endpoint, key, response.get("order_id"), response)
+            else:
+                await release_idempotency_key(user_id, endpoint, key)
+
+            await _cleanup_idempotency_keys()
+            return response
+
+        # Ключ успел занять параллельный запрос (в этом или другом worker)
+        record = await get_idempotency_record(user_id, endpoint, key, IDEMPOTENCY_TTL)
+
+    if record is None or record["response"] is None:
+        raise HTTPException(status_code=409, detail="Запрос уже обрабатывается")
+
+    if record["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key уже использован с другими параметрами")
+
+    logger.info(f"Idempotent replay: endpoint={endpoint} user_id={user_id} order_id={record['order_id']}")
+    return JSONResponse(content=record["response"], headers={"Idempotent-Replayed": "true"})
+
+
 # ===== ROUTES =====
 
 @app.get("/")
@@ -716,7 +1087,23 @@ async def root():
     return FileResponse("templates/index.html")
 
 
-@app.get("/api/user/{user_id}")
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Готовность worker'а: 200 только после прогрева (деплой ждёт его в ExecStartPost)"""
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request, admin_key: str = None):
+    """Метрики Prometheus (сумма по всем worker'ам). Снаружи — только с admin_key"""
+    client_ip = request.client.host if request.client else ""
+    if not is_local_client(client_ip):
+        ensure_admin_access(admin_key)
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
+
+
+@app.get("/api/user/{user_id}", response_model=UserStatsResponse)
 async def get_user(user_id: int):
     """Получить информацию о пользователе"""
     logger.debug(f"Getting user stats for user_id: {user_id}")
@@ -728,17 +1115,13 @@ async def get_user(user_id: int):
             raise HTTPException(status_code=404, detail="User not found")
 
         logger.debug(f"User {user_id} stats: orders={user_stats['orders_count']}")
-        return {
-            "uid": user_stats['uid'],
-            "orders_count": user_stats['orders_count'],
-            "total_spent": user_stats['total_spent']
-        }
+        return UserStatsResponse.model_validate(user_stats)
     except Exception as e:
         logger.error(f"Error getting user {user_id}: {e}", exc_info=True)
         raise
 
 
-@app.get("/api/user/{user_id}/orders")
+@app.get("/api/user/{user_id}/orders", response_model=list[OrderResponse])
 async def get_user_orders_api(user_id: int, limit: int = 20):
     """Получить историю заказов пользователя
 
@@ -751,21 +1134,147 @@ async def get_user_orders_api(user_id: int, limit: int = 20):
 
         # БЕЗОПАСНОСТЬ: Скрываем pickup_code для неоплаченных заказов
         # Код получения показывается ТОЛЬКО после подтверждения оплаты
-        safe_statuses = ['paid', 'completed']
+        safe_statuses = ('paid', 'completed')
 
+        result = []
         for order in orders:
-            if order.get('status') not in safe_statuses:
+            fields = order._asdict()
+            if order.status not in safe_statuses:
                 # Скрываем код для неоплаченных заказов
-                order['pickup_code'] = None
+                fields['pickup_code'] = None
+            result.append(OrderResponse.model_validate(fields))
 
-        logger.info(f"Found {len(orders)} orders for user {user_id}")
-        return orders
+        logger.debug("Found %d orders for user %s", len(result), user_id)
+        return result
     except Exception as e:
         logger.error(f"Error getting orders for user {user_id}: {e}", exc_info=True)
         raise
 
 
-@app.get("/api/search")
+# ===== LIVE-СТАТУСЫ ЗАКАЗОВ (SSE) =====
+
+ORDER_STREAM_HEARTBEAT = 15  # секунд между ping-комментариями
+ORDER_STREAM_REPLAY_LIMIT = 100  # больше пропущенных событий — отдаём снапшот
+
+
+def _sse_message(event: str, data: dict, event_id: int = None) -> str:
+    """Сформировать сообщение Server-Sent Events"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def _get_order_statuses(user_id: int) -> dict:
+    """Текущие статусы последних заказов пользователя {order_id: status}"""
+    orders = await get_user_orders(user_id, 20)
+    return {order.id: order.status for order in orders}
+
+
+@app.get("/api/orders/stream")
+async def orders_stream(
+    request: Request,
+    init_data: str = None,
+    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data"),
+    last_event_id: str = Header(None, alias="Last-Event-ID")
+):
+    """
+    Поток изменений статусов заказов пользователя (Server-Sent Events).
+
+    EventSource не умеет передавать заголовки, поэтому initData
+    принимается и в query-параметре init_data.
+    При переподключении браузер сам присылает Last-Event-ID.
+    """
+    raw_init_data = x_telegram_init_data or init_data
+    if not raw_init_data:
+        raise HTTPException(status_code=401, detail="Missing Telegram initData")
+
+    user_data = validate_telegram_init_data(raw_init_data)
+    if not user_data or not user_data.get("id"):
+        raise HTTPException(status_code=401, detail="Invalid Telegram initData")
+
+    user_id = int(user_data["id"])
+
+    async def event_stream():
+        subscription = order_events.subscribe(user_id)
+        try:
+            yield "retry: 3000\n\n"
+
+            since = order_events.parse_cursor(last_event_id)
+            replay = None
+            if since is not None:
+                replay = await get_order_events_after(since, ORDER_STREAM_REPLAY_LIMIT + 1, user_id=user_id)
+                if len(replay) > ORDER_STREAM_REPLAY_LIMIT:
+                    replay = None
+
+            if replay is None:
+                # Первое подключение или пропущено слишком много — отдаём снапшот
+                cursor = order_events.last_id
+                statuses = await _get_order_statuses(user_id)
+                yield _sse_message(
+                    "snapshot",
+                    {"orders": [{"order_id": oid, "status": st} for oid, st in statuses.items()]},
+                    cursor
+                )
+                sent_id = cursor
+            else:
+                sent_id = since
+                for event in replay:
+                    yield _sse_message(
+                        "order",
+                        {"order_id": event["order_id"], "status": event["new_status"]},
+                        event["id"]
+                    )
+                    sent_id = event["id"]
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=ORDER_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+
+                if subscription.overflowed:
+                    # Клиент не успевал читать — досылаем из журнала
+                    subscription.overflowed = False
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    missed = await get_order_events_after(sent_id, ORDER_STREAM_REPLAY_LIMIT, user_id=user_id)
+                    for missed_event in missed:
+                        yield _sse_message(
+                            "order",
+                            {"order_id": missed_event["order_id"], "status": missed_event["new_status"]},
+                            missed_event["id"]
+                        )
+                        sent_id = missed_event["id"]
+                    continue
+
+                if event.id <= sent_id:
+                    continue  # Уже отправлено в replay
+                yield _sse_message(
+                    "order",
+                    {"order_id": event.order_id, "status": event.new_status},
+                    event.id
+                )
+                sent_id = event.id
+        finally:
+            order_events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache, no-transform",
+            "X-Accel-Buffering": "no"  # nginx: не буферизовать поток
+        }
+    )
+
+
+@app.get("/api/search", response_model=list[ProductSummary])
 async def search_products(q: str, game: str = None):
     """Умный поиск товаров с санитизацией входных данных"""
     # SECURITY: Санитизация и ограничение длины запроса
@@ -792,9 +1301,9 @@ async def search_products(q: str, game: str = None):
         results = []
 
         for p in all_products:
-            product_name = (p[1] or "").lower()
-            product_desc = (p[2] or "").lower()
-            product_game = (p[4] or "").lower()
+            product_name = (p.name or "").lower()
+            product_desc = (p.description or "").lower()
+            product_game = (p.game or "").lower()
 
             #Вычисляем релевантность
             score = 0
@@ -837,39 +1346,26 @@ async def search_products(q: str, game: str = None):
             }
             for kw, subcats in keywords.items():
                 if kw in q_lower:
-                    product_subcat = (p[5] or "").lower()
+                    product_subcat = (p.subcategory or "").lower()
                     if product_subcat in subcats or any(s in product_name for s in subcats):
                         score += 25
 
             if score > 0:
-                results.append({
-                    "id": p[0],
-                    "name": p[1],
-                    "description": p[2],
-                    "price": p[3],
-                    "game": p[4],
-                    "subcategory": p[5],
-                    "image_file_id": p[7] if len(p) > 7 else None,
-                    "image_path": p[8] if len(p) > 8 else None,
-                    "score": score
-                })
+                results.append((score, p))
 
-        #Сортируем по релевантности
-        results.sort(key=lambda x: x["score"], reverse=True)
+        #Сортируем по релевантности (стабильно: при равном score — порядок каталога)
+        results.sort(key=lambda x: x[0], reverse=True)
 
-        #Убираем score из результата
-        for r in results:
-            del r["score"]
-
-        logger.info(f"Search '{q}' found {len(results)} results")
-        return results[:20]  #Максимум 20 результатов
+        logger.debug("Search '%s' found %d results", q, len(results))
+        #Максимум 20 результатов
+        return [product_response(ProductSummary, p, PRODUCT_LIST_WIDTH) for _, p in results[:20]]
 
     except Exception as e:
         logger.error(f"Search error: {e}", exc_info=True)
         return []
 
 
-@app.get("/api/products")
+@app.get("/api/products", response_model=list[ProductResponse])
 async def get_products(game: str = None, subcategory: str = None):
     """Получить список товаров (с кешированием)"""
     cache_key = f"products:{game}:{subcategory}"
@@ -884,22 +1380,9 @@ async def get_products(game: str = None, subcategory: str = None):
 
     try:
         products = await get_products_by_game_and_subcategory(game, subcategory)
-        logger.info(f"Found {len(products)} products for game={game}, subcategory={subcategory}")
-
-        result = [
-            {
-                "id": p[0],
-                "name": p[1],
-                "description": p[2],
-                "price": p[3],
-                "game": p[4],
-                "subcategory": p[5],
-                "in_stock": p[6],
-                "image_file_id": p[7] if len(p) > 7 else None,
-                "image_path": p[8] if len(p) > 8 else None,
-            }
-            for p in products
-        ]
+        logger.debug("Found %d products for game=%s, subcategory=%s", len(products), game, subcategory)
+
+        result = [product_response(ProductResponse, p, PRODUCT_LIST_WIDTH) for p in products]
 
         # Сохраняем в кеш
         cache.set(cache_key, result)
@@ -911,7 +1394,7 @@ async def get_products(game: str = None, subcategory: str = None):
         raise
 
 
-@app.get("/api/product/{product_id}")
+@app.get("/api/product/{product_id}", response_model=ProductResponse)
 async def get_product(product_id: int):
     """Получить информацию о товаре"""
     product = await get_product_by_id(product_id)
@@ -919,23 +1402,14 @@ async def get_product(product_id: int):
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    return {
-        "id": product[0],
-        "name": product[1],
-        "description": product[2],
-        "price": product[3],
-        "game": product[4],
-        "subcategory": product[5],
-        "in_stock": product[6],
-        "image_file_id": product[7] if len(product) > 7 else None,
-        "image_path": product[8] if len(product) > 8 else None
-    }
+    return product_response(ProductResponse, product, PRODUCT_DETAIL_WIDTH)
 
 
 @app.post("/api/purchase")
 async def purchase_product(
     request: PurchaseRequest,
-    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data"),
+    idempotency_key: str = Header(None, alias="Idempotency-Key")
 ):
     """Создать заказ на товар (требует авторизации через Telegram)"""
     # Проверяем авторизацию через Telegram
@@ -954,43 +1428,47 @@ async def purchase_product(
         logger.warning(f"User ID mismatch: request={request.user_id}, telegram={telegram_user_id}")
         raise HTTPException(status_code=403, detail="Несоответствие пользователя")
 
-    logger.info(f"Purchase request (verified): user_id={request.user_id}, product_id={request.product_id}, supercell_id={request.supercell_id}")
+    async def _create_order():
+        logger.info(f"Purchase request (verified): user_id={request.user_id}, product_id={request.product_id}, supercell_id={request.supercell_id}")
 
-    success, message, order_id, pickup_code = await create_order_without_balance(
-        request.user_id,
-        request.product_id,
-        request.supercell_id
-    )
+        success, message, order_id, pickup_code = await create_order_without_balance(
+            request.user_id,
+            request.product_id,
+            request.supercell_id
+        )
 
-    if not success:
-        logger.warning(f"Purchase failed: {message}")
-        return {
-            "success": False,
-            "message": message
-        }
+        if not success:
+            logger.warning(f"Purchase failed: {message}")
+            return {
+                "success": False,
+                "message": message
+            }
 
-    # Сразу устанавливаем статус "pending_payment" - ожидает оплаты
-    await update_order_payment_status(order_id, "pending_payment")
-    logger.info(f"Order {order_id} created with status pending_payment")
+        # Сразу устанавливаем статус "pending_payment" - ожидает оплаты
+        await apply_order_status(order_id, "pending_payment", "purchase")
+        logger.info(f"Order {order_id} created with status pending_payment")
 
-    # ВАЖНО: Уведомления НЕ отправляются здесь!
-    # Они будут отправлены только после подтверждения оплаты через webhook
-    # или при ручном подтверждении админом.
-    # Код получения (pickup_code) также НЕ показывается до оплаты.
+        # ВАЖНО: Уведомления НЕ отправляются здесь!
+        # Они будут отправлены только после подтверждения оплаты через webhook
+        # или при ручном подтверждении админом.
+        # Код получения (pickup_code) также НЕ показывается до оплаты.
 
-    return {
-        "success": True,
-        "message": "Заказ создан. Ожидает оплаты.",
-        "order_id": order_id,
-        "payment_required": True
-        # pickup_code НЕ возвращаем - он будет отправлен после оплаты
-    }
+        return {
+            "success": True,
+            "message": "Заказ создан. Ожидает оплаты.",
+            "order_id": order_id,
+            "payment_required": True
+            # pickup_code НЕ возвращаем - он будет отправлен после оплаты
+        }
+
+    return await run_idempotent("purchase", request.user_id, idempotency_key, request.model_dump(), _create_order)
 
 
 @app.post("/api/purchase-cart")
 async def purchase_cart(
     request: PurchaseCartRequest,
-    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data"),
+    idempotency_key: str = Header(None, alias="Idempotency-Key")
 ):
     """Создать единый заказ по корзине (одна оплата на всю сумму)."""
     if not x_telegram_init_data:
@@ -1007,70 +1485,79 @@ async def purchase_cart(
         logger.warning(f"Cart purchase user mismatch: request={request.user_id}, telegram={telegram_user_id}")
         raise HTTPException(status_code=403, detail="Несоответствие пользователя")
 
-    # Объединяем дубликаты по product_id
-    merged_items = {}
-    for item in request.items:
-        merged_items[item.product_id] = merged_items.get(item.product_id, 0) + item.quantity
-
-    product_rows = []
-    for product_id, qty in merged_items.items():
-        product = await get_product_by_id(product_id)
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Товар #{product_id} не найден")
-        if not product[6]:
-            raise HTTPException(status_code=400, detail=f"Товар '{product[1]}' временно отсутствует")
-        product_rows.append((product, qty))
-
-    if not product_rows:
-        raise HTTPException(status_code=400, detail="Корзина пуста")
-
-    total_amount = 0.0
-    total_items = 0
-    games = set()
-    summary_parts = []
-
-    for product, qty in product_rows:
-        name = product[1]
-        price = float(product[3] or 0)
-        game = product[4] or ""
-        total_amount += price * qty
-        total_items += qty
-        if game:
-            games.add(game)
-        summary_parts.append(f"{name} x{qty}")
-
-    summary_preview = ", ".join(summary_parts[:4])
-    if len(summary_parts) > 4:
-        summary_preview += f" +{len(summary_parts) - 4} поз."
-    product_name = f"🛒 Корзина ({total_items} шт): {summary_preview}"
-
-    game_value = games.pop() if len(games) == 1 else "mixed"
-    order_id, _pickup_code = await create_order(
-        user_id=request.user_id,
-        product_id=None,
-        amount=round(total_amount, 2),
-        product_name=product_name,
-        game=game_value,
-        supercell_id=request.supercell_id
-    )
+    async def _create_cart_order():
+        # Объединяем дубликаты по product_id
+        merged_items = {}
+        for item in request.items:
+            merged_items[item.product_id] = merged_items.get(item.product_id, 0) + item.quantity
+
+        # Один запрос на все товары корзины
+        products_by_id = await get_products_by_ids(list(merged_items))
+
+        product_rows = []
+        for product_id, qty in merged_items.items():
+            product = products_by_id.get(product_id)
+            if not product:
+                raise HTTPException(status_code=404, detail=f"Товар #{product_id} не найден")
+            if not product.in_stock:
+                raise HTTPException(status_code=400, detail=f"Товар '{product.name}' временно отсутствует")
+            product_rows.append((product, qty))
+
+        if not product_rows:
+            raise HTTPException(status_code=400, detail="Корзина пуста")
+
+        total_amount = 0.0
+        total_items = 0
+        games = set()
+        summary_parts = []
+        order_items = []
+
+        for product, qty in product_rows:
+            name = product.name
+            price = float(product.price or 0)
+            game = product.game or ""
+            total_amount += price * qty
+            total_items += qty
+            if game:
+                games.add(game)
+            summary_parts.append(f"{name} x{qty}")
+            order_items.append((product.id, name, price, qty, product.game))
+
+        summary_preview = ", ".join(summary_parts[:4])
+        if len(summary_parts) > 4:
+            summary_preview += f" +{len(summary_parts) - 4} поз."
+        product_name = f"🛒 Корзина ({total_items} шт): {summary_preview}"
+
+        game_value = games.pop() if len(games) == 1 else "mixed"
+        order_id, _pickup_code = await create_order(
+            user_id=request.user_id,
+            product_id=None,
+            amount=round(total_amount, 2),
+            product_name=product_name,
+            game=game_value,
+            supercell_id=request.supercell_id,
+            items=order_items
+        )
 
-    await update_order_payment_status(order_id, "pending_payment")
-    logger.info(
-        "Cart order created: order_id=%s user_id=%s items=%s total=%.2f",
-        order_id,
-        request.user_id,
-        total_items,
-        total_amount
-    )
+        await apply_order_status(order_id, "pending_payment", "purchase_cart")
+        logger.info(
+            "Cart order created: order_id=%s user_id=%s items=%s total=%.2f",
+            order_id,
+            request.user_id,
+            total_items,
+            total_amount
+        )
 
-    return {
-        "success": True,
-        "message": "Заказ по корзине создан. Ожидает оплаты.",
-        "order_id": order_id,
-        "payment_required": True,
-        "total_amount": round(total_amount, 2),
-        "total_items": total_items
-    }
+        return {
+            "success": True,
+            "message": "Заказ по корзине создан. Ожидает оплаты.",
+            "order_id": order_id,
+            "payment_required": True,
+            "total_amount": round(total_amount, 2),
+            "total_items": total_items
+        }
+
+    return await run_idempotent("purchase-cart", request.user_id, idempotency_key, request.model_dump(), _create_cart_order)
 
 
 # ============================================
@@ -1158,7 +1645,7 @@ async def db_debug(admin_key: str = None):
     return result
 
 
-@app.get("/api/orders-debug")
+@app.get("/api/orders-debug", response_model=OrdersDebugResponse)
 async def orders_debug(admin_key: str = None, limit: int = 50):
     """
     Диагностика заказов - показывает все заказы и их статусы.
@@ -1167,38 +1654,43 @@ async def orders_debug(admin_key: str = None, limit: int = 50):
     """
     ensure_debug_access(admin_key)
 
-    from database import get_db
+    from database import get_db, named_row
 
     async with get_db() as db:
         cursor = await db.execute("""
-            SELECT id, user_id, product_name, amount, status, transaction_id, created_at
+            SELECT id, user_id, product_name AS product, amount, status, transaction_id, created_at
             FROM orders
             ORDER BY id DESC
             LIMIT ?
         """, (limit,))
+        cursor.row_factory = named_row
         rows = await cursor.fetchall()
 
     orders = []
     status_counts = {}
 
     for row in rows:
-        status = row[4] or "null"
+        status = row.status or "null"
         status_counts[status] = status_counts.get(status, 0) + 1
-        orders.append({
-            "id": row[0],
-            "user_id": row[1],
-            "product": row[2],
-            "amount": row[3],
-            "status": status,
-            "transaction_id": row[5],
-            "created_at": row[6]
-        })
+        orders.append(DebugOrder.model_validate(row._replace(status=status)._asdict()))
 
-    return {
-        "total_shown": len(orders),
-        "status_breakdown": status_counts,
-        "orders": orders
-    }
+    return OrdersDebugResponse(total_shown=len(orders), status_breakdown=status_counts, orders=orders)
+
+
+@app.get("/api/query-stats")
+async def query_stats(admin_key: str = None, limit: int = 20, sort: str = "total"):
+    """
+    Топ SQL-запросов по всем процессам (worker'ы API и бот): количество,
+    суммарное/среднее/максимальное время и план медленных запросов.
+
+    GET /api/query-stats?admin_key=YOUR_KEY&limit=20&sort=total|max|avg|count|slow
+    """
+    ensure_admin_access(admin_key)
+
+    try:
+        return query_report(max(1, min(limit, 200)), sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 class CreatePaymentRequest(BaseModel):
@@ -1211,7 +1703,8 @@ class CreatePaymentRequest(BaseModel):
 async def create_sbp_payment(
     request_data: CreatePaymentRequest,
     request: Request,
-    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(None, alias="X-Telegram-Init-Data"),
+    idempotency_key: str = Header(None, alias="Idempotency-Key")
 ):
     """
     Создаёт ссылку на платёжную форму wata.pro.
@@ -1226,46 +1719,56 @@ async def create_sbp_payment(
     if not user_data:
         raise HTTPException(status_code=401, detail="Неверная авторизация")
 
-    # Получаем заказ из БД
-    order = await get_order_by_id(request_data.order_id)
-    if not order:
-        raise HTTPException(status_code=404, detail="Заказ не найден")
+    # Ключ идемпотентности привязываем к пользователю из подписанного initData,
+    # а не к user_id из тела запроса
+    telegram_user_id = user_data.get('id')
+    if not telegram_user_id or telegram_user_id != request_data.user_id:
+        logger.warning(f"User ID mismatch: request={request_data.user_id}, telegram={telegram_user_id}")
+        raise HTTPException(status_code=403, detail="Несоответствие пользователя")
 
-    # order: (id, user_id, product_id, product_name, amount, game, pickup_code, status, created_at)
-    order_id = order[0]
-    amount = order[4]
-    product_name = order[3] or "Товар"
+    async def _create_payment_link():
+        # Получаем заказ из БД
+        order = await get_order_by_id(request_data.order_id)
+        if not order:
+            raise HTTPException(status_code=404, detail="Заказ не найден")
+
+        # order: (id, user_id, product_id, product_name, amount, game, pickup_code, status, created_at)
+        order_id = order[0]
+        amount = order[4]
+        product_name = order[3] or "Товар"
+
+        # Для корзины product_name может быть длинным, что ломает создание ссылки в wata.
+        # Ограничиваем description безопасной длиной.
+        payment_description = f"Заказ #{order_id}: {product_name}".strip()
+        if len(payment_description) > 96:
+            payment_description = f"Заказ #{order_id} Supercell Shop"
+
+        # Генерируем ссылку на платёжную форму через API wata.pro
+        result = await create_payment_form_url_async(
+            amount=amount,
+            order_id=f"order_{order_id}",
+            description=payment_description
+        )
 
-    # Для корзины product_name может быть длинным, что ломает создание ссылки в wata.
-    # Ограничиваем description безопасной длиной.
-    payment_description = f"Заказ #{order_id}: {product_name}".strip()
-    if len(payment_description) > 96:
-        payment_description = f"Заказ #{order_id} Supercell Shop"
-
-    # Генерируем ссылку на платёжную форму через API wata.pro
-    result = await create_payment_form_url_async(
-        amount=amount,
-        order_id=f"order_{order_id}",
-        description=payment_description
-    )
+        if not result.success:
+            logger.error(f"Failed to create payment URL: {result.error}")
+            return {
+                "success": False,
+                "error": result.error or "Не удалось создать ссылку на оплату"
+            }
 
-    if not result.success:
-        logger.error(f"Failed to create payment URL: {result.error}")
-        return {
-            "success": False,
-            "error": result.error or "Не удалось создать ссылку на оплату"
-        }
+        logger.info(f"Payment URL created for order {order_id}: {result.payment_url[:50]}...")
 
-    logger.info(f"Payment URL created for order {order_id}: {result.payment_url[:50]}...")
+        # Обновляем статус заказа на "pending_payment"
+        await apply_order_status(order_id, "pending_payment", "sbp_payment")
 
-    # Обновляем статус заказа на "pending_payment"
-    await update_order_payment_status(order_id, "pending_payment")
+        return {
+            "success": True,
+            "payment_url": result.payment_url,  # Ссылка на форму wata.pro
+            "order_id": order_id
+        }
 
-    return {
-        "success": True,
-        "payment_url": result.payment_url,  # Ссылка на форму wata.pro
-        "order_id": order_id
-    }
+    return await run_idempotent("create-sbp-payment", telegram_user_id, idempotency_key, request_data.model_dump(), _create_payment_link)
 
 
 # ============================================
@@ -1424,7 +1927,7 @@ async def payment_fail(
 
     # Обновляем статус заказа
     if numeric_order_id:
-        await update_order_payment_status(numeric_order_id, "payment_failed")
+        await apply_order_status(numeric_order_id, "payment_failed", "payment_fail")
 
     html = f"""
     <!DOCTYPE html>
@@ -1543,9 +2046,9 @@ async def simulate_payment(order_id: int, admin_key: str = None, status: str = "
     if status_normalized == "paid":
         # Сохраняем transaction_id и финально фиксируем paid.
         # Порядок важен: так не откатываемся в pending_payment.
-        await save_payment_transaction(order_id, transaction_id)
+        await save_payment_transaction(order_id, transaction_id, "simulate")
         results["actions"].append(f"Transaction saved: {transaction_id}")
-        await update_order_payment_status(order_id, "paid")
+        await apply_order_status(order_id, "paid", "simulate")
         results["actions"].append("Order status updated to 'paid'")
 
         # Уведомляем пользователя
@@ -1588,7 +2091,7 @@ async def simulate_payment(order_id: int, admin_key: str = None, status: str = "
         results["admin_notifications"] = admin_results
 
     elif status_normalized == "declined":
-        await update_order_payment_status(order_id, "payment_failed")
+        await apply_order_status(order_id, "payment_failed", "simulate")
         results["actions"].append("Order status updated to 'payment_failed'")
 
         user_message = (
@@ -1660,7 +2163,7 @@ async def sync_payments_from_wata(admin_key: str = None):
 
                 if wata_status == "paid":
                     # Обновляем статус на paid
-                    await update_order_payment_status(order_id, "paid")
+                    await apply_order_status(order_id, "paid", "sync")
                     results["updated_to_paid"] += 1
                     detail["action"] = "updated to paid"
 
@@ -1704,7 +2207,7 @@ async def sync_payments_from_wata(admin_key: str = None):
                             })
 
                 elif wata_status in ("declined", "failed", "error", "cancelled"):
-                    await update_order_payment_status(order_id, "payment_failed")
+                    await apply_order_status(order_id, "payment_failed", "sync")
                     results["updated_to_failed"] += 1
                     detail["action"] = "updated to payment_failed"
                 else:
@@ -1751,7 +2254,7 @@ async def mark_order_as_paid(order_id: int, admin_key: str = None):
         return {"message": "Order already marked as paid", "order_id": order_id}
 
     # Обновляем статус
-    await update_order_payment_status(order_id, "paid")
+    await apply_order_status(order_id, "paid", "mark_paid")
 
     user_id = order[1]
     product_name = order[3] or "Товар"
@@ -1904,8 +2407,6 @@ async def wata_webhook(request: Request):
     # Получаем тело запроса
     body = await request.body()
 
-    logger.info(f"Webhook received from wata.pro, body length: {len(body)}")
-
     # PRODUCTION: Проверяем подпись webhook
     from wata_form import verify_webhook_signature_async
     if IS_PRODUCTION:
@@ -1921,10 +2422,10 @@ async def wata_webhook(request: Request):
 
     try:
         data = await request.json()
-        # ВСЕГДА логируем полные данные webhook для отладки
-        logger.info(f"Wata webhook FULL DATA: {data}")
+        # Полные данные — только в DEBUG (и в ошибках ниже); аргументом, чтобы не форматировать зря
+        logger.debug("Wata webhook payload: %s", data)
     except Exception as e:
-        logger.error(f"Failed to parse webhook JSON: {e}")
+        logger.error(f"Failed to parse webhook JSON: {e}, body: {body[:2000]!r}")
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
     # Извлекаем данные из webhook
@@ -1935,8 +2436,6 @@ async def wata_webhook(request: Request):
     order_id_str = data.get("orderId") or data.get("order_id") or ""
     amount = data.get("amount")
 
-    logger.info(f"Wata webhook: transaction={transaction_id}, status={status}, order={order_id_str}, amount={amount}")
-    logger.info(f"Webhook data keys: {list(data.keys())}")
 
     # Нормализуем статус (wata.pro может присылать разные варианты)
     status_normalized = status.lower() if status else ""
@@ -1948,7 +2447,10 @@ async def wata_webhook(request: Request):
         status_normalized = "declined"
     elif status_normalized in ("created", "pending", "processing", "in_progress"):
         status_normalized = "pending"
-    logger.info(f"Normalized status: '{status}' -> '{status_normalized}'")
+    logger.info(
+        f"Wata webhook: transaction={transaction_id}, status={status} -> {status_normalized}, "
+        f"order={order_id_str}, amount={amount}"
+    )
 
     # Извлекаем числовой order_id
     numeric_order_id = None
@@ -1965,13 +2467,13 @@ async def wata_webhook(request: Request):
                 pass
 
     if not numeric_order_id:
-        logger.error(f"Could not parse order_id from webhook: {order_id_str}")
+        logger.error(f"Could not parse order_id from webhook: {order_id_str}, payload: {data}")
         return {"status": "ok", "message": "order_id not parsed"}
 
     # Получаем заказ из БД
     order = await get_order_by_id(numeric_order_id)
     if not order:
-        logger.error(f"Order {numeric_order_id} not found")
+        logger.error(f"Order {numeric_order_id} not found, webhook payload: {data}")
         return {"status": "ok", "message": "order not found"}
 
     # order: (id, user_id, product_id, product_name, amount, game, pickup_code, status, ...)
@@ -1984,20 +2486,18 @@ async def wata_webhook(request: Request):
 
         # Сначала сохраняем transaction_id (если есть), затем финально ставим paid.
         if transaction_id:
-            await save_payment_transaction(numeric_order_id, transaction_id)
+            await save_payment_transaction(numeric_order_id, transaction_id, "webhook")
 
         # Обновляем статус заказа на "paid" последней операцией
         try:
-            await update_order_payment_status(numeric_order_id, "paid")
-            logger.info(f"Order {numeric_order_id} status updated to 'paid' successfully")
+            await apply_order_status(numeric_order_id, "paid", "webhook")
         except Exception as e:
-            logger.error(f"FAILED to update order {numeric_order_id} status: {e}", exc_info=True)
+            logger.error(f"FAILED to update order {numeric_order_id} status: {e}, webhook payload: {data}", exc_info=True)
 
         # Проверяем что обновилось
         order_check = await get_order_by_id(numeric_order_id)
         if order_check:
             actual_status = order_check[7] if len(order_check) > 7 else None
-            logger.info(f"Order {numeric_order_id} actual status after update: '{actual_status}'")
             if actual_status != "paid":
                 logger.error(f"ORDER STATUS MISMATCH! Expected 'paid', got '{actual_status}'")
 
@@ -2053,10 +2553,10 @@ async def wata_webhook(request: Request):
 
         # Фиксируем transaction_id, чтобы в БД было видно, какой платёж отклонён.
         if transaction_id:
-            await save_payment_transaction(numeric_order_id, transaction_id)
+            await save_payment_transaction(numeric_order_id, transaction_id, "webhook")
 
         # Обновляем статус заказа
-        await update_order_payment_status(numeric_order_id, "payment_failed")
+        await apply_order_status(numeric_order_id, "payment_failed", "webhook")
 
         # Уведомляем пользователя
         try:
@@ -2073,7 +2573,7 @@ async def wata_webhook(request: Request):
         logger.info(f"Payment PENDING for order {numeric_order_id}")
         # Сохраняем transaction_id для отслеживания попытки оплаты.
         if transaction_id:
-            await save_payment_transaction(numeric_order_id, transaction_id)
+            await save_payment_transaction(numeric_order_id, transaction_id, "webhook")
 
     else:
         logger.warning(f"Unknown payment status: {status}")
@@ -2087,94 +2587,132 @@ async def wata_webhook(request: Request):
 # ============================================
 
 
+def _parse_range(range_header: str, size: int):
+    """Диапазон из заголовка Range (один интервал) -> (start, end) или None"""
+    units, _, spec = range_header.partition("=")
+    if units.strip() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # bytes=-N — последние N байт
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+def _read_file_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+async def _cached_file_response(request: Request, path: str, media_type: str,
+                                cache_control: str, etag: str = None, size: int = None):
+    """
+    Отдать файл из дискового кэша: через nginx (X-Accel-Redirect) или сами,
+    с поддержкой If-None-Match (304) и Range (206).
+    """
+    headers = {"Cache-Control": cache_control}
+    if etag:
+        headers["ETag"] = etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    accel_path = accel_redirect_path(path)
+    if accel_path:
+        # nginx сам отдаст файл через sendfile и обработает Range
+        headers["X-Accel-Redirect"] = accel_path
+        return Response(media_type=media_type, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    range_header = request.headers.get("range")
+    if range_header:
+        if size is None:
+            size = os.path.getsize(path)
+        byte_range = _parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        content = await asyncio.to_thread(_read_file_range, path, start, end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(content=content, status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
 @app.get("/api/user/{user_id}/avatar")
-async def get_user_avatar(user_id: int):
-    """Получить аватарку пользователя через Telegram Bot API"""
+async def get_user_avatar(user_id: int, request: Request):
+    """Получить аватарку пользователя (дисковый кэш, Telegram — только при промахе)"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Получаем фото профиля пользователя
-            async with session.get(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getUserProfilePhotos?user_id={user_id}&limit=1"
-            ) as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=404, detail="Avatar not found")
-
-                data = await resp.json()
-                if not data.get("ok") or data["result"]["total_count"] == 0:
-                    raise HTTPException(status_code=404, detail="No avatar")
-
-                # Берём самый маленький размер (первый в массиве)
-                photo = data["result"]["photos"][0][0]
-                file_id = photo["file_id"]
-
-            # Получаем file_path
-            async with session.get(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={file_id}"
-            ) as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=404, detail="File not found")
-
-                file_data = await resp.json()
-                if not file_data.get("ok"):
-                    raise HTTPException(status_code=404, detail="File not found")
-
-                file_path = file_data["result"]["file_path"]
-
-            # Скачиваем файл
-            async with session.get(
-                f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-            ) as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=404, detail="Failed to download")
-
-                image_data = await resp.read()
-
-                return StreamingResponse(
-                    BytesIO(image_data),
-                    media_type="image/jpeg",
-                    headers={"Cache-Control": "public, max-age=3600"}  # Кэш на 1 час
-                )
-    except HTTPException:
-        raise
-    except Exception as e:
+        path = await avatar_cache.get(user_id)
+    except TelegramFileError as e:
         logger.error(f"Error loading avatar for user {user_id}: {e}")
         raise HTTPException(status_code=404, detail="Avatar not found")
 
+    if not path:
+        raise HTTPException(status_code=404, detail="No avatar")
+
+    # Имя файла — file_unique_id, он же ETag
+    etag = f'"{os.path.splitext(os.path.basename(path))[0]}"'
+    return await _cached_file_response(request, path, "image/jpeg", "public, max-age=3600", etag)  # Кэш на 1 час
+
 
 @app.get("/api/product-image/{file_id}")
-async def get_product_image(file_id: str):
-    """Получить изображение товара через Telegram Bot API"""
+async def get_product_image(file_id: str, request: Request):
+    """Получить изображение товара (локальное хранилище, Telegram — только при первом запросе)"""
     try:
-        # Получаем информацию о файле
-        async with aiohttp.ClientSession() as session:
-            # Получаем file_path
-            async with session.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={file_id}") as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=404, detail="Image not found")
-
-                data = await resp.json()
-                if not data.get("ok"):
-                    raise HTTPException(status_code=404, detail="Image not found")
-
-                file_path = data["result"]["file_path"]
-
-            # Скачиваем файл
-            async with session.get(f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}") as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=404, detail="Failed to download image")
-
-                image_data = await resp.read()
-
-                # Возвращаем изображение
-                return StreamingResponse(
-                    BytesIO(image_data),
-                    media_type="image/jpeg",
-                    headers={"Cache-Control": "public, max-age=86400"}  # Кэш на 24 часа
-                )
-    except Exception as e:
-        print(f"Error loading image {file_id}: {e}")
+        image = await product_images.get(file_id)
+    except TelegramFileError as e:
+        logger.error(f"Error loading image {file_id}: {e}")
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # file_id всегда указывает на одну и ту же картинку — кэшируем надолго
+    return await _cached_file_response(
+        request,
+        image["path"],
+        image["media_type"],
+        "public, max-age=604800, immutable",
+        image["etag"],
+        image["size"]
+    )
+
+
+@app.get("/api/img/{image_path:path}")
+async def get_image_variant(image_path: str, request: Request, w: int = None):
+    """
+    Картинка из static/images, уменьшенная до ширины w (округляется до bucket'а)
+    в лучшем формате по заголовку Accept: AVIF, WebP или исходный.
+    """
+    source_path = resolve_source(image_path)
+    if not source_path:
         raise HTTPException(status_code=404, detail="Image not found")
 
+    fmt = negotiate_format(request.headers.get("accept"))
+    try:
+        variant = await get_variant(source_path, pick_width(w), fmt)
+    except Exception as e:
+        logger.error(f"Error building image variant {image_path} w={w} fmt={fmt}: {e}")
+        return FileResponse(source_path)
+
+    response = await _cached_file_response(
+        request,
+        variant["path"],
+        variant["media_type"],
+        "public, max-age=604800",
+        variant["etag"]
+    )
+    # Ответ зависит от Accept — кэши (браузер, CDN) должны это учитывать
+    response.headers["Vary"] = "Accept"
+    return response
+
 
 # Монтируем статичные файлы
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -0,0 +1,41 @@
+"""
+Настройки gunicorn для API (подхватываются автоматически из WorkingDirectory)
+
+Метрики Prometheus собираются со всех worker'ов через общий каталог
+(см. metrics.py): перед стартом он очищается, а файлы завершившихся
+worker'ов помечаются, чтобы их gauge не суммировались с живыми.
+
+preload_app: api.py импортируется один раз в мастере, а в when_ready (до
+запуска worker'ов) прогреваются каталог и ключ wata — worker'ы получают их
+готовыми через fork (см. "ПРОГРЕВ" в api.py). Код при этом перечитывается
+только полным перезапуском (systemctl restart), не по HUP.
+"""
+
+import os
+import shutil
+
+API_METRICS_DIR = os.getenv("API_METRICS_DIR", "/dev/shm/supercell-api-metrics")
+
+# Worker'ы — fork мастера: prometheus_client должен впервые импортироваться
+# уже с этой переменной, поэтому здесь его не импортируем
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = API_METRICS_DIR
+# С preload_app мастер импортирует api.py (и создаёт файлы метрик) ещё до on_starting
+os.makedirs(API_METRICS_DIR, exist_ok=True)
+
+preload_app = os.getenv("API_PRELOAD", "true").lower() == "true"
+
+
+def on_starting(server):
+    shutil.rmtree(API_METRICS_DIR, ignore_errors=True)
+    os.makedirs(API_METRICS_DIR, exist_ok=True)
+
+
+def when_ready(server):
+    if preload_app:
+        import api
+        api.preload_before_fork()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid, API_METRICS_DIR)
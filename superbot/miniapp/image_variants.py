@@ -0,0 +1,248 @@
+"""
+Адаптивные картинки Mini App (WebP / AVIF)
+==========================================
+
+static/images — это ~38 МБ PNG/JPG в полном разрешении (баннеры категорий,
+главные картинки игр, фото товаров). Телефону столько не нужно.
+
+Flow:
+1. Клиент запрашивает /api/img/<путь в static/images>?w=480
+2. Ширина округляется вверх до ближайшего bucket'а (WIDTH_BUCKETS)
+3. Формат выбирается по заголовку Accept: AVIF → WebP → исходный
+4. Вариант строится один раз и кладётся на диск под хэшем исходника:
+       MEDIA_CACHE_DIR/variants/<xx>/<sha256>-<width>.<ext>
+   Изменился исходник — изменился хэш, старые варианты просто не используются.
+
+Заранее построить все варианты: python build_image_variants.py
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from media_cache import MEDIA_CACHE_DIR, SingleFlight
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow не установлен — отдаём исходники
+    Image = None
+    features = None
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# КОНФИГУРАЦИЯ
+# ============================================
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "images")
+VARIANTS_DIR = os.path.join(MEDIA_CACHE_DIR, "variants")
+
+# Допустимые ширины: произвольный ?w= не должен раздувать кэш
+WIDTH_BUCKETS = (160, 320, 480, 640, 960, 1280)
+DEFAULT_WIDTH = 480
+
+# Ширина картинки товара в ответах API (карточка каталога / экран товара)
+PRODUCT_LIST_WIDTH = 480
+PRODUCT_DETAIL_WIDTH = 960
+
+# Качество кодирования (AVIF при том же качестве заметно меньше WebP)
+WEBP_QUALITY = 80
+AVIF_QUALITY = 55
+
+SUPPORTED_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+_ORIGINAL_MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+_FORMATS = {
+    # формат: (расширение, media type, параметры Pillow)
+    "avif": (".avif", "image/avif", {"quality": AVIF_QUALITY}),
+    "webp": (".webp", "image/webp", {"quality": WEBP_QUALITY, "method": 4}),
+}
+
+
+def _format_supported(name: str) -> bool:
+    if Image is None:
+        return False
+    try:
+        return bool(features.check(name))
+    except Exception:
+        return False
+
+
+AVIF_ENABLED = _format_supported("avif")
+WEBP_ENABLED = _format_supported("webp")
+
+_flight = SingleFlight()
+# (путь, mtime, size) -> sha256, чтобы не хэшировать исходник на каждый запрос
+_digest_cache: dict = {}
+
+
+# ============================================
+# ВЫБОР ВАРИАНТА
+# ============================================
+
+def pick_width(width: Optional[int]) -> int:
+    """Ближайший bucket не меньше запрошенной ширины"""
+    if not width:
+        return DEFAULT_WIDTH
+    for bucket in WIDTH_BUCKETS:
+        if bucket >= width:
+            return bucket
+    return WIDTH_BUCKETS[-1]
+
+
+def negotiate_format(accept: Optional[str]) -> Optional[str]:
+    """Лучший формат, который принимает клиент (None — исходный)"""
+    accept = (accept or "").lower()
+    if AVIF_ENABLED and "image/avif" in accept:
+        return "avif"
+    if WEBP_ENABLED and "image/webp" in accept:
+        return "webp"
+    return None
+
+
+def resolve_source(rel_path: str) -> Optional[str]:
+    """Абсолютный путь к исходнику внутри static/images или None"""
+    path = os.path.realpath(os.path.join(IMAGES_DIR, rel_path))
+    if not path.startswith(os.path.realpath(IMAGES_DIR) + os.sep):
+        return None
+    if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTENSIONS:
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def variant_url(image_path: Optional[str], width: int = DEFAULT_WIDTH) -> Optional[str]:
+    """
+    /static/images/products/1.jpg -> /api/img/products/1.jpg?w=480.
+    Прочие пути (внешние URL, file_id) возвращаются как есть.
+    """
+    prefix = "/static/images/"
+    if not image_path or not image_path.startswith(prefix):
+        return image_path
+    return f"/api/img/{image_path[len(prefix):]}?w={pick_width(width)}"
+
+
+def source_digest(path: str) -> str:
+    """sha256 содержимого исходника (кэшируется по mtime и размеру)"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = _digest_cache.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        _digest_cache[key] = digest
+    return digest
+
+
+# ============================================
+# ПОСТРОЕНИЕ ВАРИАНТОВ
+# ============================================
+
+def _render_variant(source_path: str, dest_path: str, width: int, fmt: Optional[str]):
+    """Уменьшить картинку до width и сохранить в нужном формате (синхронно)"""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    # Уникальный временный файл (как в media_cache.py): варианты одной
+    # картинки строят и потоки одного процесса, и разные worker'ы
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        _save_variant(source_path, tmp_path, width, fmt)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        # Битый исходник или формат без кодека — не оставляем обрезки
+        os.unlink(tmp_path)
+        raise
+
+
+def _save_variant(source_path: str, tmp_path: str, width: int, fmt: Optional[str]):
+    """Декодировать, уменьшить и записать вариант в tmp_path"""
+    with Image.open(source_path) as img:
+        img.load()
+        if img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.LANCZOS)
+
+        if fmt is None:
+            extension = os.path.splitext(source_path)[1].lower()
+            if extension == ".png":
+                img.save(tmp_path, "PNG", optimize=True)
+            else:
+                img.convert("RGB").save(tmp_path, "JPEG", quality=85, optimize=True, progressive=True)
+        else:
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+            img.save(tmp_path, fmt.upper(), **_FORMATS[fmt][2])
+
+
+def _variant_target(source_path: str, width: int, fmt: Optional[str]) -> tuple[str, str, str]:
+    """(путь варианта, media type, digest исходника)"""
+    digest = source_digest(source_path)
+    if fmt is None:
+        extension = os.path.splitext(source_path)[1].lower()
+        media_type = _ORIGINAL_MEDIA_TYPES[extension]
+    else:
+        extension, media_type, _ = _FORMATS[fmt]
+    path = os.path.join(VARIANTS_DIR, digest[:2], f"{digest}-{width}{extension}")
+    return path, media_type, digest
+
+
+async def get_variant(source_path: str, width: int, fmt: Optional[str]) -> dict:
+    """
+    Вариант картинки (строится при первом запросе).
+    Возвращает {'path', 'media_type', 'etag'}.
+    """
+    path, media_type, digest = await asyncio.to_thread(_variant_target, source_path, width, fmt)
+    etag = f'"{digest[:16]}-{width}-{fmt or "orig"}"'
+
+    if Image is None:
+        # Без Pillow — исходный файл как есть
+        return {"path": source_path, "media_type": media_type, "etag": etag}
+
+    if not os.path.exists(path):
+        await _flight.run(path, lambda: asyncio.to_thread(_render_variant, source_path, path, width, fmt))
+
+    return {"path": path, "media_type": media_type, "etag": etag}
+
+
+def build_all(widths=None, formats=None) -> dict:
+    """
+    Построить варианты для всех картинок static/images (шаг сборки).
+    Возвращает {'sources', 'built', 'skipped', 'failed'}.
+    """
+    if Image is None:
+        raise RuntimeError("Pillow не установлен: pip install Pillow")
+
+    widths = widths or WIDTH_BUCKETS
+    if formats is None:
+        formats = [fmt for fmt, enabled in (("avif", AVIF_ENABLED), ("webp", WEBP_ENABLED)) if enabled] + [None]
+
+    stats = {"sources": 0, "built": 0, "skipped": 0, "failed": 0}
+    for root, _, files in os.walk(IMAGES_DIR):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            source_path = os.path.join(root, name)
+            stats["sources"] += 1
+            for width in widths:
+                for fmt in formats:
+                    path, _, _ = _variant_target(source_path, width, fmt)
+                    if os.path.exists(path):
+                        stats["skipped"] += 1
+                        continue
+                    try:
+                        _render_variant(source_path, path, width, fmt)
+                        stats["built"] += 1
+                    except Exception as e:
+                        logger.error(f"Failed to build {name} w={width} fmt={fmt}: {e}")
+                        stats["failed"] += 1
+    return stats
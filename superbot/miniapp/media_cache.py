@@ -0,0 +1,454 @@
+"""
+Дисковый кэш файлов Telegram для Mini App
+=========================================
+
+Аватарки пользователей и картинки товаров раньше скачивались из Telegram
+на каждый запрос, и каждый из 4 worker'ов делал это заново. Теперь файл
+скачивается один раз и отдаётся с диска.
+
+Структура кэша (общая для всех worker'ов):
+    MEDIA_CACHE_DIR/avatars/<user_id>/<file_unique_id>.jpg  — файл аватарки
+    MEDIA_CACHE_DIR/avatars/<user_id>/current.json          — какая аватарка актуальна
+    MEDIA_CACHE_DIR/products/ids/<sha256(file_id)>.json     — file_id → file_unique_id
+    MEDIA_CACHE_DIR/products/<xx>/<sha256(file_unique_id)>  — файл картинки товара
+
+file_unique_id меняется только вместе с картинкой, поэтому файл по этому
+имени никогда не устаревает — после TTL проверяется лишь, не сменил ли
+пользователь фото. Отсутствие аватарки тоже кэшируется (negative cache),
+но только в памяти процесса и с ограничением по размеру: на диске каталог
+появляется лишь у пользователя, чья аватарка действительно скачана.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+
+from metrics import CACHE_REQUESTS, observe_outbound
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# КОНФИГУРАЦИЯ
+# ============================================
+
+MEDIA_CACHE_DIR = os.getenv(
+    "MEDIA_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+)
+
+# Через сколько секунд перепроверять, не сменил ли пользователь аватарку
+AVATAR_CACHE_TTL = int(os.getenv("AVATAR_CACHE_TTL", 6 * 3600))
+# Сколько помнить, что у пользователя нет аватарки
+AVATAR_NEGATIVE_TTL = int(os.getenv("AVATAR_NEGATIVE_TTL", 3600))
+# Сколько таких user_id помнить в памяти процесса (старые вытесняются)
+AVATAR_NEGATIVE_MAX = int(os.getenv("AVATAR_NEGATIVE_MAX", 10000))
+# Сколько помнить file_id, на который Telegram ответил ошибкой (wrong file identifier)
+PRODUCT_IMAGE_NEGATIVE_TTL = int(os.getenv("PRODUCT_IMAGE_NEGATIVE_TTL", 600))
+PRODUCT_IMAGE_NEGATIVE_MAX = int(os.getenv("PRODUCT_IMAGE_NEGATIVE_MAX", 10000))
+
+# Префикс internal-location nginx (X-Accel-Redirect), например /_media/.
+# Пусто — файл отдаёт сам FastAPI.
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "").strip()
+
+TELEGRAM_TIMEOUT = aiohttp.ClientTimeout(total=15)
+# Адрес Bot API (для нагрузочных тестов — loadtest/fake_telegram.py)
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "https://api.telegram.org").rstrip("/")
+
+
+class TelegramFileError(Exception):
+    """Telegram недоступен или вернул ошибку — кэшировать результат нельзя"""
+
+
+# ============================================
+# ОБЩИЕ ХЕЛПЕРЫ
+# ============================================
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия процесса (keep-alive до api.telegram.org)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=TELEGRAM_TIMEOUT)
+    return _session
+
+
+async def close_session():
+    """Закрыть HTTP-сессию (при остановке приложения)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def telegram_api(bot_token: str, method: str, **params) -> Optional[dict]:
+    """
+    Вызов метода Bot API.
+    Возвращает result или None, если Telegram ответил ok=false (например, user not found).
+    """
+    started = time.monotonic()
+    try:
+        async with _get_session().get(
+            f"{TELEGRAM_API_URL}/bot{bot_token}/{method}", params=params
+        ) as resp:
+            data = await resp.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        observe_outbound("telegram", method, "error", time.monotonic() - started)
+        raise TelegramFileError(f"{method}: {e}") from e
+    observe_outbound("telegram", method, resp.status, time.monotonic() - started)
+
+    if resp.status >= 500 or resp.status == 429:
+        raise TelegramFileError(f"{method}: HTTP {resp.status}")
+    if not data.get("ok"):
+        return None
+    return data["result"]
+
+
+async def download_telegram_file(bot_token: str, file_id: str, dest_path: str, file_info: dict = None) -> dict:
+    """
+    Скачать файл по file_id в dest_path (через временный файл, атомарно).
+    file_info — уже полученный результат getFile (чтобы не запрашивать повторно).
+    Возвращает результат getFile.
+    """
+    if file_info is None:
+        file_info = await telegram_api(bot_token, "getFile", file_id=file_id)
+    if not file_info or not file_info.get("file_path"):
+        raise TelegramFileError(f"getFile: no file_path for {file_id}")
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    # Уникальное имя в том же каталоге: две загрузки одного файла (в одном
+    # процессе или в разных worker'ах) не пишут в общий временный файл
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix=".tmp")
+    started = time.monotonic()
+    status = "error"
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with _get_session().get(
+                f"{TELEGRAM_API_URL}/file/bot{bot_token}/{file_info['file_path']}"
+            ) as resp:
+                status = resp.status
+                if resp.status != 200:
+                    raise TelegramFileError(f"download: HTTP {resp.status}")
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    f.write(chunk)
+        os.replace(tmp_path, dest_path)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = "error"
+        raise TelegramFileError(f"download: {e}") from e
+    finally:
+        observe_outbound("telegram", "file", status, time.monotonic() - started)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return file_info
+
+
+def _write_json_atomic(path: str, data: dict):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SingleFlight:
+    """
+    Не больше одной загрузки на ключ внутри процесса:
+    параллельные запросы одного файла ждут результат первого.
+    """
+
+    def __init__(self):
+        self._inflight: dict = {}
+
+    async def run(self, key, coro_factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+
+class NegativeCache:
+    """
+    Ключи, для которых Telegram ответил «нет» (нет аватарки, неверный file_id).
+    Хранится в памяти процесса: размер ограничен, самые старые вытесняются.
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        # ключ → время проверки (порядок — по времени)
+        self._checked: OrderedDict = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        checked_at = self._checked.get(key)
+        if checked_at is None:
+            return False
+        if time.time() - checked_at < self.ttl:
+            return True
+        del self._checked[key]
+        return False
+
+    def add(self, key):
+        self._checked.pop(key, None)
+        self._checked[key] = time.time()
+        while len(self._checked) > self.max_size:
+            self._checked.popitem(last=False)
+
+    def discard(self, key):
+        self._checked.pop(key, None)
+
+
+def accel_redirect_path(cache_path: str) -> Optional[str]:
+    """URI для X-Accel-Redirect или None, если отдача через nginx выключена"""
+    if not MEDIA_ACCEL_REDIRECT:
+        return None
+    rel_path = os.path.relpath(cache_path, MEDIA_CACHE_DIR).replace(os.sep, "/")
+    return MEDIA_ACCEL_REDIRECT.rstrip("/") + "/" + rel_path
+
+
+# ============================================
+# АВАТАРКИ ПОЛЬЗОВАТЕЛЕЙ
+# ============================================
+
+class AvatarCache:
+    """
+    Кэш аватарок: <user_id>/<file_unique_id>.jpg + указатель current.json.
+
+    user_exists — проверка, что user_id есть в базе: эндпоинт открыт без
+    авторизации (картинку грузит <img>), и без проверки любой перебор id
+    шёл бы в Telegram. Вызывается только при промахе.
+    """
+
+    def __init__(self, bot_token: str, cache_dir: str = None,
+                 ttl: int = AVATAR_CACHE_TTL, negative_ttl: int = AVATAR_NEGATIVE_TTL,
+                 negative_max: int = AVATAR_NEGATIVE_MAX,
+                 user_exists: Callable[[int], Awaitable[bool]] = None):
+        self.bot_token = bot_token
+        self.cache_dir = cache_dir or os.path.join(MEDIA_CACHE_DIR, "avatars")
+        self.ttl = ttl
+        self.user_exists = user_exists
+        self._negative = NegativeCache(negative_ttl, negative_max)
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def _user_dir(self, user_id: int) -> str:
+        return os.path.join(self.cache_dir, str(user_id))
+
+    def _lookup(self, user_id: int) -> tuple[Optional[dict], Optional[str]]:
+        """Указатель current.json и путь к файлу (если он есть на диске)"""
+        pointer = _read_json(os.path.join(self._user_dir(user_id), "current.json"))
+        if not pointer or not pointer.get("file_unique_id"):
+            return pointer, None
+        path = os.path.join(self._user_dir(user_id), f"{pointer['file_unique_id']}.jpg")
+        return pointer, path if os.path.exists(path) else None
+
+    async def get(self, user_id: int) -> Optional[str]:
+        """Путь к файлу аватарки или None, если аватарки нет"""
+        pointer, path = self._lookup(user_id)
+        if path and time.time() - pointer.get("checked_at", 0) < self.ttl:
+            self.hits += 1
+            CACHE_REQUESTS.labels("avatars", "hit").inc()
+            return path
+        if not path and user_id in self._negative:
+            self.hits += 1
+            CACHE_REQUESTS.labels("avatars", "hit").inc()
+            return None
+
+        self.misses += 1
+        CACHE_REQUESTS.labels("avatars", "miss").inc()
+        if not path and self.user_exists is not None and not await self.user_exists(user_id):
+            return None
+        try:
+            return await self._flight.run(user_id, lambda: self._refresh(user_id))
+        except TelegramFileError as e:
+            # Telegram недоступен — отдаём устаревшую копию, если есть
+            if path:
+                logger.warning(f"Avatar refresh failed for {user_id}, serving stale copy: {e}")
+                return path
+            raise
+
+    async def _refresh(self, user_id: int) -> Optional[str]:
+        """Сверить аватарку с Telegram и при необходимости скачать"""
+        user_dir = self._user_dir(user_id)
+        pointer_path = os.path.join(user_dir, "current.json")
+
+        photos = await telegram_api(self.bot_token, "getUserProfilePhotos", user_id=user_id, limit=1)
+        if not photos or not photos.get("total_count"):
+            self._negative.add(user_id)
+            # Пользователь убрал фото — старая копия и указатель больше не нужны
+            if os.path.isdir(user_dir):
+                for name in os.listdir(user_dir):
+                    try:
+                        os.remove(os.path.join(user_dir, name))
+                    except OSError:
+                        pass
+                try:
+                    os.rmdir(user_dir)
+                except OSError:
+                    pass
+            return None
+
+        # Самый маленький размер (первый в массиве)
+        photo = photos["photos"][0][0]
+        file_unique_id = photo["file_unique_id"]
+        path = os.path.join(user_dir, f"{file_unique_id}.jpg")
+
+        self._negative.discard(user_id)
+        if not os.path.exists(path):
+            await download_telegram_file(self.bot_token, photo["file_id"], path)
+            # Старые аватарки пользователя больше не нужны
+            for name in os.listdir(user_dir):
+                if name.endswith(".jpg") and name != f"{file_unique_id}.jpg":
+                    try:
+                        os.remove(os.path.join(user_dir, name))
+                    except OSError:
+                        pass
+
+        _write_json_atomic(pointer_path, {"file_unique_id": file_unique_id, "checked_at": time.time()})
+        return path
+
+
+# ============================================
+# КАРТИНКИ ТОВАРОВ
+# ============================================
+
+# Тип по расширению file_path из getFile (фото из Telegram — почти всегда jpg)
+_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+
+
+def _sha256(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class ProductImageStore:
+    """
+    Content-addressed хранилище картинок товаров.
+
+    Файл лежит под sha256(file_unique_id), поэтому разные file_id одной
+    картинки (а у каждого бота они свои) указывают на один файл, а ETag
+    стабилен и не зависит от worker'а.
+    """
+
+    def __init__(self, bot_token: str, cache_dir: str = None,
+                 negative_ttl: int = PRODUCT_IMAGE_NEGATIVE_TTL,
+                 negative_max: int = PRODUCT_IMAGE_NEGATIVE_MAX):
+        self.bot_token = bot_token
+        self.cache_dir = cache_dir or os.path.join(MEDIA_CACHE_DIR, "products")
+        # Неизвестные Telegram file_id: без этого каждый запрос — новый getFile
+        self._unknown = NegativeCache(negative_ttl, negative_max)
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def _index_path(self, file_id: str) -> str:
+        return os.path.join(self.cache_dir, "ids", f"{_sha256(file_id)}.json")
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def lookup(self, file_id: str) -> Optional[dict]:
+        """
+        Локальная копия картинки без обращений к Telegram.
+        Возвращает {'path', 'etag', 'media_type', 'size'} или None.
+        """
+        entry = _read_json(self._index_path(file_id))
+        if not entry:
+            return None
+        path = self._blob_path(entry["digest"])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        return {
+            "path": path,
+            "etag": f'"{entry["digest"][:32]}"',
+            "media_type": entry.get("media_type", "image/jpeg"),
+            "size": size
+        }
+
+    async def get(self, file_id: str) -> dict:
+        """Картинка товара: с диска, а при промахе — один раз из Telegram"""
+        stored = self.lookup(file_id)
+        if stored:
+            self.hits += 1
+            CACHE_REQUESTS.labels("product_images", "hit").inc()
+            return stored
+        if file_id in self._unknown:
+            self.hits += 1
+            CACHE_REQUESTS.labels("product_images", "hit").inc()
+            raise TelegramFileError(f"getFile: unknown file_id {file_id[:20]}...")
+
+        self.misses += 1
+        CACHE_REQUESTS.labels("product_images", "miss").inc()
+        return await self._flight.run(file_id, lambda: self._fetch(file_id))
+
+    async def _fetch(self, file_id: str) -> dict:
+        file_info = await telegram_api(self.bot_token, "getFile", file_id=file_id)
+        if not file_info:
+            self._unknown.add(file_id)
+            raise TelegramFileError(f"getFile: unknown file_id {file_id[:20]}...")
+
+        digest = _sha256(file_info["file_unique_id"])
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            await download_telegram_file(self.bot_token, file_id, path, file_info)
+
+        extension = os.path.splitext(file_info.get("file_path", ""))[1].lower()
+        index_path = self._index_path(file_id)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        _write_json_atomic(index_path, {
+            "digest": digest,
+            "media_type": _MEDIA_TYPES.get(extension, "image/jpeg")
+        })
+        return self.lookup(file_id)
+
+    async def prefetch(self, file_ids, concurrency: int = 4) -> dict:
+        """
+        Прогреть хранилище для списка file_id (уже скачанные пропускаются).
+        Возвращает {'cached', 'fetched', 'failed'}.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        stats = {"cached": 0, "fetched": 0, "failed": 0}
+
+        async def fetch_one(file_id):
+            if self.lookup(file_id):
+                stats["cached"] += 1
+                return
+            async with semaphore:
+                try:
+                    await self.get(file_id)
+                    stats["fetched"] += 1
+                except TelegramFileError as e:
+                    logger.warning(f"Prefetch failed for {file_id[:20]}...: {e}")
+                    stats["failed"] += 1
+
+        await asyncio.gather(*(fetch_one(file_id) for file_id in set(file_ids)))
+        return stats
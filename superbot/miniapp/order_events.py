@@ -0,0 +1,112 @@
+"""
+Live-статусы заказов для Mini App
+=================================
+
+In-process pub/sub, который питает SSE endpoint /api/orders/stream.
+
+Flow:
+1. Webhook / checker / бот меняет статус заказа — в той же транзакции
+   database.py пишет строку в журнал order_events
+2. Каждый worker API читает журнал по возрастанию id (order_events_tail_task)
+   и публикует новые события через broker.publish()
+3. Все открытые Mini App покупателя получают событие из своей очереди
+
+Номер события — id строки в order_events, он общий для всех процессов.
+Клиент (EventSource) передаёт последний полученный номер в заголовке
+Last-Event-ID при переподключении, и пропущенные события досылаются
+из журнала — неважно, к какому worker'у пришёл запрос.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class OrderEvent:
+    """Изменение статуса заказа (строка order_events)"""
+    id: int
+    order_id: int
+    user_id: int
+    old_status: Optional[str]
+    new_status: str
+    source: Optional[str] = None
+    created_at: Optional[str] = None
+
+
+@dataclass(eq=False)
+class Subscription:
+    """Подписка одного открытого Mini App"""
+    user_id: int
+    queue: asyncio.Queue
+    # Очередь переполнилась — клиент пропустил события и должен получить снапшот
+    overflowed: bool = False
+
+
+class OrderEventBroker:
+    """Pub/sub событий заказов внутри одного процесса"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        # id последнего опубликованного события журнала
+        self.last_id = 0
+        self._subscribers: dict[int, set] = {}
+        # Сигнал для tail-задачи: в журнале появились события этого процесса
+        self._changed = asyncio.Event()
+
+    def publish(self, event: OrderEvent):
+        """Разослать событие журнала подписчикам покупателя"""
+        if event.id <= self.last_id:
+            return
+        self.last_id = event.id
+
+        for subscription in self._subscribers.get(event.user_id, ()):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+
+    def subscribe(self, user_id: int) -> Subscription:
+        """Подписаться на события пользователя"""
+        subscription = Subscription(user_id=user_id, queue=asyncio.Queue(maxsize=self.queue_size))
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Отписаться (клиент закрыл Mini App)"""
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.user_id]
+
+    def notify(self):
+        """Разбудить tail-задачу, не дожидаясь очередного опроса журнала"""
+        self._changed.set()
+
+    async def wait_for_changes(self, timeout: float):
+        """Ждать notify() не дольше timeout секунд"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    @staticmethod
+    def parse_cursor(cursor: Optional[str]) -> Optional[int]:
+        """Номер события из Last-Event-ID или None"""
+        if not cursor:
+            return None
+        try:
+            return int(cursor)
+        except ValueError:
+            return None
+
+    @property
+    def subscribers_count(self) -> int:
+        return sum(len(s) for s in self._subscribers.values())
+
+
+# Глобальный broker процесса
+broker = OrderEventBroker()
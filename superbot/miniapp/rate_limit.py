@@ -0,0 +1,295 @@
+"""
+Rate limiting для API (GCRA)
+============================
+
+Старый RateLimiter хранил список timestamp'ов на каждый IP и на каждый
+запрос пересобирал его (плюс второй список для burst). Это O(запросов в
+минуту) на запрос, а записи IP, которые больше не приходят, не удалялись.
+
+GCRA (Generic Cell Rate Algorithm) — тот же token bucket, но на ключ
+хранится одно число: TAT (theoretical arrival time), момент, когда
+bucket снова станет полным.
+
+    T   = period / limit        — интервал между запросами
+    tau = period - T            — сколько можно «опередить» расписание
+    запрос разрешён, если TAT - now <= tau; тогда TAT = max(TAT, now) + T
+
+Лимитов несколько (в минуту и в секунду) — по одному числу на ключ для
+каждого, плюс ещё одно: момент окончания блокировки. При нарушении TAT'ы
+сбрасываются на now, а ключ отклоняется до blocked_until — после
+блокировки у него снова полный bucket, а не остаток, вызвавший нарушение.
+
+Ключ, у которого все значения <= now, ничем не отличается от нового —
+такие ключи удаляются (sweep) или их место занимают новые.
+
+Хранилища состояния:
+- MemoryStore — словарь в памяти процесса
+- SharedMemoryStore — таблица в mmap-файле (/dev/shm), общая для всех
+  worker'ов gunicorn: без неё у каждого из 4 worker'ов свой лимит, и
+  реальный лимит на IP в 4 раза больше настроенного
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import fcntl
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# ХРАНИЛИЩА
+# ============================================
+
+class MemoryStore:
+    """Состояние в памяти процесса: key -> [n_values моментов времени]"""
+
+    def __init__(self, n_values: int):
+        self.n_values = n_values
+        self._tats = {}
+
+    def update(self, key: str, fn):
+        """
+        Атомарно прочитать значения ключа (0.0 — ключа нет), вызвать
+        fn(tats) -> (результат, новые tats или None) и сохранить.
+        """
+        tats = self._tats.get(key) or [0.0] * self.n_values
+        result, new_tats = fn(tats)
+        if new_tats is not None:
+            self._tats[key] = new_tats
+        return result
+
+    def values(self):
+        return list(self._tats.values())
+
+    def sweep(self, now: float) -> int:
+        idle = [key for key, tats in self._tats.items() if max(tats) <= now]
+        for key in idle:
+            del self._tats[key]
+        return len(idle)
+
+
+class SharedMemoryStore:
+    """
+    Состояние в mmap-файле, общее для процессов.
+
+    Таблица разбита на группы по GROUP_SIZE слотов; ключ попадает в группу
+    по хэшу. Поиск и вставка просматривают только свою группу (O(1)),
+    блокировка (fcntl.lockf) берётся на байты этой группы — worker'ы,
+    попавшие в разные группы, друг друга не ждут.
+
+    Слот: 8 байт хэша ключа (0 — пусто) + n_values моментов времени (double).
+    Новый ключ занимает пустой слот, слот с истёкшим TAT или, если группа
+    переполнена, слот с самым ранним TAT (самый «спокойный» ключ).
+    """
+
+    MAGIC = b"GCRA0002"
+    HEADER = struct.Struct("<8sII")  # magic, slots, n_values
+    GROUP_SIZE = 8
+
+    def __init__(self, path: str, n_values: int, slots: int = 65536):
+        self.path = path
+        self.n_values = n_values
+        self.groups = max(1, slots // self.GROUP_SIZE)
+        self.slots = self.groups * self.GROUP_SIZE
+        self._slot = struct.Struct(f"<Q{n_values}d")
+        self._group_bytes = self._slot.size * self.GROUP_SIZE
+        self._offset = self.HEADER.size
+        size = self._offset + self.slots * self._slot.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Инициализация под эксклюзивной блокировкой всего файла:
+        # worker'ы стартуют одновременно
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            expected = self.HEADER.pack(self.MAGIC, self.slots, n_values)
+            if header != expected or os.fstat(self._fd).st_size != size:
+                # Новый файл или другая конфигурация — создаём таблицу заново
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, expected, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        value = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        return value or 1
+
+    def _group_start(self, key_hash: int) -> int:
+        return self._offset + (key_hash % self.groups) * self._group_bytes
+
+    def update(self, key: str, fn):
+        key_hash = self._hash(key)
+        start = self._group_start(key_hash)
+        slot_size = self._slot.size
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._group_bytes, start)
+        try:
+            found = None
+            victim = None
+            victim_tat = None
+            now = time.time()
+            for i in range(self.GROUP_SIZE):
+                pos = start + i * slot_size
+                slot_hash, *tats = self._slot.unpack_from(self._map, pos)
+                if slot_hash == key_hash:
+                    found = (pos, tats)
+                    break
+                # Кандидат на вытеснение: пустой, затем с самым ранним TAT
+                latest = max(tats) if slot_hash else float("-inf")
+                if victim is None or latest < victim_tat:
+                    victim, victim_tat = pos, latest
+
+            if found:
+                pos, tats = found
+            else:
+                pos, tats = victim, [0.0] * self.n_values
+                if victim_tat != float("-inf") and victim_tat > now:
+                    logger.debug("Rate limit table group is full, evicting an active key")
+
+            result, new_tats = fn(tats)
+            if new_tats is not None:
+                self._slot.pack_into(self._map, pos, key_hash, *new_tats)
+            return result
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._group_bytes, start)
+
+    def values(self):
+        """TAT'ы занятых слотов (без блокировки — для статистики)"""
+        result = []
+        for slot_hash, *tats in self._slot.iter_unpack(self._map[self._offset:]):
+            if slot_hash:
+                result.append(tats)
+        return result
+
+    def sweep(self, now: float) -> int:
+        """Очистить слоты с истёкшим TAT (необязательно: их и так займут новые ключи)"""
+        evicted = 0
+        empty = self._slot.pack(0, *([0.0] * self.n_values))
+        for group in range(self.groups):
+            start = self._offset + group * self._group_bytes
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._group_bytes, start)
+            try:
+                for i in range(self.GROUP_SIZE):
+                    pos = start + i * self._slot.size
+                    slot_hash, *tats = self._slot.unpack_from(self._map, pos)
+                    if slot_hash and max(tats) <= now:
+                        self._map[pos:pos + self._slot.size] = empty
+                        evicted += 1
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._group_bytes, start)
+        return evicted
+
+
+def default_shared_path(name: str = "supercell-ratelimit") -> str:
+    """Файл в /dev/shm (RAM), иначе во временном каталоге"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+# ============================================
+# RATE LIMITER
+# ============================================
+
+class GCRALimiter:
+    """
+    Rate limiter: O(1) на проверку. Состояние ключа — TAT по каждому лимиту
+    и момент окончания блокировки (state_size(limits) чисел)
+    """
+
+    @staticmethod
+    def state_size(limits) -> int:
+        """Сколько чисел на ключ нужно хранилищу для этих лимитов"""
+        return len(limits) + 1
+
+    def __init__(self, limits, block_duration: float = 0, store=None, clock=time.time):
+        """
+        limits — список (количество, период в секундах), например
+        [(120, 60), (20, 1)]: не больше 120 в минуту и 20 в секунду.
+        block_duration — на сколько секунд блокировать ключ после нарушения.
+        store — MemoryStore / SharedMemoryStore (по умолчанию в памяти процесса).
+        """
+        self.limits = []
+        for count, period in limits:
+            interval = period / count
+            self.limits.append((interval, period - interval))
+        self.block_duration = block_duration
+        self.store = store or MemoryStore(self.state_size(limits))
+        if self.store.n_values != self.state_size(limits):
+            raise ValueError(f"store: нужно {self.state_size(limits)} значений на ключ, а не {self.store.n_values}")
+        self._clock = clock
+        # Счётчики этого процесса
+        self.stats = {"allowed": 0, "rejected": 0, "blocks": 0, "evicted": 0}
+
+    def _admit(self, state, now: float):
+        """(разрешён, заблокирован сейчас, новое состояние) по текущему состоянию"""
+        *tats, blocked_until = state
+        if blocked_until > now:
+            return (False, False), None
+        new_tats = []
+        for (interval, tolerance), tat in zip(self.limits, tats):
+            if tat < now:
+                tat = now
+            if tat - now > tolerance:
+                if self.block_duration <= 0:
+                    return (False, False), None
+                # Блокировка: bucket'ы сбрасываются, по её окончании лимит полный
+                return (False, True), [now] * len(self.limits) + [now + self.block_duration]
+            new_tats.append(tat + interval)
+        return (True, False), new_tats + [blocked_until]
+
+    def is_allowed(self, key: str) -> bool:
+        """Проверить и учесть запрос"""
+        now = self._clock()
+        allowed, blocked = self.store.update(key, lambda tats: self._admit(tats, now))
+        if allowed:
+            self.stats["allowed"] += 1
+            return True
+
+        self.stats["rejected"] += 1
+        if blocked:
+            self.stats["blocks"] += 1
+            logger.warning(f"{key} blocked for {self.block_duration:.0f}s (rate limit)")
+        return False
+
+    def _is_rejecting(self, state, now: float) -> bool:
+        *tats, blocked_until = state
+        return blocked_until > now or any(
+            tat - now > tolerance for (_, tolerance), tat in zip(self.limits, tats)
+        )
+
+    def is_blocked(self, key: str) -> bool:
+        """Отклоняется ли ключ прямо сейчас (без учёта запроса)"""
+        now = self._clock()
+        return self.store.update(key, lambda tats: (self._is_rejecting(tats, now), None))
+
+    def sweep(self) -> int:
+        """Удалить ключи с полным bucket'ом (неотличимы от новых)"""
+        evicted = self.store.sweep(self._clock())
+        self.stats["evicted"] += evicted
+        return evicted
+
+    def tracked_keys(self) -> int:
+        """Сколько ключей сейчас хранится"""
+        now = self._clock()
+        return sum(1 for tats in self.store.values() if max(tats) > now)
+
+    def get_blocked_count(self) -> int:
+        """Количество ключей, которые сейчас отклоняются"""
+        now = self._clock()
+        return sum(1 for tats in self.store.values() if self._is_rejecting(tats, now))
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "tracked_keys": self.tracked_keys(),
+            "blocked_keys": self.get_blocked_count(),
+        }
@@ -30,16 +30,28 @@ const userPhotoUrl = tg.initDataUnsafe?.user?.photo_url || null; // URL ават
 const initData = tg.initData || '';
 
 // Функция для создания заголовков с авторизацией
-function getAuthHeaders() {
+function getAuthHeaders(idempotencyKey = null) {
     const headers = {
         'Content-Type': 'application/json'
     };
     if (initData) {
         headers['X-Telegram-Init-Data'] = initData;
     }
+    if (idempotencyKey) {
+        headers['Idempotency-Key'] = idempotencyKey;
+    }
     return headers;
 }
 
+// Ключ идемпотентности: один на попытку оформления заказа,
+// чтобы повтор POST из WebView не создавал второй заказ
+function generateIdempotencyKey() {
+    if (window.crypto?.randomUUID) {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
 // Глобальные переменные
 let currentGame = null;
 let currentSubcategory = null;
@@ -527,6 +539,7 @@ window.removeFromCart = removeCartItem;
 
 // ===== МОДАЛЬНОЕ ОКНО ПОКУПКИ =====
 let currentSupercellId = '';
+let currentCheckoutKey = null;
 
 function openProductModal(product) {
     currentProduct = product;
@@ -566,6 +579,7 @@ function closeProductModal() {
     currentCheckoutMode = 'single';
     currentCheckoutItems = [];
     currentSupercellId = '';
+    currentCheckoutKey = null;
     showPurchaseStep(1);
 }
 
@@ -607,6 +621,9 @@ function goToPaymentStep() {
         return;
     }
 
+    // Новые данные — новая попытка оформления
+    currentCheckoutKey = null;
+
     // Обновляем отображение информации пользователя
     if (elements.userSupercellId) {
         elements.userSupercellId.textContent = currentSupercellId;
@@ -641,6 +658,11 @@ async function completeOrder() {
         supercellId: currentSupercellId
     });
 
+    if (!currentCheckoutKey) {
+        currentCheckoutKey = generateIdempotencyKey();
+    }
+    const checkoutKey = currentCheckoutKey;
+
     try {
         // Шаг 1: Создаём заказ
         const purchaseUrl = isCartCheckout ? `${API_URL}/purchase-cart` : `${API_URL}/purchase`;
@@ -661,7 +683,7 @@ async function completeOrder() {
 
         const response = await fetch(purchaseUrl, {
             method: 'POST',
-            headers: getAuthHeaders(),
+            headers: getAuthHeaders(checkoutKey),
             body: JSON.stringify(purchaseBody)
         });
 
@@ -689,7 +711,7 @@ async function completeOrder() {
         // Шаг 2: Получаем ссылку на оплату
         const paymentResponse = await fetch(`${API_URL}/create-sbp-payment`, {
             method: 'POST',
-            headers: getAuthHeaders(),
+            headers: getAuthHeaders(checkoutKey),
             body: JSON.stringify({
                 order_id: result.order_id,
                 user_id: userId
@@ -858,6 +880,7 @@ async function init() {
     initRippleEffects();
     await loadUserProfile();
     await loadAllProducts();
+    startOrderStream();
 
     setTimeout(() => {
         showToast('Добро пожаловать в магазин!', 'success');
@@ -1066,15 +1089,20 @@ async function loadUserProfile() {
 }
 
 function loadUserAvatar() {
-    // Используем photo_url от Telegram WebApp API
-    if (!userPhotoUrl) return;
+    // photo_url от Telegram WebApp API, иначе — аватарка из кэша сервера
+    const avatarUrl = userPhotoUrl || (isTestMode ? null : `${API_URL}/user/${userId}/avatar`);
+    if (!avatarUrl) return;
 
     // Загружаем аватарку в навбар
     const navAvatar = document.getElementById('navAvatar');
     const navPlaceholder = document.getElementById('navAvatarPlaceholder');
 
     if (navAvatar) {
-        navAvatar.src = userPhotoUrl;
+        navAvatar.onerror = () => {
+            navAvatar.style.display = 'none';
+            if (navPlaceholder) navPlaceholder.style.display = '';
+        };
+        navAvatar.src = avatarUrl;
         navAvatar.style.display = 'block';
         if (navPlaceholder) navPlaceholder.style.display = 'none';
     }
@@ -1084,7 +1112,11 @@ function loadUserAvatar() {
     const profilePlaceholder = document.getElementById('profileAvatarPlaceholder');
 
     if (profileAvatar) {
-        profileAvatar.src = userPhotoUrl;
+        profileAvatar.onerror = () => {
+            profileAvatar.style.display = 'none';
+            if (profilePlaceholder) profilePlaceholder.style.display = '';
+        };
+        profileAvatar.src = avatarUrl;
         profileAvatar.style.display = 'block';
         if (profilePlaceholder) profilePlaceholder.style.display = 'none';
     }
@@ -1131,6 +1163,56 @@ function closeProfile() {
     elements.mainPage.style.display = 'block';
 }
 
+// ===== LIVE-СТАТУСЫ ЗАКАЗОВ =====
+// Сервер присылает изменения статусов через Server-Sent Events,
+// EventSource сам переподключается и передаёт Last-Event-ID
+let orderStream = null;
+const orderStatuses = {};
+
+const ORDER_STATUS_TOASTS = {
+    paid: ['✅ Оплата заказа #{id} подтверждена! Код получения отправлен в Telegram', 'success'],
+    completed: ['🎉 Заказ #{id} выполнен!', 'success'],
+    payment_failed: ['❌ Оплата заказа #{id} не прошла', 'error'],
+    cancelled: ['Заказ #{id} отменён', 'info']
+};
+
+function startOrderStream() {
+    if (orderStream || !initData || !window.EventSource) return;
+
+    orderStream = new EventSource(`${API_URL}/orders/stream?init_data=${encodeURIComponent(initData)}`);
+
+    orderStream.addEventListener('snapshot', (e) => {
+        const data = JSON.parse(e.data);
+        (data.orders || []).forEach(order => {
+            orderStatuses[order.order_id] = order.status;
+        });
+    });
+
+    orderStream.addEventListener('order', (e) => {
+        const { order_id, status } = JSON.parse(e.data);
+        const previous = orderStatuses[order_id];
+        orderStatuses[order_id] = status;
+        if (previous === status) return;
+
+        const toast = ORDER_STATUS_TOASTS[status];
+        if (toast) {
+            showToast(toast[0].replace('{id}', order_id), toast[1]);
+        }
+
+        // Обновляем открытый профиль без ручного перезапроса
+        if (elements.profilePage && elements.profilePage.style.display === 'block') {
+            loadUserOrders();
+        }
+        if (status === 'paid' || status === 'completed') {
+            loadUserProfile().catch(err => console.error('Error updating profile:', err));
+        }
+    });
+
+    orderStream.onerror = () => {
+        console.log('Order stream disconnected, browser will reconnect');
+    };
+}
+
 async function loadUserOrders() {
     const ordersList = document.getElementById('ordersList');
     if (!ordersList) return;
@@ -1335,8 +1417,8 @@ function displayCategories(game) {
 <div class="category-card ripple" onclick="openCategoryPage('${cat.subcategory}')">
     <div class="category-image-wrapper">
         <img class="category-image"
-             src="/static/images/categories/${currentGame}/${cat.subcategory}.png"
-             onerror="this.src='/static/images/categories/${currentGame}/main.png'"
+             src="/api/img/categories/${currentGame}/${cat.subcategory}.png?w=320"
+             onerror="this.src='/api/img/categories/${currentGame}/main.png?w=320'"
              alt="${cat.name}">
     </div>
     <div class="category-footer">
@@ -1674,7 +1756,7 @@ function displaySearchResults(products, query = '') {
             Найдено: ${products.length}
         </div>
         ${products.map((product, index) => {
-            let imageUrl = '/static/images/main.png';
+            let imageUrl = '/api/img/main.png?w=160';
             if (product.image_file_id) {
                 imageUrl = `${API_URL}/product-image/${product.image_file_id}`;
             } else if (product.image_path) {
@@ -1685,7 +1767,7 @@ function displaySearchResults(products, query = '') {
             return `
             <div class="search-item" onclick="openProductFromSearch(${index})">
                 <div class="search-item-image">
-                    <img src="${imageUrl}" onerror="this.src='/static/images/main.png'" alt="${product.name}">
+                    <img src="${imageUrl}" onerror="this.src='/api/img/main.png?w=160'" alt="${product.name}">
                 </div>
                 <div class="search-item-content">
                     <div class="search-item-header">
@@ -24,6 +24,8 @@ import httpx
 from dataclasses import dataclass
 from typing import Optional
 
+from metrics import OutboundTransport
+
 logger = logging.getLogger(__name__)
 
 # ============================================
@@ -103,7 +105,7 @@ async def create_payment_link_via_api(
     logger.debug(f"Payload: {payload}")
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with httpx.AsyncClient(timeout=30.0, transport=OutboundTransport("wata")) as client:
             response = await client.post(
                 f"{WATA_API_BASE}/api/h2h/links",
                 headers=headers,
@@ -256,7 +258,7 @@ async def get_wata_public_key():
         return _wata_public_key
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        async with httpx.AsyncClient(timeout=10.0, transport=OutboundTransport("wata")) as client:
             response = await client.get(f"{WATA_API_BASE}/api/h2h/public-key")
 
             if response.status_code == 200:
@@ -33,6 +33,8 @@ from typing import Optional, Dict, Any
 from dataclasses import dataclass
 from enum import Enum
 
+from metrics import OutboundTransport
+
 logger = logging.getLogger(__name__)
 
 #============================================
@@ -178,7 +180,7 @@ class WataPaymentClient:
         logger.info(f"Creating SBP payment: order_id={order_id}, amount={amount}")
 
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
+            async with httpx.AsyncClient(timeout=60.0, transport=OutboundTransport("wata")) as client:
                 response = await client.post(
                     f"{self.base_url}/payments/sbp",
                     headers=self._get_headers(),
@@ -237,7 +239,7 @@ class WataPaymentClient:
             Данные транзакции или None при ошибке
         """
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            async with httpx.AsyncClient(timeout=30.0, transport=OutboundTransport("wata")) as client:
                 response = await client.get(
                     f"{self.base_url}/transactions/{transaction_id}",
                     headers=self._get_headers()
@@ -333,7 +335,7 @@ class WataPaymentClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            async with httpx.AsyncClient(timeout=30.0, transport=OutboundTransport("wata")) as client:
                 response = await client.post(
                     f"{self.base_url}/links",
                     headers=self._get_headers(),
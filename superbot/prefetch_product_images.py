@@ -0,0 +1,35 @@
+"""
+Скрипт для прогрева хранилища картинок товаров Mini App
+Скачивает из Telegram все image_file_id каталога в miniapp/cache/products,
+чтобы /api/product-image отдавал их с диска с первого запроса.
+
+API делает то же самое при старте (PREFETCH_PRODUCT_IMAGES=true);
+скрипт удобен после массового импорта товаров.
+"""
+
+import asyncio
+
+from config import BOT_TOKEN
+from database import get_product_image_file_ids
+from miniapp.media_cache import ProductImageStore, close_session
+
+
+async def prefetch_product_images():
+    """Скачать недостающие картинки товаров"""
+    file_ids = await get_product_image_file_ids()
+    print(f"Картинок в каталоге: {len(file_ids)}")
+
+    store = ProductImageStore(BOT_TOKEN)
+    try:
+        stats = await store.prefetch(file_ids)
+    finally:
+        await close_session()
+
+    print(f"✅ Уже были на диске: {stats['cached']}")
+    print(f"⬇️  Скачано: {stats['fetched']}")
+    if stats["failed"]:
+        print(f"⚠️  Не удалось скачать: {stats['failed']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(prefetch_product_images())
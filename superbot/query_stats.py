@@ -0,0 +1,352 @@
+"""
+Статистика SQL-запросов
+=======================
+
+Каждое соединение database.py создаётся с factory=TimedConnection: курсор
+замеряет выполнение и чтение строк прямо в потоке aiosqlite и копит по
+отпечатку запроса (SQL без литералов и с одним "?" вместо списков IN)
+количество, суммарное и максимальное время.
+
+Запрос дольше SLOW_QUERY_MS пишется в лог "slow_query" вместе с
+EXPLAIN QUERY PLAN (план снимается один раз на отпечаток), чтобы сразу
+было видно SCAN вместо SEARCH ... USING INDEX.
+
+Статистика своя у каждого процесса; процессы раз в QUERY_STATS_DUMP_INTERVAL
+пишут её в QUERY_STATS_DIR/<pid>.json, и query_report() складывает файлы
+всех живых процессов (worker'ы API, бот). Отчёт: GET /api/query-stats.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import QUERY_STATS_DIR, SLOW_QUERY_MS
+from metrics import DB_SLOW_QUERIES
+
+logger = logging.getLogger("slow_query")
+
+QUERY_STATS_DUMP_INTERVAL = 5.0
+# Отпечатки сырых строк SQL (списки IN дают разные строки)
+_FINGERPRINT_CACHE_SIZE = 4096
+
+SLOW_QUERY_SECONDS = SLOW_QUERY_MS / 1000
+
+# Запросы, для которых EXPLAIN QUERY PLAN имеет смысл
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+# отпечаток -> [count, total, max, slow]
+_stats = {}
+# отпечаток -> текст EXPLAIN QUERY PLAN
+_plans = {}
+_fingerprints = {}
+_lock = threading.Lock()
+_last_dump = 0.0
+_dump_enabled = bool(QUERY_STATS_DIR)
+# Список для capture_statements(): (sql, параметры) каждого выполненного запроса
+_capture = None
+
+
+def _reset_after_fork():
+    """
+    Worker gunicorn (preload_app) начинает с пустой статистикой: запросы
+    прогрева уже учтены в файле мастера
+    """
+    global _lock, _last_dump
+    _lock = threading.Lock()
+    _stats.clear()
+    _last_dump = 0.0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def fingerprint(sql: str) -> str:
+    """SQL без литералов и лишних пробелов: одинаковый для запросов с разными параметрами"""
+    result = _fingerprints.get(sql)
+    if result is None:
+        result = _COMMENT_RE.sub(" ", sql)
+        result = _STRING_RE.sub("?", result)
+        result = _NUMBER_RE.sub("?", result)
+        result = _IN_LIST_RE.sub("(?)", result)
+        result = _SPACE_RE.sub(" ", result).strip()
+        if len(_fingerprints) >= _FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[sql] = result
+    return result
+
+
+def _format_plan(rows) -> str:
+    """Строки EXPLAIN QUERY PLAN (id, parent, _, detail) -> дерево с отступами"""
+    depth = {0: 0}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        level = depth.get(parent, 0) + 1
+        depth[node_id] = level
+        lines.append("  " * level + detail)
+    return "\n".join(lines)
+
+
+def _explain(conn: sqlite3.Connection, sql: str, parameters) -> str:
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return ""
+    try:
+        # Обычный курсор: план не должен попасть в статистику
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return f"  (план недоступен: {e})"
+    return _format_plan(rows)
+
+
+# ============================================
+# КУРСОР С ЗАМЕРОМ
+# ============================================
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Курсор, который относит время execute и всех fetch к отпечатку запроса.
+    Запрос считается при execute; время чтения строк добавляется по мере
+    чтения, поэтому SELECT с большим результатом не выглядит быстрым.
+    """
+
+    _query = None
+    _parameters = ()
+    _elapsed = 0.0
+    _slow = False
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(time.perf_counter() - started, True)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Параметры для плана неизвестны (seq может быть генератором)
+        self._start(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(time.perf_counter() - started, True)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._observe(time.perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._observe(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._observe(time.perf_counter() - started)
+
+    def _start(self, sql, parameters):
+        if _capture is not None:
+            _capture.append((sql, parameters))
+        self._query = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._slow = False
+
+    def _observe(self, duration: float, executed: bool = False):
+        if self._query is None:
+            return
+        self._elapsed += duration
+        key = fingerprint(self._query)
+        with _lock:
+            entry = _stats.get(key)
+            if entry is None:
+                entry = _stats[key] = [0, 0.0, 0.0, 0]
+            if executed:
+                entry[0] += 1
+            entry[1] += duration
+            if self._elapsed > entry[2]:
+                entry[2] = self._elapsed
+            slow = not self._slow and self._elapsed >= SLOW_QUERY_SECONDS
+            if slow:
+                entry[3] += 1
+        if slow:
+            self._slow = True
+            self._report_slow(key)
+        _maybe_dump()
+
+    def _report_slow(self, key: str):
+        DB_SLOW_QUERIES.inc()
+        plan = _plans.get(key)
+        if plan is None and self._parameters is not None:
+            plan = _plans[key] = _explain(self.connection, self._query, self._parameters)
+        logger.warning(
+            "Медленный запрос %.0f мс: %s\n%s", self._elapsed * 1000, key, plan or "  (план не снят)"
+        )
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого — TimedCursor (factory для aiosqlite.connect)"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute создаёт курсор в обход cursor() — повторяем его сами
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        # Traceback ошибки из TimedCursor.execute держит курсор, а close()
+        # (sqlite3_close_v2) при живом курсоре только откладывает закрытие —
+        # вместе с незавершённой транзакцией и блокировкой записи. Все
+        # остальные писатели ждали бы busy_timeout
+        if self.in_transaction:
+            self.rollback()
+        super().close()
+
+
+@contextmanager
+def capture_statements():
+    """
+    Собрать запросы, выполненные внутри блока (проверка планов в
+    loadtest/query_plans.py). Параметры executemany не сохраняются (None)
+    """
+    global _capture
+    statements = []
+    _capture = statements
+    try:
+        yield statements
+    finally:
+        _capture = None
+
+
+# ============================================
+# ОТЧЁТ
+# ============================================
+
+def _snapshot() -> dict:
+    with _lock:
+        return {
+            key: {"count": c, "total": t, "max": m, "slow": s, "plan": _plans.get(key)}
+            for key, (c, t, m, s) in _stats.items()
+        }
+
+
+def _maybe_dump():
+    """Записать статистику процесса в QUERY_STATS_DIR (не чаще раза в интервал)"""
+    global _last_dump, _dump_enabled
+    if not _dump_enabled:
+        return
+    now = time.monotonic()
+    with _lock:
+        if now - _last_dump < QUERY_STATS_DUMP_INTERVAL:
+            return
+        _last_dump = now
+    path = os.path.join(QUERY_STATS_DIR, f"{os.getpid()}.json")
+    try:
+        os.makedirs(QUERY_STATS_DIR, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(_snapshot(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        _dump_enabled = False
+        logging.getLogger(__name__).warning(f"Статистика запросов не записывается в {QUERY_STATS_DIR}: {e}")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _other_processes() -> list:
+    """Последние снимки остальных живых процессов; файлы завершившихся удаляются"""
+    if not QUERY_STATS_DIR or not os.path.isdir(QUERY_STATS_DIR):
+        return []
+    own = os.getpid()
+    snapshots = []
+    for name in os.listdir(QUERY_STATS_DIR):
+        pid, ext = os.path.splitext(name)
+        if ext != ".json" or not pid.isdigit() or int(pid) == own:
+            continue
+        path = os.path.join(QUERY_STATS_DIR, name)
+        if not _pid_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+QUERY_REPORT_SORT = ("total", "max", "count", "avg", "slow")
+
+
+def query_report(limit: int = 20, sort: str = "total") -> dict:
+    """Топ запросов по всем процессам: count, суммарное/среднее/максимальное время, план"""
+    if sort not in QUERY_REPORT_SORT:
+        raise ValueError(f"sort: одно из {', '.join(QUERY_REPORT_SORT)}")
+    snapshots = [_snapshot()] + _other_processes()
+    merged = {}
+    for snapshot in snapshots:
+        for key, entry in snapshot.items():
+            total = merged.get(key)
+            if total is None:
+                merged[key] = dict(entry)
+                continue
+            total["count"] += entry["count"]
+            total["total"] += entry["total"]
+            total["max"] = max(total["max"], entry["max"])
+            total["slow"] += entry["slow"]
+            total["plan"] = total["plan"] or entry["plan"]
+
+    queries = [
+        {
+            "query": key,
+            "count": entry["count"],
+            "total_ms": round(entry["total"] * 1000, 2),
+            "avg_ms": round(entry["total"] * 1000 / entry["count"], 3) if entry["count"] else 0.0,
+            "max_ms": round(entry["max"] * 1000, 2),
+            "slow": entry["slow"],
+            "plan": entry["plan"],
+        }
+        for key, entry in merged.items()
+    ]
+    sort_key = {"total": "total_ms", "max": "max_ms", "avg": "avg_ms"}.get(sort, sort)
+    queries.sort(key=lambda item: item[sort_key], reverse=True)
+    return {
+        "processes": len(snapshots),
+        "slow_query_ms": SLOW_QUERY_MS,
+        "statements": len(queries),
+        "total_ms": round(sum(item["total_ms"] for item in queries), 2),
+        "queries": queries[:limit],
+    }
@@ -0,0 +1,125 @@
+"""
+Throttling для всех сообщений и callback'ов бота
+================================================
+
+Раньше лимит проверялся только в /start и «Назад в меню» (check_rate_limit
+в main.py): список datetime на пользователя, который пересобирался на
+каждый вызов и никогда не очищался. Остальные роутеры (покупка,
+категории) лимита не имели вовсе.
+
+ThrottlingMiddleware — outer middleware диспетчера: срабатывает до
+фильтров и хэндлеров, поэтому спам отсекается до любых запросов к БД.
+Лимит — GCRA (miniapp/rate_limit.py): O(1) на событие, одно число на
+пользователя для каждого лимита, неактивные пользователи удаляются.
+
+Лимиты задаются по группам хэндлеров (THROTTLE_LIMITS). Администраторы
+не ограничиваются.
+"""
+
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message
+
+from config import ADMIN_IDS
+from metrics import RATE_LIMITED
+from miniapp.rate_limit import GCRALimiter
+
+logger = logging.getLogger(__name__)
+
+# Группа -> [(количество, период в секундах), ...]
+THROTTLE_LIMITS = {
+    # /start и прочие команды
+    "command": [(10, 60)],
+    # Создание платежей и оплата с баланса
+    "payment": [(10, 60), (2, 1)],
+    # Навигация по меню и каталогу, ввод текста
+    "default": [(60, 60), (8, 1)],
+}
+
+# Префиксы callback_data групп (остальные — default)
+PAYMENT_CALLBACK_PREFIXES = ("confirm_buy_", "pay_balance_", "pay_sbp_")
+
+# Как часто напоминать пользователю о лимите (остальные отказы — молча)
+THROTTLE_NOTICE_PERIOD = 10
+THROTTLE_SWEEP_INTERVAL = 60
+
+THROTTLE_MESSAGE_TEXT = "Вы отправляете запросы слишком часто. Пожалуйста, подождите минуту."
+THROTTLE_CALLBACK_TEXT = "Слишком много запросов. Подождите минуту."
+
+
+def get_throttle_group(event) -> str:
+    """Группа лимита для события"""
+    if isinstance(event, CallbackQuery):
+        if event.data and event.data.startswith(PAYMENT_CALLBACK_PREFIXES):
+            return "payment"
+        return "default"
+    if isinstance(event, Message) and event.text and event.text.startswith("/"):
+        return "command"
+    return "default"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отклоняет события пользователей, превысивших лимит своей группы"""
+
+    def __init__(self, limits: dict = None):
+        limits = limits or THROTTLE_LIMITS
+        self.limiters = {group: GCRALimiter(group_limits) for group, group_limits in limits.items()}
+        # Не больше одного уведомления о лимите за THROTTLE_NOTICE_PERIOD
+        self.notices = GCRALimiter([(1, THROTTLE_NOTICE_PERIOD)])
+        self.stats = {"throttled": 0}
+        self._last_sweep = time.monotonic()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+
+        self._maybe_sweep()
+
+        group = get_throttle_group(event)
+        limiter = self.limiters.get(group) or self.limiters["default"]
+        if limiter.is_allowed(str(user.id)):
+            return await handler(event, data)
+
+        self.stats["throttled"] += 1
+        RATE_LIMITED.labels(f"bot_{group}").inc()
+        notify = self.notices.is_allowed(str(user.id))
+        if notify:
+            # Логируем так же редко, как уведомляем, чтобы флуд не забивал лог
+            logger.warning(f"Throttled user {user.id} (group={group})")
+        await self._reject(event, notify)
+        return None
+
+    async def _reject(self, event, notify: bool):
+        """Один дешёвый ответ вместо хэндлера"""
+        try:
+            if isinstance(event, CallbackQuery):
+                # Отвечаем всегда, иначе у пользователя будут «часики» на кнопке
+                await event.answer(THROTTLE_CALLBACK_TEXT if notify else None)
+            elif notify and isinstance(event, Message):
+                await event.answer(THROTTLE_MESSAGE_TEXT)
+        except TelegramAPIError as e:
+            logger.debug(f"Throttle reply failed: {e}")
+
+    def _maybe_sweep(self):
+        """Удаление неактивных пользователей (раз в THROTTLE_SWEEP_INTERVAL)"""
+        now = time.monotonic()
+        if now - self._last_sweep < THROTTLE_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        evicted = sum(limiter.sweep() for limiter in self.limiters.values())
+        self.notices.sweep()
+        if evicted:
+            logger.debug(f"Throttling: evicted {evicted} idle users")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "tracked_users": {group: limiter.tracked_keys() for group, limiter in self.limiters.items()},
+        }
+
+
+throttling_middleware = ThrottlingMiddleware()
@@ -0,0 +1,192 @@
+"""
+Планировщик обновлений бота
+===========================
+
+start_polling по умолчанию запускает каждое обновление отдельной задачей:
+параллельность не ограничена, а два быстрых нажатия одного пользователя
+выполняются одновременно и гоняются друг с другом (двойная покупка,
+перепутанные состояния FSM).
+
+ChatScheduler:
+- обновления одного чата выполняются строго по очереди
+- разные чаты — параллельно, но не больше UPDATE_MAX_IN_FLIGHT хэндлеров сразу
+- у каждого чата маленькая очередь (UPDATE_CHAT_QUEUE_SIZE); лишнее
+  отбрасывается — флуд одного пользователя не копится в памяти
+- медленный хэндлер (рассылка, создание платежа в wata до 30 секунд)
+  держит только свой чат, меню остальных пользователей не ждёт
+
+ScheduledDispatcher ставит обновление в очередь ещё до middleware
+aiogram, поэтому состояние FSM читается, когда до обновления дошла
+очередь, а не в момент получения.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+from metrics import (
+    BOT_UPDATE_LATENCY, BOT_UPDATE_WAIT, BOT_UPDATES, BOT_UPDATES_IN_FLIGHT, BOT_UPDATES_QUEUED, LATENCY_BUCKETS
+)
+
+logger = logging.getLogger(__name__)
+
+# Максимум одновременно выполняющихся хэндлеров
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", 64))
+# Сколько обновлений чата может ждать своей очереди
+UPDATE_CHAT_QUEUE_SIZE = int(os.getenv("UPDATE_CHAT_QUEUE_SIZE", 5))
+# Сколько ждать незавершённые хэндлеры при остановке (секунды)
+UPDATE_DRAIN_TIMEOUT = 30
+
+
+def update_chat_id(update) -> int:
+    """Чат обновления; для событий без чата — пользователь, иначе 0"""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else 0
+
+
+class ChatScheduler:
+    """Очереди по чатам + общий лимит одновременных хэндлеров"""
+
+    def __init__(self, max_in_flight: int = UPDATE_MAX_IN_FLIGHT, chat_queue_size: int = UPDATE_CHAT_QUEUE_SIZE):
+        self.max_in_flight = max_in_flight
+        self.chat_queue_size = chat_queue_size
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._queues = {}  # chat_id -> deque[(factory, enqueued_at)]
+        self._workers = set()
+        self.in_flight = 0
+        self.stats = {
+            "submitted": 0,
+            "dropped": 0,
+            "processed": 0,
+            "failed": 0,
+            "max_queue_depth": 0,
+        }
+        self.wait_time = {"count": 0, "sum": 0.0, "max": 0.0}
+        self.latency = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+
+    def submit(self, chat_id: int, factory) -> bool:
+        """
+        Поставить обновление в очередь чата. factory() возвращает корутину.
+        False — очередь чата переполнена, обновление отброшено.
+        """
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = deque()
+            self._queues[chat_id] = queue
+            worker = asyncio.create_task(self._run_chat(chat_id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        elif len(queue) >= self.chat_queue_size:
+            self.stats["dropped"] += 1
+            BOT_UPDATES.labels("dropped").inc()
+            logger.warning(f"Chat {chat_id} queue is full ({len(queue)}), update dropped")
+            return False
+
+        queue.append((factory, time.monotonic()))
+        BOT_UPDATES_QUEUED.inc()
+        self.stats["submitted"] += 1
+        if len(queue) > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = len(queue)
+        return True
+
+    async def _run_chat(self, chat_id: int, queue: deque):
+        """Выполняет очередь одного чата, пока она не опустеет"""
+        try:
+            while queue:
+                factory, enqueued_at = queue.popleft()
+                BOT_UPDATES_QUEUED.dec()
+                async with self._semaphore:
+                    started = time.monotonic()
+                    self._observe(self.wait_time, started - enqueued_at)
+                    BOT_UPDATE_WAIT.observe(started - enqueued_at)
+                    self.in_flight += 1
+                    BOT_UPDATES_IN_FLIGHT.inc()
+                    try:
+                        await factory()
+                        self.stats["processed"] += 1
+                        BOT_UPDATES.labels("processed").inc()
+                    except Exception as e:
+                        self.stats["failed"] += 1
+                        BOT_UPDATES.labels("failed").inc()
+                        logger.error(f"Update handler failed in chat {chat_id}: {e}", exc_info=True)
+                    finally:
+                        self.in_flight -= 1
+                        BOT_UPDATES_IN_FLIGHT.dec()
+                        self._observe_latency(time.monotonic() - started)
+        finally:
+            # Между проверкой пустой очереди и удалением нет await — новое
+            # обновление этого чата создаст новый worker
+            if self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+
+    @staticmethod
+    def _observe(metric: dict, value: float):
+        metric["count"] += 1
+        metric["sum"] += value
+        if value > metric["max"]:
+            metric["max"] = value
+
+    def _observe_latency(self, value: float):
+        self._observe(self.latency, value)
+        BOT_UPDATE_LATENCY.observe(value)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.latency["buckets"][i] += 1
+                break
+
+    def queued(self) -> int:
+        """Сколько обновлений ждут в очередях"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "queued": self.queued(),
+            "active_chats": len(self._queues),
+            "wait_time": dict(self.wait_time),
+            "latency": {**self.latency, "buckets": dict(zip(LATENCY_BUCKETS, self.latency["buckets"]))},
+        }
+
+    async def drain(self, timeout: float = UPDATE_DRAIN_TIMEOUT):
+        """Дождаться обработки очередей (при остановке бота)"""
+        if not self._workers:
+            return
+        done, pending = await asyncio.wait(list(self._workers), timeout=timeout)
+        if pending:
+            logger.warning(f"{len(pending)} chats still busy after {timeout}s, cancelling")
+            for task in pending:
+                task.cancel()
+
+
+class ScheduledDispatcher(Dispatcher):
+    """Dispatcher, который выполняет обновления через ChatScheduler"""
+
+    def __init__(self, *args, scheduler: ChatScheduler = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or ChatScheduler()
+
+    async def feed_update(self, bot, update, **kwargs):
+        """Поставить обновление в очередь его чата (ответ не ждём)"""
+        self.scheduler.submit(
+            update_chat_id(update),
+            lambda: Dispatcher.feed_update(self, bot, update, **kwargs)
+        )
+        return UNHANDLED
+
+    async def emit_shutdown(self, *args, **kwargs):
+        # Сначала доделываем начатые обновления, потом закрываем FSM storage и т.п.
+        await self.scheduler.drain()
+        await super().emit_shutdown(*args, **kwargs)